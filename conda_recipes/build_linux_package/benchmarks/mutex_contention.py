@@ -0,0 +1,250 @@
+"""
+Benchmarks s3-object-mutex.py with many sessions contending for the same mutex, like the
+ReindexCondaChannel tasks of many package build jobs that finish together.
+
+It starts the local S3 stand-in from the copy_s3_prefix_to_job_attachments benchmarks, then
+runs the given number of sessions concurrently. Each session runs the enter action, holds
+the mutex for --hold-seconds like the reindex does, and runs the exit action. The first
+--crash-count sessions to get the lock simulate a host that disappears: they stop the
+heartbeat and never run the exit action, so the next session has to wait for the lease
+to expire.
+
+It reports the total time compared with the time the sessions held the mutex, the handoff
+gaps between one session releasing the mutex and the next one acquiring it, and the API
+calls, and fails if two sessions held the mutex at the same time.
+
+Example:
+
+    python mutex_contention.py --sessions 24 --hold-seconds 2 --latency-ms 20
+"""
+
+import argparse
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from pathlib import Path
+
+BENCHMARKS_DIR = Path(__file__).parent
+MUTEX_SCRIPT = BENCHMARKS_DIR.parent / "scripts" / "s3-object-mutex.py"
+FAKE_S3_SERVER = (
+    BENCHMARKS_DIR.parents[2]
+    / "job_bundles"
+    / "copy_s3_prefix_to_job_attachments"
+    / "benchmarks"
+    / "fake_s3_server.py"
+)
+BUCKET = "benchmark-conda-channel"
+CHANNEL_URL = f"s3://{BUCKET}/Conda/Default/"
+
+
+def start_server(args):
+    """Starts the fake S3 server, and returns the process and its URL."""
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            str(FAKE_S3_SERVER),
+            "--latency-ms",
+            str(args.latency_ms),
+            "--latency-jitter-ms",
+            str(args.latency_jitter_ms),
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    line = server.stdout.readline()
+    if not line.startswith("Listening on "):
+        server.kill()
+        raise RuntimeError(f"The fake S3 server failed to start: {line!r}")
+    return server, line.split()[-1]
+
+
+def admin_request(url, path, body=None):
+    request = urllib.request.Request(
+        url + path, data=json.dumps(body).encode() if body is not None else None
+    )
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)
+
+
+class Session:
+    """One session that enters the mutex, holds it, and exits it."""
+
+    def __init__(self, index, args, env, work_dir, crash_slots):
+        self.index = index
+        self.args = args
+        self.state_dir = work_dir / f"session_{index}"
+        self.log_path = work_dir / f"session_{index}.log"
+        self.env = dict(
+            env,
+            DEADLINE_JOB_ID=f"job-{index}",
+            DEADLINE_SESSION_ID=f"session-{index}",
+            DEADLINE_WORKER_ID=f"worker-{index}",
+        )
+        self.crash_slots = crash_slots
+        self.acquired_time = None
+        self.released_time = None
+        self.crashed = False
+        self.error = None
+
+    def _run_action(self, action, log_file):
+        subprocess.run(
+            [
+                sys.executable,
+                str(MUTEX_SCRIPT),
+                action,
+                CHANNEL_URL,
+                "--state-dir",
+                str(self.state_dir),
+                "--lease-seconds",
+                str(self.args.lease_seconds),
+            ],
+            env=self.env,
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            check=True,
+        )
+
+    def run(self):
+        try:
+            with open(self.log_path, "w") as log_file:
+                self._run_action("enter", log_file)
+                self.acquired_time = time.monotonic()
+                time.sleep(self.args.hold_seconds)
+                self.crashed = self.crash_slots.take()
+                if self.crashed:
+                    # Stop the heartbeat without releasing the lock, like a host that disappears
+                    state_file = next(self.state_dir.glob("s3-object-mutex-*.json"))
+                    os.kill(json.loads(state_file.read_text())["heartbeatPid"], signal.SIGKILL)
+                    self.released_time = time.monotonic()
+                    return
+                self.released_time = time.monotonic()
+                self._run_action("exit", log_file)
+        except Exception as exc:
+            self.error = exc
+
+
+class CrashSlots:
+    """A counter of the sessions that still have to crash, shared by the session threads."""
+
+    def __init__(self, count):
+        self._count = count
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Returns True if the calling session should crash."""
+        with self._lock:
+            if self._count > 0:
+                self._count -= 1
+                return True
+            return False
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--sessions", type=int, default=24)
+    parser.add_argument("--hold-seconds", type=float, default=2)
+    parser.add_argument("--lease-seconds", type=int, default=10)
+    parser.add_argument("--crash-count", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--latency-jitter-ms", type=float, default=0)
+    parser.add_argument(
+        "--work-dir", type=Path, help="Where to put the state and logs. Defaults to a temporary directory."
+    )
+    parser.add_argument("--output", type=Path, help="Save the results as JSON to this file.")
+    args = parser.parse_args()
+
+    server, url = start_server(args)
+    try:
+        admin_request(url, "/_benchmark/reset", {"buckets": [BUCKET]})
+        env = {
+            name: value
+            for name, value in os.environ.items()
+            if not name.startswith("AWS_") and not name.startswith("DEADLINE_")
+        }
+        env.update(
+            AWS_ENDPOINT_URL=url,
+            AWS_ACCESS_KEY_ID="benchmark",
+            AWS_SECRET_ACCESS_KEY="benchmark",
+            AWS_DEFAULT_REGION="us-west-2",
+            AWS_EC2_METADATA_DISABLED="true",
+            DEADLINE_FARM_ID="farm-benchmark",
+            DEADLINE_QUEUE_ID="queue-benchmark",
+            DEADLINE_FLEET_ID="fleet-benchmark",
+            PYTHONUNBUFFERED="True",
+        )
+        with tempfile.TemporaryDirectory(prefix="s3-object-mutex-benchmark-") as temp_dir:
+            work_dir = args.work_dir or Path(temp_dir)
+            work_dir.mkdir(parents=True, exist_ok=True)
+            crash_slots = CrashSlots(args.crash_count)
+            sessions = [Session(i, args, env, work_dir, crash_slots) for i in range(args.sessions)]
+            threads = [threading.Thread(target=session.run) for session in sessions]
+            start_time = time.monotonic()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            seconds = time.monotonic() - start_time
+            stats = admin_request(url, "/_benchmark/stats")
+    finally:
+        server.terminate()
+        server.wait()
+
+    failed = [session for session in sessions if session.error is not None]
+    for session in failed:
+        print(f"Session {session.index} failed, see {session.log_path}: {session.error}")
+    if failed:
+        sys.exit(1)
+
+    held = sorted(sessions, key=lambda session: session.acquired_time)
+    overlaps = sum(
+        1 for previous, current in zip(held, held[1:]) if current.acquired_time < previous.released_time
+    )
+    gaps = [current.acquired_time - previous.released_time for previous, current in zip(held, held[1:])]
+    normal_gaps = [gap for gap, previous in zip(gaps, held) if not previous.crashed] or [0]
+    crash_gaps = [gap for gap, previous in zip(gaps, held) if previous.crashed]
+    hold_seconds = args.sessions * args.hold_seconds
+    results = {
+        "config": {name: str(value) if isinstance(value, Path) else value for name, value in vars(args).items()},
+        "seconds": round(seconds, 3),
+        "held_seconds": hold_seconds,
+        "overhead_seconds": round(seconds - hold_seconds, 3),
+        "handoff_gap_seconds": {
+            "mean": round(statistics.mean(normal_gaps), 3),
+            "median": round(statistics.median(normal_gaps), 3),
+            "max": round(max(normal_gaps), 3),
+        },
+        "crash_takeover_seconds": [round(gap, 3) for gap in crash_gaps],
+        "api_calls": stats["requests"],
+        "overlaps": overlaps,
+    }
+    print(
+        f"{args.sessions} sessions in {seconds:.2f}s, held the mutex for {hold_seconds:.2f}s, "
+        f"{seconds - hold_seconds:.2f}s overhead"
+    )
+    print(
+        f"Handoff gap {results['handoff_gap_seconds']['mean']:.3f}s mean, "
+        f"{results['handoff_gap_seconds']['median']:.3f}s median, {results['handoff_gap_seconds']['max']:.3f}s max"
+    )
+    if crash_gaps:
+        print(f"Takeover after a crashed holder: {', '.join(f'{gap:.2f}s' for gap in crash_gaps)}")
+    print(f"API calls: {', '.join(f'{name} {count}' for name, count in sorted(stats['requests'].items()))}")
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(results, fh, indent=2)
+        print(f"Saved the results to {args.output}")
+    if overlaps:
+        print(f"ERROR: Sessions held the mutex at the same time {overlaps} times")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
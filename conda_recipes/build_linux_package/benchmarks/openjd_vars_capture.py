@@ -0,0 +1,193 @@
+"""
+Checks that openjd-vars-capture.py with an `env -0` snapshot prints the same environment
+changes as the former pair of openjd-vars-start.py and openjd-vars-capture.py, and
+benchmarks the two.
+
+Each case runs a bash script that takes a snapshot, changes the environment the way an
+activation does, and captures the changes. The cases cover new, modified and unset
+variables, and values with newlines, non-ASCII text, quotes, backslashes, '=' and bytes
+that aren't UTF-8. It runs the cases with the inherited locale, and with the C locale that
+worker agents often run in, where Python changes its own LC_CTYPE. The openjd_env lines
+must be identical and in the same order. The former capture printed the openjd_unset_env
+lines in set order, which varies with the hash seed, so those are compared as sets.
+
+The benchmark times the whole snapshot and capture sequence of each approach, which is
+what a session pays on every environment activation. Use --python to time it with the
+interpreter of a large conda environment, where the site packages slow the startup.
+
+Example:
+
+    python openjd_vars_capture.py --iterations 50
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BENCHMARKS_DIR = Path(__file__).parent
+CAPTURE_SCRIPT = BENCHMARKS_DIR.parent / "scripts" / "openjd-vars-capture.py"
+
+# The former pair of scripts, from before the capture took an `env -0` snapshot
+FORMER_START_SCRIPT = """\
+import json
+import os
+import sys
+
+# Exclude the env var "_" as it has special meaning to shells
+before = dict(os.environ)
+if "_" in before:
+    del before["_"]
+
+with open(sys.argv[1], "w", encoding="utf8") as f:
+    json.dump(before, f)
+"""
+FORMER_CAPTURE_SCRIPT = """\
+import json
+import os
+import sys
+
+# Get the snapshot from `openjd-vars-start.py`, and the current environment state.
+with open(sys.argv[1], "r", encoding="utf8") as f:
+    before = json.load(f)
+after = dict(os.environ)
+# Exclude the env var "_" as it has special meaning to shells
+if "_" in after:
+    del after["_"]
+
+# Identify the modified and deleted environment variables
+vars_to_put = {k: v for k, v in after.items() if v != before.get(k)}
+vars_to_delete = {k for k in before if k not in after}
+
+# Print the env var changes following the Open Job Description specification
+for k, v in vars_to_put.items():
+    kv = json.dumps(f"{k}={v}", ensure_ascii=True)
+    print(f"openjd_env: {kv}")
+for k in vars_to_delete:
+    print(f"openjd_unset_env: {k}")
+"""
+
+# The environment before each case, and the bash commands that change it like an activation
+BASE_ENV = {
+    "BENCH_UNCHANGED": "same value",
+    "BENCH_MODIFIED": "old value",
+    "BENCH_REMOVED": "going away",
+    "BENCH_REMOVED_MULTILINE": "line one\nline two",
+    "BENCH_UNCHANGED_UNICODE": "café 日本",
+}
+CASES = {
+    "new variable": "export BENCH_NEW=hello",
+    "modified variable": "export BENCH_MODIFIED='new value'",
+    "unset variables": "unset BENCH_REMOVED BENCH_REMOVED_MULTILINE",
+    "empty value": "export BENCH_EMPTY=",
+    "newlines": "export BENCH_NEWLINES=$'first\\nsecond\\n\\nfourth\\n'",
+    "non-ASCII": "export BENCH_UNICODE=$'r\\u00e9sum\\u00e9 \\u2014 \\U0001F600 \\u65e5\\u672c\\u8a9e'",
+    "quotes and backslashes": "export BENCH_QUOTES=$'say \"hi\" \\\\ it\\'s\\t=tab'",
+    "equals signs": "export BENCH_EQUALS='a=b=c=='",
+    "invalid UTF-8": "export BENCH_BYTES=$'\\xff\\xfe ok'",
+    "PATH prefix": 'export PATH="/opt/conda/envs/bench/bin:$PATH"',
+    "activation": (
+        "export CONDA_PREFIX=/opt/conda/envs/bench CONDA_SHLVL=1 CONDA_DEFAULT_ENV=bench"
+        " && export PATH=\"$CONDA_PREFIX/bin:$PATH\" BENCH_MODIFIED=$'multi\\nline \\u00fc'"
+        " && unset BENCH_REMOVED"
+    ),
+}
+
+
+def run_bash(script, env):
+    result = subprocess.run(["bash", "-c", script], env=env, capture_output=True, check=True)
+    return result.stdout.decode("utf-8", errors="surrogateescape")
+
+
+def former_script(python, tmp_dir, change):
+    return (
+        "set -euo pipefail\n"
+        f"{python} {tmp_dir}/openjd-vars-start.py {tmp_dir}/.vars\n"
+        f"{change}\n"
+        f"{python} {tmp_dir}/openjd-vars-capture.py {tmp_dir}/.vars\n"
+    )
+
+
+def single_process_script(python, tmp_dir, change):
+    return (
+        "set -euo pipefail\n"
+        f"env -0 > {tmp_dir}/.vars\n"
+        f"{change}\n"
+        f"PYTHONCOERCECLOCALE=0 {python} -S {CAPTURE_SCRIPT} {tmp_dir}/.vars\n"
+    )
+
+
+def split_output(output):
+    lines = output.splitlines()
+    return (
+        [line for line in lines if not line.startswith("openjd_unset_env:")],
+        sorted(line for line in lines if line.startswith("openjd_unset_env:")),
+    )
+
+
+def check_equivalence(python, tmp_dir, env):
+    failures = 0
+    for name, change in CASES.items():
+        former = run_bash(former_script(python, tmp_dir, change), env)
+        single = run_bash(single_process_script(python, tmp_dir, change), env)
+        if split_output(former) == split_output(single) and former.strip():
+            print(f"  OK    {name}: {len(former.splitlines())} lines")
+        else:
+            failures += 1
+            print(f"  FAIL  {name}")
+            print("    former pair:\n      " + "\n      ".join(former.splitlines()))
+            print("    single process:\n      " + "\n      ".join(single.splitlines()))
+    return failures
+
+
+def benchmark(script, env, iterations):
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        run_bash(script, env)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--python", default=sys.executable, help="The Python interpreter that runs the scripts")
+    parser.add_argument("--iterations", type=int, default=30)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.update(BASE_ENV)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        Path(tmp_dir, "openjd-vars-start.py").write_text(FORMER_START_SCRIPT)
+        Path(tmp_dir, "openjd-vars-capture.py").write_text(FORMER_CAPTURE_SCRIPT)
+
+        # Python coerces the C locale to a UTF-8 one when LC_ALL and LC_CTYPE are unset
+        c_locale_env = {k: v for k, v in env.items() if not k.startswith("LC_")}
+        c_locale_env["LANG"] = "C"
+        failures = 0
+        for locale_name, locale_env in [("the inherited locale", env), ("the C locale", c_locale_env)]:
+            print(f"Checking that the output is the same in {locale_name}, with {args.python}:")
+            failures += check_equivalence(args.python, tmp_dir, locale_env)
+
+        change = CASES["activation"]
+        print(f"Benchmarking {args.iterations} captures of each:")
+        former = benchmark(former_script(args.python, tmp_dir, change), env, args.iterations)
+        single = benchmark(single_process_script(args.python, tmp_dir, change), env, args.iterations)
+    for name, durations in [("former pair", former), ("single process", single)]:
+        print(
+            f"  {name:<15} median {statistics.median(durations) * 1000:7.1f} ms, "
+            f"min {min(durations) * 1000:7.1f} ms, max {max(durations) * 1000:7.1f} ms"
+        )
+    print(f"  Speedup: {statistics.median(former) / statistics.median(single):.2f}x")
+
+    if failures:
+        print(f"FAILED: {failures} cases printed different output")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -81,20 +81,12 @@ if [ ! -z "$OVERRIDE_PACKAGE_NAME" ]; then
     PACKAGE_NAME="$OVERRIDE_PACKAGE_NAME"
 fi
 PACKAGE_VERSION=$(yq .package.version rendered_meta.yaml -r)
-if conda search \
-        $CHANNEL_OPTIONS \
-        --platform $CONDA_PLATFORM \
-        --json \
-        --spec "$PACKAGE_NAME==$PACKAGE_VERSION" > package-search.json; then
-    BUILD_NUMBER=$(jq ".\"$PACKAGE_NAME\" | max_by(.build_number) | .build_number + 1" package-search.json)
-else
-    # If it's not a package not found error, fail the build
-    if grep -qv PackagesNotFoundError; then
-        cat package-search.json
-        exit 1
-    fi
-    BUILD_NUMBER=0
-fi
+SCRIPT_DIR="$(dirname "${BASH_SOURCE[0]}")"
+BUILD_NUMBER=$(python "$SCRIPT_DIR/next-build-number.py" \
+    "$S3_CHANNEL" \
+    "$CONDA_PLATFORM" \
+    "$PACKAGE_NAME" \
+    "$PACKAGE_VERSION")
 
 echo "Selected build number $BUILD_NUMBER"
 
@@ -129,12 +121,9 @@ conda build --no-anaconda-upload \
     "$RECIPE_DIR"
 
 echo "Uploading the package(s) to the S3 Conda channel..."
-for SUBDIR in $CONDA_PLATFORM noarch; do
-    aws s3 sync --no-progress \
-        "$CONDA_BLD_DIR/$SUBDIR" \
-        "$S3_CHANNEL/$SUBDIR" \
-        --exclude "*" \
-        --include "*.conda"
-done
+python "$SCRIPT_DIR/upload-conda-packages.py" \
+    "$S3_CHANNEL" \
+    "$CONDA_BLD_DIR" \
+    $CONDA_PLATFORM noarch
 
 echo "All done"
@@ -0,0 +1,81 @@
+"""
+Prints the subdirs of an S3 conda channel whose index does not match their packages, one
+per line, so that a reindex can skip the channel when another session already indexed the
+packages it uploaded.
+
+A subdir is pending if it has a .conda package that is missing from its repodata.json,
+or its repodata.json lists a .conda package that is no longer there. This compares the
+package filenames instead of the timestamps of the packages and the index, because the
+LastModified time of an object uploaded in parts is when its upload started, which can be
+before a reindex started even if the reindex didn't see it.
+
+Usage:
+    $ python conda-channel-pending.py s3://<bucket-name>/channel/prefix
+
+Required permissions on the S3 bucket prefix:
+* s3:ListBucket
+* s3:GetObject
+"""
+
+import argparse
+import json
+import sys
+from urllib.parse import urlparse
+
+import boto3
+from botocore.exceptions import ClientError
+
+parser = argparse.ArgumentParser()
+parser.add_argument("s3_conda_channel", type=str)
+args = parser.parse_args()
+
+url = urlparse(args.s3_conda_channel, allow_fragments=False)
+if url.scheme != "s3":
+    print(f"ERROR: The S3 conda channel {args.s3_conda_channel} is not an s3:// URL", file=sys.stderr)
+    sys.exit(1)
+s3_bucket_name = url.netloc
+s3_prefix = url.path.strip("/")
+
+s3_client = boto3.client("s3")
+paginator = s3_client.get_paginator("list_objects_v2")
+
+
+def list_subdirs():
+    subdirs = []
+    for page in paginator.paginate(Bucket=s3_bucket_name, Prefix=f"{s3_prefix}/", Delimiter="/"):
+        for common_prefix in page.get("CommonPrefixes", []):
+            subdirs.append(common_prefix["Prefix"][len(s3_prefix) + 1 :].rstrip("/"))
+    return subdirs
+
+
+def list_packages(subdir):
+    packages = set()
+    for page in paginator.paginate(Bucket=s3_bucket_name, Prefix=f"{s3_prefix}/{subdir}/", Delimiter="/"):
+        for obj in page.get("Contents", []):
+            filename = obj["Key"].rsplit("/", 1)[-1]
+            if filename.endswith(".conda"):
+                packages.add(filename)
+    return packages
+
+
+def list_indexed_packages(subdir):
+    try:
+        response = s3_client.get_object(Bucket=s3_bucket_name, Key=f"{s3_prefix}/{subdir}/repodata.json")
+    except ClientError as exc:
+        if int(exc.response["ResponseMetadata"]["HTTPStatusCode"]) != 404:
+            raise
+        return set()
+    return set(json.loads(response["Body"].read()).get("packages.conda", {}))
+
+
+for subdir in list_subdirs():
+    packages = list_packages(subdir)
+    indexed_packages = list_indexed_packages(subdir)
+    if packages == indexed_packages:
+        continue
+    print(
+        f"Subdir {subdir} has {len(packages - indexed_packages)} packages to add to its index "
+        f"and {len(indexed_packages - packages)} to remove",
+        file=sys.stderr,
+    )
+    print(subdir)
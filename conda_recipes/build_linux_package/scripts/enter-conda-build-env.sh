@@ -65,6 +65,7 @@ popd
 
 echo "Capturing the environment variables for the OpenJD environment scope..."
 VARS_TMP="$(mktemp vars-capture.tmp.XXXXXXXXXX)"
-python "$(dirname $0)/openjd-vars-start.py" "$VARS_TMP"
-conda run -p "$ENV_DIR" python "$(dirname $0)/openjd-vars-capture.py" "$VARS_TMP"
+env -0 > "$VARS_TMP"
+eval "$(conda shell.posix activate "$ENV_DIR")"
+PYTHONCOERCECLOCALE=0 python -S "$(dirname $0)/openjd-vars-capture.py" "$VARS_TMP"
 rm "$VARS_TMP"
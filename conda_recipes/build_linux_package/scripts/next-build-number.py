@@ -0,0 +1,54 @@
+"""
+Prints the next build number for a package version in an S3 conda channel.
+
+It reads repodata.json of the platform subdir and noarch, and prints one more than the
+largest build number of the package version, or 0 if the channel doesn't have it. This
+is a couple of GETs, instead of a conda search that loads and solves over every channel.
+
+Usage:
+    $ python next-build-number.py s3://<bucket-name>/channel/prefix <platform> <package-name> <version>
+
+Required permissions on the S3 bucket prefix:
+* s3:ListBucket (so that a missing repodata.json is a 404 instead of a 403)
+* s3:GetObject
+"""
+
+import argparse
+import json
+import sys
+from urllib.parse import urlparse
+
+import boto3
+from botocore.exceptions import ClientError
+
+parser = argparse.ArgumentParser()
+parser.add_argument("s3_conda_channel", type=str)
+parser.add_argument("platform", type=str)
+parser.add_argument("package_name", type=str)
+parser.add_argument("version", type=str)
+args = parser.parse_args()
+
+url = urlparse(args.s3_conda_channel, allow_fragments=False)
+if url.scheme != "s3":
+    print(f"ERROR: The S3 conda channel {args.s3_conda_channel} is not an s3:// URL", file=sys.stderr)
+    sys.exit(1)
+s3_bucket_name = url.netloc
+s3_prefix = url.path.strip("/")
+
+s3_client = boto3.client("s3")
+
+build_numbers = []
+for subdir in sorted({args.platform, "noarch"}):
+    try:
+        response = s3_client.get_object(Bucket=s3_bucket_name, Key=f"{s3_prefix}/{subdir}/repodata.json")
+    except ClientError as exc:
+        if int(exc.response["ResponseMetadata"]["HTTPStatusCode"]) != 404:
+            raise
+        continue
+    repodata = json.loads(response["Body"].read())
+    for section in ("packages", "packages.conda"):
+        for record in repodata.get(section, {}).values():
+            if record.get("name") == args.package_name and record.get("version") == args.version:
+                build_numbers.append(record.get("build_number", 0))
+
+print(max(build_numbers) + 1 if build_numbers else 0)
@@ -1,22 +1,44 @@
+"""
+Prints the environment variables that changed since a snapshot, as Open Job Description
+openjd_env and openjd_unset_env lines, so that the session keeps an activated environment.
+
+Take the snapshot with `env -0` from the shell, so that the capture is a single Python
+process. Run it with `python -S`, because it only needs the standard library and skipping
+the site packages of a large environment speeds up the interpreter startup. Also set
+PYTHONCOERCECLOCALE=0, because in the C locale Python otherwise adds LC_CTYPE to its own
+environment, which the snapshot from the shell doesn't have.
+
+Usage:
+    $ env -0 > .vars
+    $ conda activate <env>
+    $ PYTHONCOERCECLOCALE=0 python -S openjd-vars-capture.py .vars
+"""
+
 import json
 import os
 import sys
 
-# Get the snapshot from `openjd-vars-start.py`, and the current environment state.
-with open(sys.argv[1], "r", encoding="utf8") as f:
-    before = json.load(f)
+# Get the snapshot from `env -0`, and the current environment state.
+with open(sys.argv[1], "rb") as f:
+    snapshot = f.read()
+before = {}
+for entry in snapshot.split(b"\0"):
+    name, _, value = os.fsdecode(entry).partition("=")
+    # Skip the empty entry at the end, and the hidden per-drive variables like "=C:" on Windows
+    if name:
+        # Windows variable names are case-insensitive, and os.environ upper-cases them
+        before[name.upper() if os.name == "nt" else name] = value
 after = dict(os.environ)
-# Exclude the env var "_" as it has special meaning to shells
-if "_" in after:
-    del after["_"]
+# Exclude the env var "_" as it has special meaning to shells, and the one set for this script
+for name in ("_", "PYTHONCOERCECLOCALE"):
+    before.pop(name, None)
+    after.pop(name, None)
 
 # Identify the modified and deleted environment variables
 vars_to_put = {k: v for k, v in after.items() if v != before.get(k)}
-vars_to_delete = {k for k in before if k not in after}
+vars_to_delete = [k for k in before if k not in after]
 
 # Print the env var changes following the Open Job Description specification
-for k, v in vars_to_put.items():
-    kv = json.dumps(f"{k}={v}", ensure_ascii=True)
-    print(f"openjd_env: {kv}")
-for k in vars_to_delete:
-    print(f"openjd_unset_env: {k}")
+lines = [f"openjd_env: {json.dumps(f'{k}={v}', ensure_ascii=True)}\n" for k, v in vars_to_put.items()]
+lines.extend(f"openjd_unset_env: {k}\n" for k in vars_to_delete)
+sys.stdout.write("".join(lines))
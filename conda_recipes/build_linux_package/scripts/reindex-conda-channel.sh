@@ -4,6 +4,8 @@ set -euo pipefail
 REINDEXING_DIR=
 S3_CHANNEL=
 CONDA_CHANNEL_NAME=
+MUTEX_URL=
+MUTEX_STATE_DIR=
 
 # Parse the CLI arguments
 while [ $# -gt 0 ]; do
@@ -11,6 +13,8 @@ while [ $# -gt 0 ]; do
     --reindexing-dir) REINDEXING_DIR="$2" ; shift 2 ;;
     --s3-conda-channel) S3_CHANNEL="$2" ; shift 2 ;;
     --conda-channel-name) CONDA_CHANNEL_NAME="$2" ; shift 2 ;;
+    --mutex-url) MUTEX_URL="$2" ; shift 2 ;;
+    --mutex-state-dir) MUTEX_STATE_DIR="$2" ; shift 2 ;;
     *) echo "Unexpected option: $1" ; exit 1 ;;
   esac
 done
@@ -27,6 +31,10 @@ if [ -z "$CONDA_CHANNEL_NAME" ]; then
     echo "ERROR: Option --conda-channel-name is required."
     exit 1
 fi
+if [ -n "$MUTEX_URL" ] && [ -z "$MUTEX_STATE_DIR" ]; then
+    echo "ERROR: Option --mutex-state-dir is required with --mutex-url."
+    exit 1
+fi
 
 # Trim the trailing '/' from the S3 channel URL if necessary
 S3_CHANNEL=${S3_CHANNEL%/}
@@ -39,6 +47,38 @@ else
     exit 1
 fi
 
+SCRIPT_DIR="$(dirname "${BASH_SOURCE[0]}")"
+
+# Stops the reindex before it writes the index if the session lost the mutex,
+# for example because its heartbeat could not renew the lease.
+function check_mutex {
+    if [ -n "$MUTEX_URL" ]; then
+        python "$SCRIPT_DIR/s3-object-mutex.py" check "$MUTEX_URL" --state-dir "$MUTEX_STATE_DIR"
+    fi
+}
+
+# Another session may have reindexed the channel while this one waited for the mutex. Only
+# the subdirs whose index is missing packages, or lists removed ones, need a reindex, and
+# this picks up the packages of every build that finished since the last reindex.
+PENDING_SUBDIRS=$(python "$SCRIPT_DIR/conda-channel-pending.py" "$S3_CHANNEL")
+if [ -z "$PENDING_SUBDIRS" ]; then
+    echo "The channel index already includes all the packages, skipping the reindex."
+    exit 0
+fi
+echo "Reindexing the channel subdirs:" $PENDING_SUBDIRS
+
+# The incremental update only reads the packages that changed. If it fails, for example
+# on a package it can't read, fall back to a full reindex of the pending subdirs.
+check_mutex
+if python "$SCRIPT_DIR/update-conda-index.py" \
+        "$S3_CHANNEL" \
+        $PENDING_SUBDIRS \
+        --channel-name "$CONDA_CHANNEL_NAME"; then
+    echo "Reindexing completed."
+    exit 0
+fi
+echo "The incremental index update failed, falling back to a full reindex..."
+
 CHANNEL_INDEXING_DIR="$REINDEXING_DIR/index-dir"
 CHANNEL_MOUNTPOINT="$REINDEXING_DIR/mountpoint"
 mkdir -p $CHANNEL_INDEXING_DIR
@@ -56,7 +96,7 @@ function unmount_channel {
 trap unmount_channel EXIT
 
 echo "Wiring up an indexing view of the channel packages..."
-for CHANNEL_DIR in linux-32 linux-64 win-64 win-32 osx-64 noarch; do
+for CHANNEL_DIR in $PENDING_SUBDIRS; do
     if [ -d $CHANNEL_MOUNTPOINT/$CHANNEL_DIR ]; then
         mkdir -p $CHANNEL_INDEXING_DIR/$CHANNEL_DIR
         for PACKAGE in $(cd $CHANNEL_MOUNTPOINT/$CHANNEL_DIR; \
@@ -74,11 +114,18 @@ python -m conda_index \
     $CHANNEL_INDEXING_DIR
 
 echo "Synchronizing the updated index to the S3 bucket..."
+# conda_index creates the noarch subdir even when it's not pending, so only sync the pending
+# subdirs to avoid replacing the noarch index with an empty one.
+SYNC_INCLUDES=()
+for CHANNEL_DIR in $PENDING_SUBDIRS; do
+    SYNC_INCLUDES+=(--include "$CHANNEL_DIR/repodata.json" \
+                    --include "$CHANNEL_DIR/repodata.json.zst" \
+                    --include "$CHANNEL_DIR/index.html")
+done
+check_mutex
 aws s3 sync $CHANNEL_INDEXING_DIR \
     $S3_CHANNEL \
     --exclude "*" \
-    --include "*/repodata.json" \
-    --include "*/repodata.json.zst" \
-    --include "*/index.html"
+    "${SYNC_INCLUDES[@]}"
 
 echo "Reindexing completed."
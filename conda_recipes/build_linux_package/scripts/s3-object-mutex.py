@@ -3,19 +3,42 @@ Provides enter/exit actions for an OpenJobDescription environment that
 holds a mutex for a specific S3 object provided as an s3://<bucket-name>/prefix/object
 URL.
 
-The lock on the mutex times out after 15 minutes (900 seconds), so all tasks within
-its scope must complete faster than this. If a session is not stopped in an orderly
-fashion, for example due to the worker host being terminated, this timeout ensures
-that package build jobs will resume without intervention.
+The mutex is a lock object next to the S3 object, created with a conditional write
+(If-None-Match: *) so that exactly one session succeeds. The lock is a lease that
+expires MUTEX_LEASE_SECONDS after it was last written. Waiters don't compare the time
+it was written with their own clock, which may be off. Instead, a waiter considers the
+lease expired once it has seen the same ETag of the lock object for the lease duration,
+timed with its monotonic clock. When entering the mutex, a
+heartbeat process is started that renews the lease with conditional writes (If-Match
+on the ETag of the lock object) until the session exits the mutex, so tasks within
+its scope can take as long as they need. If a session is not stopped in an orderly
+fashion, for example due to the worker host being terminated, the lease expires
+and another session takes over the lock with a conditional write, so package build
+jobs will resume without intervention.
+
+Sessions waiting for the mutex poll the lock object with an exponential backoff with
+jitter, starting at MUTEX_MIN_WAIT_SECONDS and capped at MUTEX_MAX_WAIT_SECONDS, so
+that a release is noticed within a couple of seconds. Polling is a GET of the small lock
+object, and a session only tries to write it when it's gone or its lease expired.
 
 To enter the mutex:
-    $ python s3-object-mutex.py enter s3://<bucket-name>/prefix/object
+    $ python s3-object-mutex.py enter s3://<bucket-name>/prefix/object --state-dir <session-dir>
 
 To exit the mutex:
-    $ python s3-object-mutex.py exit s3://<bucket-name>/prefix/object
+    $ python s3-object-mutex.py exit s3://<bucket-name>/prefix/object --state-dir <session-dir>
+
+The state directory holds a file with the lease details for the exit action. Use a
+directory that is deleted when the session ends, like the session working directory,
+because the heartbeat also stops when the file is gone.
+
+If the heartbeat loses the lock, for example because the host was cut off from S3 for
+longer than the lease, it records that in the state file, and the exit action fails. The
+work that the mutex protects can stop before it writes anything by checking that the
+session still holds the lock, which exits with an error if it doesn't:
+    $ python s3-object-mutex.py check s3://<bucket-name>/prefix/object --state-dir <session-dir>
 
 Required permissions on the S3 bucket prefix:
-* s3:ListBucket
+* s3:ListBucket (so that a missing lock object is a 404 instead of a 403)
 * s3:PutObject
 * s3:GetObject
 * s3:DeleteObject
@@ -23,10 +46,16 @@ Required permissions on the S3 bucket prefix:
 
 import argparse
 import datetime
+import hashlib
 import json
 import os
+import random
+import signal
+import subprocess
 import sys
 import time
+import uuid
+from pathlib import Path
 from pprint import pprint
 from urllib.parse import urlparse
 
@@ -34,13 +63,34 @@ import boto3
 from botocore.exceptions import ClientError
 
 MUTEX_OBJECT_SUFFIX = ".s3-object-mutex-lock.json"
-MUTEX_TIMEOUT_SECONDS = 900
-MUTEX_ACQUISITION_TIMEOUT_SECONDS = 120
-MUTEX_WAIT_POLLING_SECONDS = 20
+MUTEX_LEASE_SECONDS = 120
+# Lock objects written by the earlier version of this script have no lease in them
+MUTEX_LEGACY_TIMEOUT_SECONDS = 900
+# The heartbeat stops renewing the lease after this long, in case the session ends without
+# running the exit action or deleting the state directory.
+MUTEX_MAX_HOLD_SECONDS = 12 * 3600
+MUTEX_MIN_WAIT_SECONDS = 0.25
+MUTEX_MAX_WAIT_SECONDS = 2
+# How long the exit action waits for the heartbeat process to stop
+HEARTBEAT_STOP_TIMEOUT_SECONDS = 10
+# Responses to a conditional write when another session changed the lock object first
+CONDITIONAL_WRITE_CONFLICT_CODES = {"PreconditionFailed", "ConditionalRequestConflict", "NoSuchKey"}
 
 parser = argparse.ArgumentParser()
-parser.add_argument("action", type=str, choices=["enter", "exit"])
+parser.add_argument("action", type=str, choices=["enter", "exit", "check", "heartbeat"])
 parser.add_argument("s3_object_url", type=str)
+parser.add_argument(
+    "--state-dir",
+    type=Path,
+    default=Path.cwd(),
+    help="The directory for the lease state file, usually the session working directory.",
+)
+parser.add_argument(
+    "--lease-seconds",
+    type=int,
+    default=MUTEX_LEASE_SECONDS,
+    help="How long the lock lasts without renewal.",
+)
 args = parser.parse_args()
 
 # Split the S3 URL into bucket and prefix
@@ -51,6 +101,9 @@ if url.scheme != "s3":
 s3_bucket_name = url.netloc
 s3_prefix = url.path.lstrip("/")
 s3_lock_object = s3_prefix + MUTEX_OBJECT_SUFFIX
+state_file = args.state_dir / (
+    "s3-object-mutex-" + hashlib.sha256(args.s3_object_url.encode("utf8")).hexdigest()[:16] + ".json"
+)
 
 s3_client = boto3.client("s3")
 
@@ -66,14 +119,26 @@ def _get_data_for_lock():
     }
 
 
-def _mutex_get_lock_data(mutex_timeout_seconds=MUTEX_TIMEOUT_SECONDS):
-    """
-    If the mutex is locked, this function returns (lock_data, time_until_expiry),
-    otherwise returns (None, None).
+def _is_conflict(exc):
+    return exc.response.get("Error", {}).get("Code") in CONDITIONAL_WRITE_CONFLICT_CODES
+
+
+def _now():
+    # Only for the information in the lock object, the lease expiry doesn't depend on the clock
+    return datetime.datetime.now(tz=datetime.timezone.utc)
+
 
-    The mutex is locked if:
-        1. The object key + MUTEX_OBJECT_SUFFIX exists.
-        2. The last-modified date of the object is newer than MUTEX_TIMEOUT_MINUTES ago.
+def _put_lock(lock_data, **condition):
+    """Writes the lock object with the condition, and returns its ETag."""
+    body = json.dumps(lock_data).encode("utf8")
+    response = s3_client.put_object(Bucket=s3_bucket_name, Key=s3_lock_object, Body=body, **condition)
+    return response["ETag"]
+
+
+def _mutex_get_lock():
+    """
+    If the lock object exists, returns (etag, lock_data), otherwise returns None. The lock_data
+    is None if the object does not contain valid JSON.
     """
     try:
         response = s3_client.get_object(Bucket=s3_bucket_name, Key=s3_lock_object)
@@ -81,130 +146,271 @@ def _mutex_get_lock_data(mutex_timeout_seconds=MUTEX_TIMEOUT_SECONDS):
         error_code = int(exc.response["ResponseMetadata"]["HTTPStatusCode"])
         if error_code != 404:
             raise
-        # It's not locked if the lock object is missing
-        return (None, None)
-
-    time_until_expiry = response["LastModified"] + datetime.timedelta(seconds=mutex_timeout_seconds) - datetime.datetime.now(tz=datetime.timezone.utc)
-    if time_until_expiry <= datetime.timedelta(seconds=0):
-        # If the object hasn't been refreshed within the timeout, it's not locked. This
-        # way the mutex can recover from hosts disappearing such as via spot instance interruptions.
-        return (None, None)
+        return None
 
     try:
-        return (json.loads(response["Body"].read()), time_until_expiry)
+        lock_data = json.loads(response["Body"].read())
     except json.JSONDecodeError:
-        # If the object does not contain valid JSON, it's not locked.
-        return (None, None)
+        lock_data = None
+    return (response["ETag"], lock_data)
 
 
-def _mutex_wait_while_locked():
+class _LeaseObserver:
     """
-    Wait while the mutex is locked.
+    Tracks when this process first saw each version of the lock object, to tell when its lease
+    expired without comparing the S3 server's clock with the local one.
     """
-    lock_data, time_until_expiry = _mutex_get_lock_data()
-    while lock_data is not None:
-        print(f"Waiting, the lock for mutex s3://{s3_bucket_name}/{s3_lock_object} expires in {time_until_expiry}, info:")
-        pprint(lock_data)
-        time.sleep(MUTEX_WAIT_POLLING_SECONDS)
-        lock_data, time_until_expiry = _mutex_get_lock_data()
-    return
+
+    def __init__(self):
+        self._etag = None
+        self._first_seen_time = None
+
+    def time_until_expiry(self, lock_etag, lock_data):
+        """Returns the seconds until the lease of the lock expires, if it's not renewed first."""
+        if lock_data is None:
+            # The object isn't a lock this script wrote, so take it over
+            return 0.0
+        now = time.monotonic()
+        if lock_etag != self._etag:
+            # The lock was renewed or taken by another session, so its lease starts over
+            self._etag = lock_etag
+            self._first_seen_time = now
+        lease_seconds = lock_data.get("leaseSeconds", MUTEX_LEGACY_TIMEOUT_SECONDS)
+        return lease_seconds - (now - self._first_seen_time)
+
+
+def _write_state(state):
+    # Write to a temporary file and rename it, so readers never see a partial file
+    temporary_file = state_file.with_suffix(f".{os.getpid()}.tmp")
+    temporary_file.write_text(json.dumps(state), encoding="utf8")
+    os.replace(temporary_file, state_file)
+
+
+def _read_state():
+    try:
+        return json.loads(state_file.read_text(encoding="utf8"))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
 
 
 def enter():
     """
-    Lock the mutex, waiting as necessary.
+    Lock the mutex, waiting as necessary, and start the heartbeat that renews the lease.
     """
-    # Write the lock acquisition object to get in line for the mutex
-    s3_lock_acquisition_object = f"{s3_lock_object}.{os.environ['DEADLINE_SESSION_ID']}"
-    print(f"Creating object s3://{s3_bucket_name}/{s3_lock_acquisition_object}")
-    s3_client.put_object(
-        Bucket=s3_bucket_name, Key=s3_lock_acquisition_object, Body=b""
-    )
-
-    paginator = s3_client.get_paginator("list_objects_v2")
+    lock_data = _get_data_for_lock()
+    lock_data["token"] = uuid.uuid4().hex
+    lock_data["leaseSeconds"] = args.lease_seconds
+    lock_data["acquiredAt"] = _now().isoformat()
+
+    start_time = time.monotonic()
+    wait_seconds = MUTEX_MIN_WAIT_SECONDS
+    previous_holder = None
+    lease_observer = _LeaseObserver()
+    lock = None
     while True:
-        # Wait until the mutex is available
-        _mutex_wait_while_locked()
-
-        # Get all the lock acquisition objects
-        all_s3_objects = []
-        for page in paginator.paginate(
-            Bucket=s3_bucket_name, Prefix=f"{s3_lock_object}."
-        ):
-            all_s3_objects.extend(page.get("Contents", []))
-
-        # Check our object for expiry or deletion
-        our_expiry = datetime.datetime.now(
-            tz=datetime.timezone.utc
-        ) - datetime.timedelta(
-            seconds=MUTEX_ACQUISITION_TIMEOUT_SECONDS - MUTEX_WAIT_POLLING_SECONDS
-        )
-        our_s3_object = [
-            obj for obj in all_s3_objects if obj["Key"] == s3_lock_acquisition_object
-        ]
-        if len(our_s3_object) == 0 or our_s3_object[0]["LastModified"] < our_expiry:
-            # Re-write the lock acquisition object, and restart the loop
-            if len(our_s3_object) == 0:
-                print("The lock acquisition object was deleted.")
+        if lock is None:
+            try:
+                etag = _put_lock(lock_data, IfNoneMatch="*")
+                break
+            except ClientError as exc:
+                if not _is_conflict(exc):
+                    raise
+        else:
+            lock_etag, holder_data = lock
+            time_until_expiry = lease_observer.time_until_expiry(lock_etag, holder_data)
+            if time_until_expiry <= 0:
+                # The holder stopped renewing its lease, for example because its host disappeared,
+                # so take over the lock. The condition ensures that only one waiter succeeds.
+                print(f"The lock for mutex s3://{s3_bucket_name}/{s3_lock_object} expired, taking it over")
+                try:
+                    etag = _put_lock(lock_data, IfMatch=lock_etag)
+                    break
+                except ClientError as exc:
+                    if not _is_conflict(exc):
+                        raise
             else:
-                print("The lock acquisition object expired.")
-            print(
-                f"Re-creating object s3://{s3_bucket_name}/{s3_lock_acquisition_object}"
-            )
-            s3_client.put_object(
-                Bucket=s3_bucket_name, Key=s3_lock_acquisition_object, Body=b""
-            )
+                if holder_data != previous_holder:
+                    print(
+                        f"Waiting, the lock for mutex s3://{s3_bucket_name}/{s3_lock_object} "
+                        f"expires in {time_until_expiry:.0f} seconds unless renewed, info:"
+                    )
+                    pprint(holder_data)
+                    previous_holder = holder_data
+                # Sleep a random time up to the backoff, so that waiters spread out their polling,
+                # but don't sleep past the expiry of the lease.
+                time.sleep(
+                    min(
+                        random.uniform(MUTEX_MIN_WAIT_SECONDS, wait_seconds),
+                        max(time_until_expiry, MUTEX_MIN_WAIT_SECONDS),
+                    )
+                )
+                wait_seconds = min(wait_seconds * 2, MUTEX_MAX_WAIT_SECONDS)
+        # Polling reads the lock object, and only writes when it's gone or expired
+        lock = _mutex_get_lock()
+
+    print(
+        f"Locked mutex s3://{s3_bucket_name}/{s3_lock_object} after waiting "
+        f"{time.monotonic() - start_time:.1f} seconds"
+    )
+    args.state_dir.mkdir(parents=True, exist_ok=True)
+    state = {"lockData": lock_data, "etag": etag}
+    _write_state(state)
+
+    # Start the heartbeat in its own session, so that it outlives this action
+    with open(state_file.with_suffix(".heartbeat.log"), "a") as log_file:
+        heartbeat = subprocess.Popen(
+            [
+                sys.executable,
+                __file__,
+                "heartbeat",
+                args.s3_object_url,
+                "--state-dir",
+                str(args.state_dir),
+                "--lease-seconds",
+                str(args.lease_seconds),
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+    print(f"Started the lease heartbeat, process id {heartbeat.pid}")
+    state["heartbeatPid"] = heartbeat.pid
+    _write_state(state)
+
+
+def _record_lost_lock(state, reason):
+    """Records in the state file that the lock was lost, for the check and exit actions."""
+    print(f"Lost the lock for mutex s3://{s3_bucket_name}/{s3_lock_object}: {reason}")
+    state["lostLock"] = f"{reason} at {_now().isoformat()}"
+    _write_state(state)
+
+
+def heartbeat():
+    """
+    Renew the lease of the lock until stopped, the state file is gone, or the lock is lost.
+    """
+    # Exit cleanly when the exit action stops the heartbeat
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    state = _read_state()
+    if state is None:
+        print("The state file is missing, not renewing the lease")
+        return
+    lock_data = state["lockData"]
+    etag = state["etag"]
+    renew_interval_seconds = args.lease_seconds / 4
+    start_time = last_renewal_time = time.monotonic()
+    while time.monotonic() - start_time < MUTEX_MAX_HOLD_SECONDS:
+        time.sleep(renew_interval_seconds)
+        state = _read_state()
+        if state is None or state["lockData"]["token"] != lock_data["token"]:
+            print("The state file is gone, stopping the heartbeat")
+            return
+        try:
+            lock_data["renewedAt"] = _now().isoformat()
+            etag = _put_lock(lock_data, IfMatch=etag)
+        except ClientError as exc:
+            if _is_conflict(exc):
+                _record_lost_lock(state, "Another session took over the lock")
+                return
+            print(f"Failed to renew the lease, will retry: {exc}")
+            if time.monotonic() - last_renewal_time > args.lease_seconds:
+                _record_lost_lock(state, "The lease expired without renewal")
+                return
             continue
+        last_renewal_time = time.monotonic()
+        state["etag"] = etag
+        _write_state(state)
+    print(f"Held the lock for the maximum of {MUTEX_MAX_HOLD_SECONDS} seconds, stopping the heartbeat")
 
-        # Filter out expired objects
-        expiry = datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(
-            seconds=MUTEX_ACQUISITION_TIMEOUT_SECONDS
-        )
-        s3_objects = [obj for obj in all_s3_objects if obj["LastModified"] > expiry]
-
-        # Sort the objects oldest first, then by key
-        s3_objects.sort(key=lambda obj: (obj["LastModified"], obj["Key"]))
-        if s3_objects[0]["Key"] == s3_lock_acquisition_object:
-            break
-
-        # Print the list of sessions ahead of us
-        our_index = next(i for i, obj in enumerate(s3_objects) if obj["Key"] == s3_lock_acquisition_object)
-        ahead_s3_objects = s3_objects[:our_index]
-        print("These Deadline Cloud job sessions are waiting for the mutex ahead of us:")
-        for obj in ahead_s3_objects:
-            print(f"    {obj['Key'].rsplit('.', 1)[-1]}")
-        time.sleep(MUTEX_WAIT_POLLING_SECONDS)
-
-    # We're at the front of the line, so take the lock
-    lock_data = _get_data_for_lock()
-    body = json.dumps(lock_data).encode("utf8")
-    print(f"Creating object s3://{s3_bucket_name}/{s3_lock_object}")
-    s3_client.put_object(Bucket=s3_bucket_name, Key=s3_lock_object, Body=body)
 
-    # Delete our lock acquisition object and any expired ones
-    delete_s3_objects = [
-        obj
-        for obj in all_s3_objects
-        if obj["LastModified"] <= expiry or obj["Key"] == s3_lock_acquisition_object
-    ]
-    for obj in delete_s3_objects:
-        print(f"Deleting object s3://{s3_bucket_name}/{obj['Key']}")
-        s3_client.delete_object(Bucket=s3_bucket_name, Key=obj["Key"])
+def _is_running(pid):
+    # The heartbeat is not a child of this process, so it can't be waited for. Once it exits,
+    # it can remain a zombie until its new parent reaps it, so check its state in /proc.
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            return f.read().rpartition(b")")[2].split()[0] != b"Z"
+    except FileNotFoundError:
+        return False
+
+
+def _stop_heartbeat(pid):
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    deadline = time.monotonic() + HEARTBEAT_STOP_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        if not _is_running(pid):
+            return
+        time.sleep(0.05)
+    print(f"The heartbeat process {pid} did not stop, killing it")
+    os.kill(pid, signal.SIGKILL)
 
 
 def exit():
     """
-    Unlocks the mutex if it's being held by this session.
+    Stops the heartbeat, and unlocks the mutex if it's being held by this session.
+    """
+    state = _read_state()
+    if state is not None and "heartbeatPid" in state:
+        _stop_heartbeat(state["heartbeatPid"])
+
+    lock = _mutex_get_lock()
+    if lock is None:
+        print(f"The mutex s3://{s3_bucket_name}/{s3_lock_object} is not locked")
+    else:
+        lock_etag, lock_data = lock
+        if state is not None:
+            is_ours = lock_data is not None and lock_data.get("token") == state["lockData"]["token"]
+        else:
+            # Without the state file, compare the session that holds the lock
+            is_ours = lock_data is not None and all(
+                lock_data.get(name) == value for name, value in _get_data_for_lock().items()
+            )
+        if is_ours:
+            print(f"Deleting object s3://{s3_bucket_name}/{s3_lock_object}")
+            try:
+                # The condition avoids deleting the lock of a session that took over an expired lease
+                s3_client.delete_object(Bucket=s3_bucket_name, Key=s3_lock_object, IfMatch=lock_etag)
+            except ClientError as exc:
+                if not _is_conflict(exc):
+                    raise
+                print("Another session took over the lock before it was deleted")
+        else:
+            print("Another session holds the lock, leaving it")
+    state_file.unlink(missing_ok=True)
+    if state is not None and "lostLock" in state:
+        # The work that the mutex protected may have overlapped with another session's
+        print(f"openjd_fail: Lost the lock for mutex s3://{s3_bucket_name}/{s3_lock_object}: {state['lostLock']}")
+        sys.exit(1)
+
+
+def check():
+    """
+    Exits with an error unless this session still holds the mutex, so the protected work can stop
+    before it writes anything.
     """
-    # Get the lock data with a 10 seconds faster timeout. If there's less time than that
-    # remaining just let it time out instead of deleting the object.
-    lock_data, _ = _mutex_get_lock_data(mutex_timeout_seconds=MUTEX_TIMEOUT_SECONDS - 10)
-    if lock_data == _get_data_for_lock():
-        print(f"Deleting object s3://{s3_bucket_name}/{s3_lock_object}")
-        s3_client.delete_object(Bucket=s3_bucket_name, Key=s3_lock_object)
+    state = _read_state()
+    if state is None:
+        print(f"openjd_fail: This session did not lock the mutex s3://{s3_bucket_name}/{s3_lock_object}")
+        sys.exit(1)
+    if "lostLock" in state:
+        print(f"openjd_fail: Lost the lock for mutex s3://{s3_bucket_name}/{s3_lock_object}: {state['lostLock']}")
+        sys.exit(1)
+    lock = _mutex_get_lock()
+    if lock is None or lock[1] is None or lock[1].get("token") != state["lockData"]["token"]:
+        print(f"openjd_fail: Another session holds the lock for mutex s3://{s3_bucket_name}/{s3_lock_object}")
+        sys.exit(1)
+    print(f"This session holds the mutex s3://{s3_bucket_name}/{s3_lock_object}")
 
 
 if args.action == "enter":
     enter()
+elif args.action == "heartbeat":
+    heartbeat()
+elif args.action == "check":
+    check()
 else:
     exit()
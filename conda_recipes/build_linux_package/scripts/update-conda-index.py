@@ -0,0 +1,313 @@
+"""
+Updates the index of subdirs in an S3 conda channel incrementally, reading only the
+packages that were added since the last update.
+
+For each subdir, it downloads the existing repodata.json, lists the .conda packages, and
+compares them. New packages are read with ranged GETs of just the zip central directory
+and the info-*.tar.zst member, instead of the whole package, and removed packages are
+dropped from the index. The package checksums come from the sha256 and md5 metadata
+that build-package.sh sets when uploading. Packages without that metadata are read in
+full to compute them. It then writes index.html, repodata.json.zst and repodata.json,
+in that order, so the time it takes depends on the new packages instead of the size of
+the channel.
+
+The repodata.json entries are the same as conda_index produces: the package's
+info/index.json without a few build-time fields, plus its md5, sha256 and size.
+
+Usage:
+    $ python update-conda-index.py s3://<bucket-name>/channel/prefix linux-64 noarch --channel-name <name>
+
+Required permissions on the S3 bucket prefix:
+* s3:ListBucket
+* s3:GetObject
+* s3:PutObject
+"""
+
+import argparse
+import datetime
+import hashlib
+import html
+import io
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from conda_package_streaming.package_streaming import stream_conda_info
+
+try:
+    import compression.zstd as zstd  # Python 3.14+
+except ImportError:
+    try:
+        import backports.zstd as zstd
+    except ImportError:
+        zstd = None
+        import zstandard
+
+# The same fields that conda_index filters out of info/index.json
+INDEX_JSON_FILTER_FIELDS = {
+    "arch",
+    "has_prefix",
+    "mtime",
+    "platform",
+    "ucs",
+    "requires_features",
+    "binstar",
+    "target-triplet",
+    "machine",
+    "operatingsystem",
+}
+# The same compression level as conda_index
+ZSTD_COMPRESS_LEVEL = 16
+# The zip central directory of a .conda package is at the end and lists only a few
+# members, so one ranged GET of this size gets it.
+TAIL_READ_SIZE = 64 * 1024
+# Read at least this much per ranged GET, so reading a member takes few requests
+MIN_READ_SIZE = 1024 * 1024
+CHECKSUM_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_WORKERS = 16
+
+parser = argparse.ArgumentParser()
+parser.add_argument("s3_conda_channel", type=str)
+parser.add_argument("subdirs", type=str, nargs="+")
+parser.add_argument("--channel-name", type=str, required=True)
+args = parser.parse_args()
+
+url = urlparse(args.s3_conda_channel, allow_fragments=False)
+if url.scheme != "s3":
+    print(f"ERROR: The S3 conda channel {args.s3_conda_channel} is not an s3:// URL")
+    sys.exit(1)
+s3_bucket_name = url.netloc
+s3_prefix = url.path.strip("/")
+
+s3_client = boto3.client("s3", config=Config(max_pool_connections=MAX_WORKERS))
+paginator = s3_client.get_paginator("list_objects_v2")
+
+
+class S3ObjectReader(io.RawIOBase):
+    """
+    A read-only, seekable file object for an S3 object that reads it with ranged GETs. The
+    first read fetches the tail of the object along with its size and metadata, and each
+    later read fetches at least MIN_READ_SIZE bytes.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self._position = 0
+        response = s3_client.get_object(Bucket=s3_bucket_name, Key=key, Range=f"bytes=-{TAIL_READ_SIZE}")
+        self.size = int(response["ContentRange"].rsplit("/", 1)[1])
+        self.etag = response["ETag"]
+        self.metadata = response["Metadata"]
+        self._block_start = self.size - response["ContentLength"]
+        self._block = response["Body"].read()
+        self.request_count = 1
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        else:
+            self._position = self.size + offset
+        return self._position
+
+    def readinto(self, buffer):
+        if self._position >= self.size:
+            return 0
+        block_end = self._block_start + len(self._block)
+        if not (self._block_start <= self._position < block_end):
+            end = min(self._position + max(len(buffer), MIN_READ_SIZE), self.size)
+            response = s3_client.get_object(
+                Bucket=s3_bucket_name,
+                Key=self.key,
+                Range=f"bytes={self._position}-{end - 1}",
+                IfMatch=self.etag,
+            )
+            self._block_start = self._position
+            self._block = response["Body"].read()
+            self.request_count += 1
+            block_end = self._block_start + len(self._block)
+        count = min(len(buffer), block_end - self._position)
+        offset = self._position - self._block_start
+        buffer[:count] = self._block[offset : offset + count]
+        self._position += count
+        return count
+
+
+def read_package_record(subdir, filename):
+    """Returns the repodata.json record of the package, and the number of GET requests it took."""
+    reader = S3ObjectReader(f"{s3_prefix}/{subdir}/{filename}")
+    raw_index_json = None
+    for tar, member in stream_conda_info(filename, reader):
+        if member.name == "info/index.json":
+            raw_index_json = json.loads(tar.extractfile(member).read())
+            break
+    if raw_index_json is None:
+        raise RuntimeError(f"The package {subdir}/{filename} has no info/index.json")
+
+    md5 = reader.metadata.get("md5")
+    sha256 = reader.metadata.get("sha256")
+    request_count = reader.request_count
+    if not (md5 and sha256):
+        print(f"Package {subdir}/{filename} has no checksum metadata, reading it to compute the checksums")
+        response = s3_client.get_object(Bucket=s3_bucket_name, Key=reader.key, IfMatch=reader.etag)
+        md5_hash = hashlib.md5()
+        sha256_hash = hashlib.sha256()
+        for chunk in response["Body"].iter_chunks(CHECKSUM_CHUNK_SIZE):
+            md5_hash.update(chunk)
+            sha256_hash.update(chunk)
+        md5 = md5_hash.hexdigest()
+        sha256 = sha256_hash.hexdigest()
+        request_count += 1
+
+    record = {k: v for k, v in raw_index_json.items() if k not in INDEX_JSON_FILTER_FIELDS}
+    record.update(md5=md5, sha256=sha256, size=reader.size)
+    return record, request_count
+
+
+def get_repodata(subdir):
+    try:
+        response = s3_client.get_object(Bucket=s3_bucket_name, Key=f"{s3_prefix}/{subdir}/repodata.json")
+    except ClientError as exc:
+        if int(exc.response["ResponseMetadata"]["HTTPStatusCode"]) != 404:
+            raise
+        return {
+            "info": {"subdir": subdir},
+            "packages": {},
+            "packages.conda": {},
+            "removed": [],
+            "repodata_version": 1,
+        }
+    return json.loads(response["Body"].read())
+
+
+def list_packages(subdir):
+    """Returns {filename: size} for the .conda packages in the subdir."""
+    packages = {}
+    for page in paginator.paginate(Bucket=s3_bucket_name, Prefix=f"{s3_prefix}/{subdir}/", Delimiter="/"):
+        for obj in page.get("Contents", []):
+            filename = obj["Key"].rsplit("/", 1)[-1]
+            if filename.endswith(".conda"):
+                packages[filename] = obj["Size"]
+    return packages
+
+
+def _human_bytes(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def _format_timestamp(timestamp):
+    if not timestamp:
+        return ""
+    # conda package timestamps are in milliseconds
+    if timestamp > 253402300799:
+        timestamp /= 1000
+    return datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S %z")
+
+
+def make_index_html(subdir, repodata):
+    """Returns an index.html that lists the packages with the same columns as conda_index."""
+    title = html.escape(f"{args.channel_name}/{subdir}")
+    packages = {**repodata.get("packages", {}), **repodata.get("packages.conda", {})}
+    rows = [
+        f'    <tr><td><a href="{html.escape(filename)}">{html.escape(filename)}</a></td>'
+        f'<td class="s">{_human_bytes(record.get("size", 0))}</td>'
+        f"<td>{_format_timestamp(record.get('timestamp'))}</td>"
+        f"<td>{record.get('sha256', '')}</td><td>{record.get('md5', '')}</td></tr>"
+        for filename, record in sorted(packages.items())
+    ]
+    now = datetime.datetime.now(tz=datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S %z")
+    return "\n".join(
+        [
+            "<html>",
+            "<head>",
+            f"  <title>{title}</title>",
+            '  <style type="text/css">',
+            "    body { background-color: #F5F5F5; }",
+            "    th, td { font: 100% monospace; text-align: left; padding-right: 20px; }",
+            "    td.s, th.s { text-align: right; }",
+            "    table { background-color: white; border-top: 1px solid #646464; border-bottom: 1px solid #646464; }",
+            "  </style>",
+            "</head>",
+            "<body>",
+            f"  <h2>{title}</h2>",
+            "  <table>",
+            "    <tr><th>Filename</th><th>Size</th><th>Last Modified</th><th>SHA256</th><th>MD5</th></tr>",
+            *rows,
+            "  </table>",
+            f"  <address>Updated: {now} - Files: {len(packages)}</address>",
+            "</body>",
+            "</html>",
+            "",
+        ]
+    )
+
+
+def zstd_compress(data):
+    if zstd is not None:
+        return zstd.compress(data, level=ZSTD_COMPRESS_LEVEL)
+    return zstandard.ZstdCompressor(level=ZSTD_COMPRESS_LEVEL).compress(data)
+
+
+def update_subdir(subdir, executor):
+    repodata = get_repodata(subdir)
+    indexed_packages = repodata.setdefault("packages.conda", {})
+    packages = list_packages(subdir)
+
+    removed_packages = sorted(set(indexed_packages) - set(packages))
+    # A package that was uploaded again with the same filename has a different size
+    new_packages = sorted(
+        filename
+        for filename, size in packages.items()
+        if filename not in indexed_packages or indexed_packages[filename].get("size") != size
+    )
+    print(
+        f"Subdir {subdir}: {len(packages)} packages, {len(new_packages)} to add and {len(removed_packages)} to remove"
+    )
+    if not new_packages and not removed_packages:
+        return
+
+    for filename in removed_packages:
+        print(f"  Removing {filename}")
+        del indexed_packages[filename]
+    request_count = 0
+    for filename, (record, record_request_count) in zip(
+        new_packages, executor.map(lambda filename: read_package_record(subdir, filename), new_packages)
+    ):
+        print(f"  Adding {filename}")
+        indexed_packages[filename] = record
+        request_count += record_request_count
+    if new_packages:
+        print(f"  Read the metadata of {len(new_packages)} packages with {request_count} GET requests")
+
+    repodata_json = json.dumps(repodata, indent=2, sort_keys=True).encode("utf-8")
+    # Write repodata.json last, because it's what determines whether the subdir has pending packages
+    for filename, body, content_type in [
+        ("index.html", make_index_html(subdir, repodata).encode("utf-8"), "text/html"),
+        ("repodata.json.zst", zstd_compress(repodata_json), "application/zstd"),
+        ("repodata.json", repodata_json, "application/json"),
+    ]:
+        s3_client.put_object(
+            Bucket=s3_bucket_name, Key=f"{s3_prefix}/{subdir}/{filename}", Body=body, ContentType=content_type
+        )
+    print(f"  Saved the index of {len(indexed_packages)} packages")
+
+
+with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    for subdir in args.subdirs:
+        update_subdir(subdir, executor)
@@ -0,0 +1,112 @@
+"""
+Uploads the .conda packages from conda-bld subdirs to an S3 conda channel.
+
+All the packages of all the subdirs upload concurrently, each as a multipart upload with
+concurrent parts. Every package is uploaded with its sha256 and md5 checksums as object
+metadata, which the incremental reindex uses. A package whose sha256 matches the one
+already in the channel is skipped.
+
+Usage:
+    $ python upload-conda-packages.py s3://<bucket-name>/channel/prefix <conda-bld-dir> linux-64 noarch
+
+Required permissions on the S3 bucket prefix:
+* s3:GetObject
+* s3:PutObject
+"""
+
+import argparse
+import hashlib
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlparse
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+MIB = 1024 * 1024
+# Large DCC packages are many GB, so use large parts, and upload several at once
+MULTIPART_CHUNK_SIZE = 64 * MIB
+MAX_CONCURRENT_PARTS = 16
+MAX_CONCURRENT_PACKAGES = 4
+CHECKSUM_CHUNK_SIZE = 8 * MIB
+
+parser = argparse.ArgumentParser()
+parser.add_argument("s3_conda_channel", type=str)
+parser.add_argument("conda_bld_dir", type=Path)
+parser.add_argument("subdirs", type=str, nargs="+")
+args = parser.parse_args()
+
+url = urlparse(args.s3_conda_channel, allow_fragments=False)
+if url.scheme != "s3":
+    print(f"ERROR: The S3 conda channel {args.s3_conda_channel} is not an s3:// URL")
+    sys.exit(1)
+s3_bucket_name = url.netloc
+s3_prefix = url.path.strip("/")
+
+s3_client = boto3.client(
+    "s3", config=Config(max_pool_connections=MAX_CONCURRENT_PACKAGES * (MAX_CONCURRENT_PARTS + 1))
+)
+transfer_config = TransferConfig(
+    multipart_threshold=MULTIPART_CHUNK_SIZE,
+    multipart_chunksize=MULTIPART_CHUNK_SIZE,
+    max_concurrency=MAX_CONCURRENT_PARTS,
+)
+
+
+def checksums(path):
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHECKSUM_CHUNK_SIZE):
+            md5.update(chunk)
+            sha256.update(chunk)
+    return md5.hexdigest(), sha256.hexdigest()
+
+
+def upload_package(subdir, path):
+    """Uploads the package if the channel doesn't have it already, and returns the bytes uploaded."""
+    key = f"{s3_prefix}/{subdir}/{path.name}"
+    md5, sha256 = checksums(path)
+    try:
+        response = s3_client.head_object(Bucket=s3_bucket_name, Key=key)
+        if response["Metadata"].get("sha256") == sha256:
+            print(f"Skipping {subdir}/{path.name}, the channel already has it")
+            return 0
+    except ClientError as exc:
+        if int(exc.response["ResponseMetadata"]["HTTPStatusCode"]) != 404:
+            raise
+
+    size = path.stat().st_size
+    print(f"Uploading {subdir}/{path.name} ({size / MIB:.1f} MiB)")
+    s3_client.upload_file(
+        str(path),
+        s3_bucket_name,
+        key,
+        ExtraArgs={"Metadata": {"sha256": sha256, "md5": md5}},
+        Config=transfer_config,
+    )
+    return size
+
+
+packages = [
+    (subdir, path)
+    # The platform can be noarch, so skip repeated subdirs
+    for subdir in dict.fromkeys(args.subdirs)
+    for path in sorted((args.conda_bld_dir / subdir).glob("*.conda"))
+]
+if not packages:
+    print("There are no packages to upload")
+    sys.exit(0)
+
+start_time = time.monotonic()
+with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_PACKAGES) as executor:
+    uploaded_bytes = sum(executor.map(lambda package: upload_package(*package), packages))
+duration = time.monotonic() - start_time
+print(
+    f"Uploaded {uploaded_bytes / MIB:.1f} MiB of {len(packages)} packages in {duration:.1f} seconds "
+    f"({uploaded_bytes / MIB / max(duration, 1e-9):.1f} MiB/s)"
+)
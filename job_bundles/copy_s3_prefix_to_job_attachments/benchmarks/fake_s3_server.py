@@ -0,0 +1,720 @@
+"""
+A local stand-in for Amazon S3 and the AWS Deadline Cloud GetQueue API, for benchmarking.
+
+It implements the subset of the S3 REST API that the copy job scripts use, with path-style
+addressing, and keeps everything in memory. Objects created from a synthetic prefix don't
+store their data. Their bytes are generated on demand from a content seed, so a prefix with
+terabytes of data takes almost no memory. Copies and ranges refer to the data of the source
+object instead of copying it.
+
+To make it behave more like S3 under load, it can add latency to every request, and respond
+with 503 SlowDown to a fraction of the requests or to requests beyond a rate limit.
+
+Point the AWS SDK at it by setting these environment variables:
+
+    AWS_ENDPOINT_URL=http://127.0.0.1:<port>
+    AWS_DISABLE_HOST_PREFIX_INJECTION=true
+
+Besides the AWS APIs, it has a small admin API under /_benchmark/:
+
+    POST /_benchmark/reset   Deletes all buckets, then creates the buckets and synthetic prefix in the JSON body
+    GET  /_benchmark/stats   Returns the number of requests by operation, throttles and bytes transferred
+"""
+
+import argparse
+import bisect
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, quote_plus, unquote, urlparse
+from xml.etree import ElementTree
+
+sys.path.insert(0, str(Path(__file__).parent))
+import synthetic_prefix  # noqa: E402
+
+S3_NAMESPACE = "http://s3.amazonaws.com/doc/2006-03-01/"
+DEADLINE_API_PREFIX = "/2023-10-12/"
+LIST_MAX_KEYS = 1000
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# The data of synthetic objects repeats a random block, starting at an offset that depends
+# on the content seed. The block length is prime, so different seeds give different offsets.
+_BLOCK_LENGTH = 1048573
+_DOUBLE_BLOCK = random.Random(0).randbytes(_BLOCK_LENGTH) * 2
+
+
+class Segment:
+    """A run of bytes in an object's data, either stored or generated from a content seed."""
+
+    __slots__ = ("data", "seed", "offset", "length")
+
+    def __init__(self, length, data=None, seed=None, offset=0):
+        self.length = length
+        self.data = data
+        self.seed = seed
+        self.offset = offset
+
+    def slice(self, start, end):
+        if self.data is not None:
+            return Segment(end - start, data=self.data[start:end])
+        return Segment(end - start, seed=self.seed, offset=self.offset + start)
+
+    def chunks(self):
+        if self.data is not None:
+            for i in range(0, self.length, STREAM_CHUNK_SIZE):
+                yield self.data[i : i + STREAM_CHUNK_SIZE]
+            return
+        position = (self.offset + self.seed * 7919) % _BLOCK_LENGTH
+        remaining = self.length
+        while remaining > 0:
+            n = min(remaining, STREAM_CHUNK_SIZE)
+            yield _DOUBLE_BLOCK[position : position + n]
+            position = (position + n) % _BLOCK_LENGTH
+            remaining -= n
+
+
+def slice_segments(segments, start, end):
+    """Returns the segments covering bytes [start, end) of the data made of the segments."""
+    result = []
+    position = 0
+    for segment in segments:
+        segment_end = position + segment.length
+        if segment_end > start and position < end:
+            result.append(
+                segment.slice(max(start, position) - position, min(end, segment_end) - position)
+            )
+        position = segment_end
+    return result
+
+
+class S3Object:
+    __slots__ = ("segments", "size", "etag", "metadata", "tags", "last_modified")
+
+    def __init__(self, segments, etag=None, metadata=None):
+        self.segments = segments
+        self.size = sum(segment.length for segment in segments)
+        if etag is None:
+            # Hashing the data of huge synthetic objects would be slow, so the etag of an
+            # object made of only synthetic segments comes from its description instead.
+            etag_hash = hashlib.md5()
+            for segment in segments:
+                if segment.data is not None:
+                    etag_hash.update(segment.data)
+                else:
+                    etag_hash.update(f"{segment.seed}:{segment.offset}:{segment.length};".encode())
+            etag = f'"{etag_hash.hexdigest()}"'
+        self.etag = etag
+        self.metadata = metadata or {}
+        self.tags = []
+        self.last_modified = time.time()
+
+
+class Bucket:
+    def __init__(self):
+        self.objects = {}
+        # The keys in S3 listing order, which is UTF-8 byte order, the same as code point order
+        self.sorted_keys = []
+        self.uploads = {}
+
+    def put(self, key, s3_object):
+        if key not in self.objects:
+            bisect.insort(self.sorted_keys, key)
+        self.objects[key] = s3_object
+
+    def delete(self, key):
+        if self.objects.pop(key, None) is not None:
+            del self.sorted_keys[bisect.bisect_left(self.sorted_keys, key)]
+
+
+class S3Error(Exception):
+    def __init__(self, status, code, message=""):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+class FakeS3State:
+    """The buckets, request statistics, and fault injection settings shared by all request threads."""
+
+    def __init__(self, latency_seconds, latency_jitter_seconds, throttle_rate, max_requests_per_second):
+        self.latency_seconds = latency_seconds
+        self.latency_jitter_seconds = latency_jitter_seconds
+        self.throttle_rate = throttle_rate
+        self.max_requests_per_second = max_requests_per_second
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.job_attachments = {"s3BucketName": "job-attachments", "rootPrefix": "DeadlineCloud"}
+        self.request_counts = Counter()
+        self.throttle_counts = Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._tokens = float(max_requests_per_second or 0)
+        self._tokens_time = time.monotonic()
+
+    def should_throttle(self):
+        with self.lock:
+            if self.throttle_rate and random.random() < self.throttle_rate:
+                return True
+            if self.max_requests_per_second:
+                # A token bucket that refills at the rate limit, and holds up to one second of requests
+                now = time.monotonic()
+                self._tokens = min(
+                    self.max_requests_per_second,
+                    self._tokens + (now - self._tokens_time) * self.max_requests_per_second,
+                )
+                self._tokens_time = now
+                if self._tokens < 1:
+                    return True
+                self._tokens -= 1
+            return False
+
+    def reset(self, config):
+        with self.lock:
+            self.buckets = {name: Bucket() for name in config.get("buckets", [])}
+            self.job_attachments = config.get("job_attachments", self.job_attachments)
+            if synthetic := config.get("synthetic"):
+                bucket = self.buckets.setdefault(synthetic["bucket"], Bucket())
+                for key, size, content_seed in synthetic_prefix.generate(
+                    synthetic["prefix"],
+                    synthetic["profile"],
+                    synthetic["object_count"],
+                    seed=synthetic.get("seed", 0),
+                    max_size=synthetic.get("max_size", 16 * synthetic_prefix.GIB),
+                ):
+                    bucket.objects[key] = S3Object([Segment(size, seed=content_seed)])
+                bucket.sorted_keys = sorted(bucket.objects)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": dict(self.request_counts),
+                "throttled": dict(self.throttle_counts),
+                "bytes_sent": self.bytes_sent,
+                "bytes_received": self.bytes_received,
+            }
+
+
+def _xml(root_name, children):
+    """Returns an S3 XML document from a nested list of (name, value) pairs."""
+
+    def build(parent, items):
+        for name, value in items:
+            element = ElementTree.SubElement(parent, name)
+            if isinstance(value, list):
+                build(element, value)
+            else:
+                element.text = str(value)
+
+    # Like S3, error documents have no namespace, and botocore does not find their code otherwise
+    root = ElementTree.Element(root_name) if root_name == "Error" else ElementTree.Element(root_name, xmlns=S3_NAMESPACE)
+    build(root, children)
+    return b'<?xml version="1.0" encoding="UTF-8"?>' + ElementTree.tostring(root)
+
+
+def _http_date(timestamp):
+    return formatdate(timestamp, usegmt=True)
+
+
+def _iso_date(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def _strip_namespace(element):
+    for e in element.iter():
+        e.tag = e.tag.rsplit("}", 1)[-1]
+    return element
+
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # The headers and body are separate writes, which would wait on delayed ACKs with Nagle's algorithm
+    disable_nagle_algorithm = True
+    state: FakeS3State
+
+    def log_message(self, format, *args):
+        pass
+
+    # Request handling
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    # Skip the trailers
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                body += self.rfile.read(size)
+                self.rfile.readline()
+            body = bytes(body)
+        else:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if "aws-chunked" in self.headers.get("Content-Encoding", ""):
+            body = self._decode_aws_chunked(body)
+        with self.state.lock:
+            self.state.bytes_received += len(body)
+        return body
+
+    @staticmethod
+    def _decode_aws_chunked(body):
+        decoded = bytearray()
+        position = 0
+        while True:
+            line_end = body.index(b"\r\n", position)
+            size = int(body[position:line_end].split(b";")[0], 16)
+            if size == 0:
+                return bytes(decoded)
+            decoded += body[line_end + 2 : line_end + 2 + size]
+            position = line_end + 2 + size + 2
+
+    def _send(self, status, body=b"", headers=None, content_type="application/xml"):
+        self.send_response(status)
+        if body:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("x-amz-request-id", uuid.uuid4().hex)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if body and self.command != "HEAD":
+            self.wfile.write(body)
+            with self.state.lock:
+                self.state.bytes_sent += len(body)
+
+    def _send_error(self, error):
+        if self.command == "HEAD":
+            self._send(error.status)
+        else:
+            self._send(error.status, _xml("Error", [("Code", error.code), ("Message", error.message)]))
+
+    def _handle(self):
+        url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query, keep_blank_values=True).items()}
+        body = self._read_body() if self.command in ("PUT", "POST") else b""
+
+        if url.path.startswith("/_benchmark/"):
+            self._handle_admin(url.path, body)
+            return
+
+        if url.path.startswith(DEADLINE_API_PREFIX):
+            operation = "deadline:GetQueue"
+        else:
+            bucket_name, _, key = url.path[1:].partition("/")
+            key = unquote(key)
+            self.bucket_name = bucket_name
+            operation = self._s3_operation(key, query)
+
+        if self.state.latency_seconds or self.state.latency_jitter_seconds:
+            time.sleep(self.state.latency_seconds + random.random() * self.state.latency_jitter_seconds)
+        with self.state.lock:
+            self.state.request_counts[operation] += 1
+        if self.state.should_throttle():
+            with self.state.lock:
+                self.state.throttle_counts[operation] += 1
+            self._send_error(S3Error(503, "SlowDown", "Please reduce your request rate."))
+            return
+
+        try:
+            if operation == "deadline:GetQueue":
+                response = json.dumps({"jobAttachmentSettings": self.state.job_attachments}).encode()
+                self._send(200, response, content_type="application/json")
+                return
+            with self.state.lock:
+                if operation == "s3:CreateBucket":
+                    self.state.buckets.setdefault(bucket_name, Bucket())
+                    self._send(200)
+                    return
+                bucket = self.state.buckets.get(bucket_name)
+            if bucket is None:
+                raise S3Error(404, "NoSuchBucket", "The specified bucket does not exist")
+            getattr(self, "_" + operation.split(":")[1])(bucket, key, query, body)
+        except S3Error as error:
+            self._send_error(error)
+
+    def _s3_operation(self, key, query):
+        method = self.command
+        copy_source = self.headers.get("x-amz-copy-source")
+        if not key:
+            if method == "PUT":
+                return "s3:CreateBucket"
+            return "s3:ListObjectsV2"
+        if "tagging" in query:
+            return "s3:GetObjectTagging" if method == "GET" else "s3:PutObjectTagging"
+        if method == "POST":
+            return "s3:CreateMultipartUpload" if "uploads" in query else "s3:CompleteMultipartUpload"
+        if method == "PUT":
+            if "uploadId" in query:
+                if copy_source:
+                    return "s3:UploadPartCopy"
+                return "s3:UploadPart"
+            if copy_source:
+                return "s3:CopyObject"
+            return "s3:PutObject"
+        if method == "DELETE":
+            return "s3:AbortMultipartUpload" if "uploadId" in query else "s3:DeleteObject"
+        if method == "HEAD":
+            return "s3:HeadObject"
+        return "s3:GetObject"
+
+    def _handle_request(self):
+        try:
+            self._handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = _handle_request
+
+    def _handle_admin(self, path, body):
+        if path == "/_benchmark/reset":
+            self.state.reset(json.loads(body))
+            self._send(200, b"{}", content_type="application/json")
+        elif path == "/_benchmark/stats":
+            self._send(200, json.dumps(self.state.stats()).encode(), content_type="application/json")
+        else:
+            self._send(404)
+
+    # Conditional requests
+
+    def _check_conditions(self, s3_object, if_match, if_none_match):
+        if if_match is not None and (s3_object is None or if_match not in ("*", s3_object.etag)):
+            if s3_object is None:
+                raise S3Error(404, "NoSuchKey", "The specified key does not exist.")
+            raise S3Error(412, "PreconditionFailed", "At least one of the pre-conditions you specified did not hold")
+        if if_none_match is not None and s3_object is not None and if_none_match in ("*", s3_object.etag):
+            raise S3Error(412, "PreconditionFailed", "At least one of the pre-conditions you specified did not hold")
+
+    def _get_object_or_404(self, bucket, key):
+        s3_object = bucket.objects.get(key)
+        if s3_object is None:
+            raise S3Error(404, "NoSuchKey", "The specified key does not exist.")
+        return s3_object
+
+    def _copy_source_segments(self, range_header=None):
+        source = unquote(self.headers["x-amz-copy-source"]).lstrip("/")
+        source_bucket_name, _, source_key = source.partition("/")
+        source_key = source_key.split("?versionId=")[0]
+        with self.state.lock:
+            source_bucket = self.state.buckets.get(source_bucket_name)
+            if source_bucket is None:
+                raise S3Error(404, "NoSuchBucket", "The specified bucket does not exist")
+            source_object = self._get_object_or_404(source_bucket, source_key)
+        self._check_conditions(
+            source_object,
+            self.headers.get("x-amz-copy-source-if-match"),
+            self.headers.get("x-amz-copy-source-if-none-match"),
+        )
+        if range_header:
+            start, end = self._parse_range(range_header, source_object.size)
+            return source_object, slice_segments(source_object.segments, start, end)
+        return source_object, source_object.segments
+
+    @staticmethod
+    def _parse_range(range_header, size):
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+        if not match:
+            raise S3Error(416, "InvalidRange", "The requested range is not satisfiable")
+        start_text, end_text = match.groups()
+        if start_text:
+            start = int(start_text)
+            end = min(size, int(end_text) + 1) if end_text else size
+        else:
+            start, end = max(0, size - int(end_text)), size
+        if start >= size or start >= end:
+            raise S3Error(416, "InvalidRange", "The requested range is not satisfiable")
+        return start, end
+
+    def _metadata_headers(self, s3_object):
+        headers = {
+            "ETag": s3_object.etag,
+            "Last-Modified": _http_date(s3_object.last_modified),
+            "Accept-Ranges": "bytes",
+        }
+        for name, value in s3_object.metadata.items():
+            headers[f"x-amz-meta-{name}"] = value
+        return headers
+
+    def _request_metadata(self):
+        return {
+            name[len("x-amz-meta-") :].lower(): value
+            for name, value in self.headers.items()
+            if name.lower().startswith("x-amz-meta-")
+        }
+
+    # S3 operations
+
+    def _ListObjectsV2(self, bucket, key, query, body):
+        prefix = query.get("prefix", "")
+        delimiter = query.get("delimiter", "")
+        max_keys = min(LIST_MAX_KEYS, int(query.get("max-keys", LIST_MAX_KEYS)))
+        url_encode = query.get("encoding-type") == "url"
+        start_after = query.get("start-after") or ""
+        # The continuation token is "k" and the last key of the previous page, or "p" and its last common prefix
+        continuation_token = query.get("continuation-token")
+        encode = (lambda value: quote_plus(value, safe="/")) if url_encode else (lambda value: value)
+
+        contents = []
+        common_prefixes = []
+        with self.state.lock:
+            sorted_keys = bucket.sorted_keys
+            i = max(bisect.bisect_right(sorted_keys, start_after), bisect.bisect_left(sorted_keys, prefix))
+            if continuation_token:
+                token_type, token_key = continuation_token[0], continuation_token[1:]
+                if token_type == "p":
+                    # Skip the keys under the common prefix that ended the previous page
+                    i = bisect.bisect_left(sorted_keys, token_key[:-1] + chr(ord(token_key[-1]) + 1))
+                else:
+                    i = bisect.bisect_right(sorted_keys, token_key)
+            next_token = None
+            truncated = False
+            while i < len(sorted_keys):
+                object_key = sorted_keys[i]
+                if not object_key.startswith(prefix):
+                    break
+                if len(contents) + len(common_prefixes) >= max_keys:
+                    truncated = True
+                    break
+                if delimiter and delimiter in object_key[len(prefix) :]:
+                    common_prefix = object_key[: object_key.index(delimiter, len(prefix)) + len(delimiter)]
+                    common_prefixes.append(common_prefix)
+                    next_token = "p" + common_prefix
+                    # Skip the rest of the keys under the common prefix
+                    i = bisect.bisect_left(sorted_keys, common_prefix[:-1] + chr(ord(common_prefix[-1]) + 1))
+                    continue
+                s3_object = bucket.objects[object_key]
+                contents.append(
+                    (
+                        "Contents",
+                        [
+                            ("Key", encode(object_key)),
+                            ("LastModified", _iso_date(s3_object.last_modified)),
+                            ("ETag", s3_object.etag),
+                            ("Size", s3_object.size),
+                            ("StorageClass", "STANDARD"),
+                        ],
+                    )
+                )
+                next_token = "k" + object_key
+                i += 1
+
+        children = [
+            ("Name", self.bucket_name),
+            ("Prefix", encode(prefix)),
+            ("KeyCount", len(contents) + len(common_prefixes)),
+            ("MaxKeys", max_keys),
+            ("IsTruncated", "true" if truncated else "false"),
+        ]
+        if delimiter:
+            children.append(("Delimiter", encode(delimiter)))
+        if url_encode:
+            children.append(("EncodingType", "url"))
+        if truncated:
+            children.append(("NextContinuationToken", next_token))
+        children.extend(contents)
+        children.extend(("CommonPrefixes", [("Prefix", encode(p))]) for p in common_prefixes)
+        self._send(200, _xml("ListBucketResult", children))
+
+    def _HeadObject(self, bucket, key, query, body):
+        with self.state.lock:
+            s3_object = self._get_object_or_404(bucket, key)
+        self._check_conditions(s3_object, self.headers.get("If-Match"), self.headers.get("If-None-Match"))
+        headers = self._metadata_headers(s3_object)
+        self.send_response(200)
+        self.send_header("Content-Length", str(s3_object.size))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def _GetObject(self, bucket, key, query, body):
+        with self.state.lock:
+            s3_object = self._get_object_or_404(bucket, key)
+        self._check_conditions(s3_object, self.headers.get("If-Match"), self.headers.get("If-None-Match"))
+        headers = self._metadata_headers(s3_object)
+        status = 200
+        segments = s3_object.segments
+        length = s3_object.size
+        if range_header := self.headers.get("Range"):
+            start, end = self._parse_range(range_header, s3_object.size)
+            segments = slice_segments(segments, start, end)
+            length = end - start
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{s3_object.size}"
+            status = 206
+        self.send_response(status)
+        self.send_header("Content-Type", "binary/octet-stream")
+        self.send_header("Content-Length", str(length))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        for segment in segments:
+            for chunk in segment.chunks():
+                self.wfile.write(chunk)
+        with self.state.lock:
+            self.state.bytes_sent += length
+
+    def _PutObject(self, bucket, key, query, body):
+        s3_object = S3Object([Segment(len(body), data=body)], metadata=self._request_metadata())
+        with self.state.lock:
+            self._check_conditions(
+                bucket.objects.get(key), self.headers.get("If-Match"), self.headers.get("If-None-Match")
+            )
+            bucket.put(key, s3_object)
+        self._send(200, headers={"ETag": s3_object.etag})
+
+    def _CopyObject(self, bucket, key, query, body):
+        source_object, segments = self._copy_source_segments()
+        if self.headers.get("x-amz-metadata-directive", "COPY") == "REPLACE":
+            metadata = self._request_metadata()
+        else:
+            metadata = dict(source_object.metadata)
+        s3_object = S3Object(segments, etag=source_object.etag, metadata=metadata)
+        if self.headers.get("x-amz-tagging-directive", "COPY") == "COPY":
+            s3_object.tags = list(source_object.tags)
+        with self.state.lock:
+            bucket.put(key, s3_object)
+        self._send(
+            200,
+            _xml(
+                "CopyObjectResult",
+                [("LastModified", _iso_date(s3_object.last_modified)), ("ETag", s3_object.etag)],
+            ),
+        )
+
+    def _DeleteObject(self, bucket, key, query, body):
+        with self.state.lock:
+            if (if_match := self.headers.get("If-Match")) is not None:
+                self._check_conditions(bucket.objects.get(key), if_match, None)
+            bucket.delete(key)
+        self._send(204)
+
+    def _GetObjectTagging(self, bucket, key, query, body):
+        with self.state.lock:
+            s3_object = self._get_object_or_404(bucket, key)
+            tags = list(s3_object.tags)
+        self._send(
+            200,
+            _xml(
+                "Tagging",
+                [("TagSet", [("Tag", [("Key", k), ("Value", v)]) for k, v in tags])],
+            ),
+        )
+
+    def _PutObjectTagging(self, bucket, key, query, body):
+        root = _strip_namespace(ElementTree.fromstring(body))
+        tags = [(tag.findtext("Key"), tag.findtext("Value")) for tag in root.iter("Tag")]
+        with self.state.lock:
+            self._get_object_or_404(bucket, key).tags = tags
+        self._send(200)
+
+    def _CreateMultipartUpload(self, bucket, key, query, body):
+        upload_id = uuid.uuid4().hex
+        with self.state.lock:
+            bucket.uploads[upload_id] = {"key": key, "parts": {}, "metadata": self._request_metadata()}
+        self._send(
+            200,
+            _xml(
+                "InitiateMultipartUploadResult",
+                [("Bucket", self.bucket_name), ("Key", key), ("UploadId", upload_id)],
+            ),
+        )
+
+    def _get_upload(self, bucket, query):
+        upload = bucket.uploads.get(query["uploadId"])
+        if upload is None:
+            raise S3Error(404, "NoSuchUpload", "The specified upload does not exist.")
+        return upload
+
+    def _UploadPart(self, bucket, key, query, body):
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        with self.state.lock:
+            self._get_upload(bucket, query)["parts"][int(query["partNumber"])] = (
+                etag,
+                [Segment(len(body), data=body)],
+            )
+        self._send(200, headers={"ETag": etag})
+
+    def _UploadPartCopy(self, bucket, key, query, body):
+        _, segments = self._copy_source_segments(self.headers.get("x-amz-copy-source-range"))
+        etag = S3Object(segments).etag
+        with self.state.lock:
+            self._get_upload(bucket, query)["parts"][int(query["partNumber"])] = (etag, segments)
+        self._send(
+            200,
+            _xml("CopyPartResult", [("LastModified", _iso_date(time.time())), ("ETag", etag)]),
+        )
+
+    def _CompleteMultipartUpload(self, bucket, key, query, body):
+        root = _strip_namespace(ElementTree.fromstring(body))
+        part_numbers = [int(part.findtext("PartNumber")) for part in root.iter("Part")]
+        with self.state.lock:
+            upload = self._get_upload(bucket, query)
+            segments = []
+            etag_hash = hashlib.md5()
+            for part_number in part_numbers:
+                if part_number not in upload["parts"]:
+                    raise S3Error(400, "InvalidPart", "One or more of the specified parts could not be found.")
+                part_etag, part_segments = upload["parts"][part_number]
+                segments.extend(part_segments)
+                etag_hash.update(bytes.fromhex(part_etag.strip('"')))
+            self._check_conditions(
+                bucket.objects.get(key), self.headers.get("If-Match"), self.headers.get("If-None-Match")
+            )
+            etag = f'"{etag_hash.hexdigest()}-{len(part_numbers)}"'
+            bucket.put(key, S3Object(segments, etag=etag, metadata=upload["metadata"]))
+            del bucket.uploads[query["uploadId"]]
+        self._send(
+            200,
+            _xml(
+                "CompleteMultipartUploadResult",
+                [("Bucket", self.bucket_name), ("Key", key), ("ETag", etag)],
+            ),
+        )
+
+    def _AbortMultipartUpload(self, bucket, key, query, body):
+        with self.state.lock:
+            bucket.uploads.pop(query["uploadId"], None)
+        self._send(204)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=0, help="The port to listen on. 0 picks a free port.")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Latency to add to every request.")
+    parser.add_argument("--latency-jitter-ms", type=float, default=0, help="Random extra latency of up to this much.")
+    parser.add_argument(
+        "--throttle-rate", type=float, default=0, help="The fraction of requests to respond to with 503 SlowDown."
+    )
+    parser.add_argument(
+        "--max-requests-per-second",
+        type=float,
+        default=0,
+        help="Respond with 503 SlowDown to requests beyond this rate. 0 means no limit.",
+    )
+    args = parser.parse_args()
+
+    FakeS3Handler.state = FakeS3State(
+        args.latency_ms / 1000,
+        args.latency_jitter_ms / 1000,
+        args.throttle_rate,
+        args.max_requests_per_second,
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), FakeS3Handler)
+    server.daemon_threads = True
+    # The benchmark runner reads this line to find the port
+    print(f"Listening on http://127.0.0.1:{server.server_address[1]}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
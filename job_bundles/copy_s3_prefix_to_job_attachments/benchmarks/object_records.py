@@ -0,0 +1,141 @@
+"""
+Benchmarks the shard files and in-memory records of the objects that the steps pass to each
+other, against the former JSON lines shards with a dict for each object.
+
+For each object count, it writes a shard in both formats, with keys in S3 listing order and
+the etags and xxh128 hashes that HashObjects writes. Then for each format, a separate process
+reads the shard, either keeping every object in a list like a sort run of SaveManifest does, or
+streaming through it like HashObjects and CopyObjects do. It reports the file size, the read
+time, and the peak RSS of the process. Before timing, it checks that both formats read back
+the same objects.
+
+Example:
+
+    python object_records.py --object-counts 1000000,10000000
+"""
+
+import argparse
+import json
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BENCHMARKS_DIR = Path(__file__).parent
+SHARED_DIR = BENCHMARKS_DIR.parent / "scripts" / "shared"
+sys.path.insert(0, str(SHARED_DIR))
+
+from object_shards import S3Object, ShardWriter, read_shard  # noqa: E402
+
+PREFIX = "projects/benchmark"
+
+
+def generate(object_count, seed=0):
+    """Yields the objects of a synthetic prefix in S3 listing order."""
+    rnd = random.Random(seed)
+    for i in range(object_count):
+        yield S3Object(
+            f"{PREFIX}/shot{i // 1000:05d}/layer{i // 125 % 8}/frame_{i:08d}.exr",
+            int(rnd.lognormvariate(10, 2)),
+            f'"{rnd.getrandbits(128):032x}"',
+            1_700_000_000_000_000_000 + rnd.getrandbits(40),
+            f"{rnd.getrandbits(128):032x}",
+        )
+
+
+def write_shards(directory, object_count):
+    json_path = directory / f"objects_{object_count}.jsonl"
+    binary_path = directory / f"objects_{object_count}.bin"
+    with open(json_path, "w", encoding="utf8") as fh, ShardWriter(binary_path) as writer:
+        for s3_object in generate(object_count):
+            fh.write(json.dumps(s3_object.to_dict(), separators=(",", ":")))
+            fh.write("\n")
+            writer.write(s3_object)
+    return json_path, binary_path
+
+
+def read_json_shard(path):
+    # The reader of the former JSON lines shards
+    with open(path, encoding="utf8") as fh:
+        for line in fh:
+            yield json.loads(line)
+
+
+def check_equivalence(json_path, binary_path):
+    for json_object, s3_object in zip(read_json_shard(json_path), read_shard(binary_path), strict=True):
+        if json_object != s3_object.to_dict():
+            raise RuntimeError(f"The formats differ: {json_object} != {s3_object.to_dict()}")
+
+
+def peak_rss_kib():
+    # A child process inherits the maximum RSS of getrusage() from its parent, so read the
+    # peak RSS of this process image instead.
+    with open("/proc/self/status") as fh:
+        for line in fh:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(path, mode):
+    """Runs in a separate process, so the peak RSS is only of this format."""
+    reader = read_json_shard if path.suffix == ".jsonl" else read_shard
+    start = time.perf_counter()
+    if mode == "load":
+        objects = list(reader(path))
+        object_count = len(objects)
+    else:
+        object_count = sum(1 for _ in reader(path))
+    seconds = time.perf_counter() - start
+    print(json.dumps({"objects": object_count, "seconds": seconds, "peak_rss_kib": peak_rss_kib()}))
+
+
+def run_measurement(path, mode):
+    result = subprocess.run(
+        [sys.executable, __file__, "--measure", str(path), "--mode", mode], capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        # Most likely the process ran out of memory
+        return None
+    return json.loads(result.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--object-counts", default="1000000", help="Comma-separated object counts")
+    parser.add_argument("--modes", default="load,stream", help="Comma-separated modes, from load and stream")
+    parser.add_argument("--measure", type=Path, help=argparse.SUPPRESS)
+    parser.add_argument("--mode", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.measure, args.mode)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for object_count in [int(v) for v in args.object_counts.split(",")]:
+            json_path, binary_path = write_shards(Path(tmp_dir), object_count)
+            check_equivalence(json_path, binary_path)
+            print(f"{object_count} objects:")
+            for name, path in [("JSON dicts", json_path), ("binary records", binary_path)]:
+                print(f"  {name:<15} file {path.stat().st_size / 1024 / 1024:8.1f} MiB")
+            for mode in args.modes.split(","):
+                for name, path in [("JSON dicts", json_path), ("binary records", binary_path)]:
+                    result = run_measurement(path, mode)
+                    if result is None:
+                        print(f"  {mode:<6} {name:<15} failed, most likely out of memory")
+                        continue
+                    print(
+                        f"  {mode:<6} {name:<15} {result['seconds']:7.2f} s, "
+                        f"{result['objects'] / result['seconds']:10.0f} objects/s, "
+                        f"peak RSS {result['peak_rss_kib'] / 1024:8.1f} MiB"
+                    )
+            json_path.unlink()
+            binary_path.unlink()
+
+
+if __name__ == "__main__":
+    main()
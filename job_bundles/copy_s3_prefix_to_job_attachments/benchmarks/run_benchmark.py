@@ -0,0 +1,365 @@
+"""
+Benchmarks the steps of the copy job against a local S3 stand-in.
+
+It starts fake_s3_server.py, fills a source bucket with a synthetic prefix, and runs
+CollectObjects, HashObjects, CopyObjects and SaveManifest in order for each Parallelism
+value, with the tasks of a step running concurrently as separate processes like they
+would on a fleet. For each step, it reports the wall clock time, objects/s, bytes/s,
+API calls by type, throttled requests, and the peak RSS of the largest task, and saves
+them as JSON. Pass the JSON from a previous commit as --baseline to check for regressions.
+
+Example:
+
+    python run_benchmark.py --profile mixed --object-count 20000 --parallelism 1,4 \\
+        --latency-ms 20 --output results.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+import synthetic_prefix
+
+BENCHMARKS_DIR = Path(__file__).parent
+SCRIPTS_DIR = BENCHMARKS_DIR.parent / "scripts"
+SOURCE_BUCKET = "benchmark-source"
+SOURCE_PREFIX = "projects/benchmark"
+JOB_ATTACHMENTS_BUCKET = "benchmark-job-attachments"
+JOB_ATTACHMENTS_ROOT_PREFIX = "DeadlineCloud"
+# The bytes sent that the task profiles report may differ from the request bodies that the
+# server received by this fraction, or this many bytes for steps that send little
+BYTES_SENT_TOLERANCE = 0.02
+BYTES_SENT_TOLERANCE_BYTES = 64 * 1024
+
+
+def start_server(args):
+    """Starts the fake S3 server, and returns the process and its URL."""
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            str(BENCHMARKS_DIR / "fake_s3_server.py"),
+            "--latency-ms",
+            str(args.latency_ms),
+            "--latency-jitter-ms",
+            str(args.latency_jitter_ms),
+            "--throttle-rate",
+            str(args.throttle_rate),
+            "--max-requests-per-second",
+            str(args.max_requests_per_second),
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    line = server.stdout.readline()
+    if not line.startswith("Listening on "):
+        server.kill()
+        raise RuntimeError(f"The fake S3 server failed to start: {line!r}")
+    return server, line.split()[-1]
+
+
+def admin_request(url, path, body=None):
+    request = urllib.request.Request(
+        url + path, data=json.dumps(body).encode() if body is not None else None
+    )
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)
+
+
+def run_tasks(commands, env, log_dir, step_name):
+    """Runs the commands concurrently, and returns the largest peak RSS in bytes."""
+    processes = []
+    for i, command in enumerate(commands):
+        log_path = log_dir / f"{step_name}_{i + 1}.log"
+        with open(log_path, "w") as log_file:
+            processes.append(
+                (
+                    subprocess.Popen(command, env=env, stdout=log_file, stderr=subprocess.STDOUT),
+                    log_path,
+                )
+            )
+    peak_rss = 0
+    failed_logs = []
+    for process, log_path in processes:
+        # wait4 returns the resource usage of the process, including its peak RSS in KiB
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        peak_rss = max(peak_rss, rusage.ru_maxrss * 1024)
+        if process.returncode != 0:
+            failed_logs.append(str(log_path))
+    if failed_logs:
+        raise RuntimeError(f"{step_name} failed, see the logs {', '.join(failed_logs)}")
+    return peak_rss
+
+
+def counter_delta(after, before):
+    return {
+        name: count - before.get(name, 0)
+        for name, count in sorted(after.items())
+        if count - before.get(name, 0)
+    }
+
+
+def check_profiles_bytes_sent(workspace, step_name, server_bytes_received):
+    """Checks that the bytes sent in the step's task profiles match the request bodies the server received."""
+    profiles_bytes_sent = sum(
+        json.loads(path.read_text())["bytes_sent"] for path in (workspace / "profiles").glob(f"{step_name}*.json")
+    )
+    difference = abs(profiles_bytes_sent - server_bytes_received)
+    if difference > max(BYTES_SENT_TOLERANCE * server_bytes_received, BYTES_SENT_TOLERANCE_BYTES):
+        raise RuntimeError(
+            f"The {step_name} profiles report {profiles_bytes_sent} bytes sent, "
+            f"but the server received {server_bytes_received} bytes"
+        )
+    return profiles_bytes_sent
+
+
+def run_pipeline(args, url, parallelism, object_count, total_bytes, work_dir):
+    """Runs all the steps of the job once, and returns the measurements for each step."""
+    admin_request(
+        url,
+        "/_benchmark/reset",
+        {
+            "buckets": [SOURCE_BUCKET, JOB_ATTACHMENTS_BUCKET],
+            "job_attachments": {
+                "s3BucketName": JOB_ATTACHMENTS_BUCKET,
+                "rootPrefix": JOB_ATTACHMENTS_ROOT_PREFIX,
+            },
+            "synthetic": {
+                "bucket": SOURCE_BUCKET,
+                "prefix": SOURCE_PREFIX,
+                "profile": args.profile,
+                "object_count": args.object_count,
+                "seed": args.seed,
+                "max_size": args.max_size,
+            },
+        },
+    )
+    workspace = work_dir / f"parallelism_{parallelism}"
+    log_dir = work_dir / f"logs_{parallelism}"
+    log_dir.mkdir(parents=True, exist_ok=True)
+
+    env = {
+        name: value
+        for name, value in os.environ.items()
+        if not name.startswith("AWS_") and not name.startswith("DEADLINE_")
+    }
+    env.update(
+        AWS_ENDPOINT_URL=url,
+        AWS_DISABLE_HOST_PREFIX_INJECTION="true",
+        AWS_ACCESS_KEY_ID="benchmark",
+        AWS_SECRET_ACCESS_KEY="benchmark",
+        AWS_DEFAULT_REGION="us-west-2",
+        AWS_EC2_METADATA_DISABLED="true",
+        DEADLINE_FARM_ID="farm-benchmark",
+        DEADLINE_QUEUE_ID="queue-benchmark",
+        # The same environment that the job template sets up
+        PYTHONPATH=str(SCRIPTS_DIR / "shared"),
+        PYTHONUNBUFFERED="True",
+    )
+    copy_source = f"s3://{SOURCE_BUCKET}/{SOURCE_PREFIX}"
+
+    def task_command(script, *script_args, extra_args=""):
+        return [
+            sys.executable,
+            str(SCRIPTS_DIR / script),
+            str(workspace),
+            *script_args,
+            "--copy-source",
+            copy_source,
+            *shlex.split(extra_args),
+        ]
+
+    steps = [
+        (
+            "CollectObjects",
+            [
+                task_command(
+                    "collect_objects.py",
+                    "--parallelism",
+                    str(parallelism),
+                    extra_args=args.collect_args,
+                )
+            ],
+        ),
+        (
+            "HashObjects",
+            [
+                task_command("hash_objects.py", "--index", str(i), extra_args=args.hash_args)
+                for i in range(1, parallelism + 1)
+            ],
+        ),
+        (
+            "CopyObjects",
+            [
+                task_command("copy_objects.py", "--index", str(i), extra_args=args.copy_args)
+                for i in range(1, parallelism + 1)
+            ],
+        ),
+        (
+            "SaveManifest",
+            [
+                task_command(
+                    "save_manifest.py",
+                    "--parallelism",
+                    str(parallelism),
+                    extra_args=args.manifest_args,
+                )
+            ],
+        ),
+    ]
+
+    results = {}
+    for step_name, commands in steps:
+        stats_before = admin_request(url, "/_benchmark/stats")
+        start_time = time.monotonic()
+        peak_rss = run_tasks(commands, env, log_dir, step_name)
+        seconds = time.monotonic() - start_time
+        stats_after = admin_request(url, "/_benchmark/stats")
+        results[step_name] = {
+            "seconds": round(seconds, 3),
+            "objects_per_second": round(object_count / seconds, 1),
+            "bytes_per_second": round(total_bytes / seconds),
+            "api_calls": counter_delta(stats_after["requests"], stats_before["requests"]),
+            "throttled": counter_delta(stats_after["throttled"], stats_before["throttled"]),
+            "bytes_sent": stats_after["bytes_sent"] - stats_before["bytes_sent"],
+            "bytes_received": stats_after["bytes_received"] - stats_before["bytes_received"],
+            "peak_rss_bytes": peak_rss,
+        }
+        # The server receives the request bodies that the tasks send
+        results[step_name]["profiles_bytes_sent"] = check_profiles_bytes_sent(
+            workspace, step_name, results[step_name]["bytes_received"]
+        )
+        print(
+            f"  {step_name:15s} {seconds:8.2f}s {object_count / seconds:10.1f} objects/s "
+            f"{total_bytes / seconds / 1024**2:9.1f} MiB/s {sum(results[step_name]['api_calls'].values()):8d} API calls "
+            f"{peak_rss / 1024**2:7.1f} MiB peak RSS",
+            flush=True,
+        )
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=BENCHMARKS_DIR, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Prints the change in time of each step from the baseline, and returns the regressions."""
+    regressions = []
+    baseline_runs = {run["parallelism"]: run["steps"] for run in baseline["runs"]}
+    print(f"Compared with the baseline from commit {baseline.get('commit')}:")
+    for run in results["runs"]:
+        for step_name, step in run["steps"].items():
+            baseline_step = baseline_runs.get(run["parallelism"], {}).get(step_name)
+            if not baseline_step:
+                continue
+            ratio = step["seconds"] / max(baseline_step["seconds"], 1e-9)
+            flag = ""
+            if ratio > 1 + tolerance:
+                flag = "  REGRESSION"
+                regressions.append((run["parallelism"], step_name, ratio))
+            print(f"  Parallelism {run['parallelism']} {step_name:15s} {ratio:6.2f}x time{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--profile", choices=sorted(synthetic_prefix.PROFILES), default="mixed")
+    parser.add_argument("--object-count", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--max-size",
+        type=int,
+        default=256 * synthetic_prefix.MIB,
+        help="Objects are at most this many bytes, to keep the benchmark short.",
+    )
+    parser.add_argument(
+        "--parallelism",
+        type=str,
+        default="1,4",
+        help="A comma-separated list of Parallelism values to run the job with.",
+    )
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--latency-jitter-ms", type=float, default=0)
+    parser.add_argument("--throttle-rate", type=float, default=0)
+    parser.add_argument("--max-requests-per-second", type=float, default=0)
+    parser.add_argument("--collect-args", type=str, default="", help="Extra arguments for collect_objects.py.")
+    parser.add_argument("--hash-args", type=str, default="", help="Extra arguments for hash_objects.py.")
+    parser.add_argument("--copy-args", type=str, default="", help="Extra arguments for copy_objects.py.")
+    parser.add_argument("--manifest-args", type=str, default="", help="Extra arguments for save_manifest.py.")
+    parser.add_argument(
+        "--work-dir", type=Path, help="Where to put the workspaces and logs. Defaults to a temporary directory."
+    )
+    parser.add_argument("--output", type=Path, default=Path("benchmark_results.json"))
+    parser.add_argument("--baseline", type=Path, help="Results from a previous run to compare with.")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="With --baseline, a step that takes this fraction longer than in the baseline is a regression.",
+    )
+    args = parser.parse_args()
+
+    objects = synthetic_prefix.generate(
+        SOURCE_PREFIX, args.profile, args.object_count, seed=args.seed, max_size=args.max_size
+    )
+    total_bytes = sum(size for _, size, _ in objects)
+    del objects
+    print(
+        f"Synthetic prefix '{args.profile}' with {args.object_count} objects in {total_bytes / 1024**2:.1f} MiB"
+    )
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now(tz=datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "config": {
+            name: str(value) if isinstance(value, Path) else value
+            for name, value in vars(args).items()
+            if name not in ("output", "baseline", "work_dir")
+        },
+        "prefix": {"object_count": args.object_count, "total_bytes": total_bytes},
+        "runs": [],
+    }
+
+    server, url = start_server(args)
+    try:
+        with tempfile.TemporaryDirectory(prefix="copy-s3-prefix-benchmark-") as temp_dir:
+            work_dir = args.work_dir or Path(temp_dir)
+            for parallelism in [int(value) for value in args.parallelism.split(",")]:
+                print(f"Parallelism {parallelism}:")
+                steps = run_pipeline(args, url, parallelism, args.object_count, total_bytes, work_dir)
+                results["runs"].append({"parallelism": parallelism, "steps": steps})
+    finally:
+        server.terminate()
+        server.wait()
+
+    with open(args.output, "w") as fh:
+        json.dump(results, fh, indent=2)
+    print(f"Saved the results to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        if compare_with_baseline(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Generates the keys and sizes of a synthetic S3 prefix for benchmarking.
+
+Real prefixes tend to have many tiny files, a long tail of larger ones, and a few huge
+files that dominate the bytes. Each profile draws sizes from such a distribution, with
+a fixed seed so that every benchmark run sees the same prefix.
+"""
+
+import math
+import random
+
+KIB = 1024
+MIB = 1024 * KIB
+GIB = 1024 * MIB
+
+
+def _mixed_size(rnd, max_size):
+    choice = rnd.random()
+    if choice < 0.80:
+        # Many tiny files, like sidecar, text and small texture files
+        size = int(rnd.lognormvariate(math.log(4 * KIB), 1.5))
+    elif choice < 0.999:
+        # A long tail of larger files
+        size = int(rnd.paretovariate(1.2) * 256 * KIB)
+    else:
+        # A few huge files, like caches and simulation output
+        size = rnd.randint(GIB, 4 * GIB)
+    return min(size, max_size)
+
+
+def _tiny_size(rnd, max_size):
+    return min(int(rnd.lognormvariate(math.log(KIB), 1.0)), max_size)
+
+
+def _huge_size(rnd, max_size):
+    return min(rnd.randint(GIB, 8 * GIB), max_size)
+
+
+PROFILES = {
+    "mixed": _mixed_size,
+    "tiny": _tiny_size,
+    "huge": _huge_size,
+}
+
+
+def generate(prefix, profile, object_count, seed=0, max_size=16 * GIB):
+    """
+    Returns a list of (key, size, content_seed) for the objects of a synthetic prefix. The
+    content seed determines the object's data, so objects with different seeds differ.
+    """
+    rnd = random.Random(seed)
+    size_for = PROFILES[profile]
+    objects = []
+    for i in range(object_count):
+        directory = f"shot{i // 1000:04d}/layer{rnd.randrange(8)}"
+        # Some file names have spaces and non-ASCII characters, as real ones do
+        name_choice = rnd.random()
+        if name_choice < 0.01:
+            name = f"rendu final {i:07d}.exr"
+        elif name_choice < 0.02:
+            name = f"frame_{i:07d}_été.exr"
+        else:
+            name = f"frame_{i:07d}.exr"
+        objects.append((f"{prefix}/{directory}/{name}", size_for(rnd, max_size), seed * object_count + i))
+    return objects
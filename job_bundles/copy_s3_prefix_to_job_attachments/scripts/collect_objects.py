@@ -2,16 +2,77 @@ import argparse
 import json
 import os
 import sys
+from contextlib import ExitStack
 from pathlib import Path
 from pprint import pprint
 from urllib.parse import urlparse
 
 import boto3
 
+# This works because the "Shared Library" job environment sets PYTHONPATH.
+from instrumentation import Instrumentation
+from object_shards import (
+    ShardWriter,
+    shard_path,
+    unchanged_shard_path,
+    write_partitions_summary,
+)
+from parallel_listing import (
+    DEFAULT_DISCOVERY_DEPTH,
+    DEFAULT_LISTING_CONCURRENCY,
+    ParallelLister,
+)
+from partitioner import (
+    DEFAULT_BYTES_PER_SECOND,
+    DEFAULT_LARGE_OBJECT_SECONDS,
+    DEFAULT_REQUEST_SECONDS,
+    CostModel,
+    GreedyPartitioner,
+)
+from s3_concurrency import client_config
+from snapshots import find_latest_object_index, read_object_index, snapshot_prefix
+
 parser = argparse.ArgumentParser(prog="collect_object.py")
 parser.add_argument("workspace_path", type=Path)
 parser.add_argument("--parallelism", type=int, required=True)
 parser.add_argument("--copy-source", type=str, required=True)
+parser.add_argument(
+    "--request-seconds",
+    type=float,
+    default=DEFAULT_REQUEST_SECONDS,
+    help="The estimated time per S3 API call, used to balance the partitions.",
+)
+parser.add_argument(
+    "--bytes-per-second",
+    type=float,
+    default=DEFAULT_BYTES_PER_SECOND,
+    help="The estimated transfer rate of one task, used to balance the partitions.",
+)
+parser.add_argument(
+    "--large-object-seconds",
+    type=float,
+    default=DEFAULT_LARGE_OBJECT_SECONDS,
+    help="Objects estimated to take at least this long are placed after all the others, largest first.",
+)
+parser.add_argument(
+    "--incremental",
+    type=str,
+    choices=["True", "False"],
+    default="False",
+    help="If True, only objects that are new or changed since the previous snapshot are hashed and copied.",
+)
+parser.add_argument(
+    "--listing-concurrency",
+    type=int,
+    default=DEFAULT_LISTING_CONCURRENCY,
+    help="The maximum number of concurrent list requests. 1 lists the prefix with a single paginated listing.",
+)
+parser.add_argument(
+    "--listing-discovery-depth",
+    type=int,
+    default=DEFAULT_DISCOVERY_DEPTH,
+    help="How many directory levels to list with a delimiter to divide the listing into ranges.",
+)
 args = parser.parse_args()
 
 # Initialize the workspace
@@ -20,7 +81,12 @@ os.chdir(args.workspace_path)
 
 session = boto3.Session()
 deadline_client = session.client("deadline")
-s3_client = session.client("s3")
+# Size the connection pool so that every listing thread can have a request in flight
+s3_client = session.client("s3", config=client_config(args.listing_concurrency))
+# Record the timing of every API call, to report at the end
+instrumentation = Instrumentation()
+instrumentation.attach(deadline_client)
+instrumentation.attach(s3_client)
 
 # Get the queue and save it into the workspace
 response = deadline_client.get_queue(
@@ -28,6 +94,8 @@ response = deadline_client.get_queue(
 )
 with open(args.workspace_path / "job_attachment_settings.json", "w") as fh:
     json.dump(response["jobAttachmentSettings"], fh)
+ja_s3_bucket_name = response["jobAttachmentSettings"]["s3BucketName"]
+ja_root_prefix = response["jobAttachmentSettings"]["rootPrefix"]
 
 # Split the S3 copy source into bucket and prefix
 url = urlparse(args.copy_source, allow_fragments=False)
@@ -37,32 +105,110 @@ if url.scheme != "s3":
 s3_bucket_name = url.netloc
 s3_prefix = url.path.strip("/")
 
+# In incremental mode, compare the listing with the object index of the previous snapshot
+previous_objects = iter([])
+if args.incremental == "True":
+    object_index_key = find_latest_object_index(
+        s3_client,
+        ja_s3_bucket_name,
+        snapshot_prefix(ja_root_prefix, s3_bucket_name, s3_prefix),
+    )
+    if object_index_key:
+        print(
+            f"Comparing with the previous snapshot s3://{ja_s3_bucket_name}/{object_index_key}"
+        )
+        previous_objects = read_object_index(
+            s3_client, ja_s3_bucket_name, object_index_key
+        )
+    else:
+        print("There is no previous snapshot, so processing all the objects")
+
 # Collect all the S3 objects under the prefix, skipping any
-# that end with "/" as those are directory markers.
-s3_objects = []
-paginator = s3_client.get_paginator("list_objects_v2")
-for page in paginator.paginate(Bucket=s3_bucket_name, Prefix=f"{s3_prefix}/"):
-    s3_objects.extend(
-        {
-            "key": obj["Key"],
-            "size": obj["Size"],
-            "etag": obj["ETag"],
-            "mtime": int(obj["LastModified"].timestamp() * 1e9),
-        }
-        for obj in page["Contents"]
-        if not obj["Key"].endswith("/")
+# that end with "/" as those are directory markers. Ranges of the prefix are listed
+# concurrently, and the objects are streamed into the shard files in the same order
+# as a single paginated listing, so memory use stays bounded no matter how many
+# objects are under the prefix.
+first_s3_objects = []
+with ExitStack() as stack:
+    lister = stack.enter_context(
+        ParallelLister(
+            s3_client,
+            s3_bucket_name,
+            f"{s3_prefix}/",
+            args.workspace_path / "listing",
+            concurrency=args.listing_concurrency,
+            discovery_depth=args.listing_discovery_depth,
+        )
+    )
+    writers = [
+        stack.enter_context(ShardWriter(shard_path(args.workspace_path, i + 1)))
+        for i in range(args.parallelism)
+    ]
+    unchanged_writer = stack.enter_context(
+        ShardWriter(unchanged_shard_path(args.workspace_path))
     )
+    # The object index of the previous snapshot is in the same order as the listing, so
+    # step through it alongside the listing.
+    previous_object = next(previous_objects, None)
+    # Balance the estimated time of the tasks, accounting for both the amount
+    # of data and the API calls for each object.
+    partitioner = GreedyPartitioner(
+        args.parallelism,
+        CostModel(
+            request_seconds=args.request_seconds, bytes_per_second=args.bytes_per_second
+        ),
+        args.large_object_seconds,
+    )
+    for s3_object in lister.objects():
+        if len(first_s3_objects) < 20:
+            first_s3_objects.append(s3_object)
+        while previous_object is not None and previous_object.key < s3_object.key:
+            previous_object = next(previous_objects, None)
+        if (
+            previous_object is not None
+            and previous_object.key == s3_object.key
+            and previous_object.size == s3_object.size
+            and previous_object.etag == s3_object.etag
+        ):
+            # The object is unchanged, so reuse its hash and mtime from the previous snapshot
+            unchanged_writer.write(previous_object)
+            continue
+        index = partitioner.add(s3_object)
+        if index is not None:
+            writers[index].write(s3_object)
+    for index, s3_object in partitioner.finish():
+        writers[index].write(s3_object)
+    write_partitions_summary(args.workspace_path, writers, partitioner.costs)
 
-total_size = sum(obj["size"] for obj in s3_objects)
 print(
-    f"openjd_status: Collected {len(s3_objects)} objects in {total_size / 1024 / 1024:.2f}MB containing the bucket prefix"
+    f"Listed the prefix in {lister.range_count} ranges, {lister.split_count} of them split from ranges being listed"
 )
+object_count = sum(w.object_count for w in writers)
+total_size = sum(w.total_size for w in writers)
+instrumentation.report(args.workspace_path, "CollectObjects")
+if args.incremental == "True":
+    print(
+        f"openjd_status: Collected {object_count} new or changed objects in {total_size / 1024 / 1024:.2f}MB, and {unchanged_writer.object_count} unchanged objects in {unchanged_writer.total_size / 1024 / 1024:.2f}MB containing the bucket prefix"
+    )
+else:
+    print(
+        f"openjd_status: Collected {object_count} objects in {total_size / 1024 / 1024:.2f}MB containing the bucket prefix"
+    )
 print("The first 20 objects:")
-pprint(s3_objects[:20])
+pprint([s3_object.to_dict() for s3_object in first_s3_objects])
 
-# Sort by size and then deal the S3 objects to the tasks.
-# This will roughly distribute by both amount of data and file count.
-s3_objects.sort(key=lambda v: v["size"])
-for i in range(args.parallelism):
-    with open(args.workspace_path / f"s3_objects_{i + 1}.json", "w") as fh:
-        json.dump(s3_objects[i :: args.parallelism], fh)
+# Print the predicted time of each task, to help select the Parallelism parameter value
+print("Predicted time for each HashObjects/CopyObjects task:")
+for i, (writer, seconds) in enumerate(zip(writers, partitioner.costs)):
+    print(
+        f"  Task {i + 1}: {seconds:.1f} seconds for {writer.object_count} objects in {writer.total_size / 1024 / 1024:.2f}MB"
+    )
+print(
+    f"openjd_status: Predicted makespan {partitioner.makespan:.1f} seconds with Parallelism {args.parallelism} (lower bound {partitioner.lower_bound:.1f} seconds)"
+)
+if partitioner.max_object_cost > 0:
+    # Beyond this parallelism, the largest object alone determines the makespan
+    useful_parallelism = max(1, int(sum(partitioner.costs) / partitioner.max_object_cost))
+    print(
+        f"The largest object takes {partitioner.max_object_cost:.1f} seconds, so Parallelism above {useful_parallelism} will not reduce the makespan"
+    )
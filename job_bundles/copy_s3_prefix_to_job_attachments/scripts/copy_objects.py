@@ -1,22 +1,102 @@
 import argparse
 import json
 import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
 from urllib.parse import urlparse
 
 import boto3
-from botocore.exceptions import ClientError
+
+# This works because the "Shared Library" job environment sets PYTHONPATH.
+from cas_existence import CasExistenceOracle, cas_key
+from copy_scheduler import (
+    DEFAULT_MAX_CONCURRENT_REQUESTS,
+    DEFAULT_MAX_IN_FLIGHT_BYTES,
+    DEFAULT_MULTIPART_THRESHOLD,
+    CopyScheduler,
+)
+from instrumentation import Instrumentation
+from object_shards import read_partition_summary, read_shard, shard_path
+from progress_reporter import ProgressReporter
+from s3_concurrency import AimdLimiter, client_config, register_throttle_listener
+from standard_args import add_standard_args, process_standard_args
+from task_journal import (
+    DEFAULT_CHECKPOINT_SECONDS,
+    TaskJournal,
+    journal_path,
+    shard_identity,
+)
 
 parser = argparse.ArgumentParser(prog="collect_object.py")
 parser.add_argument("workspace_path", type=Path)
 parser.add_argument("--index", type=int, required=True)
 parser.add_argument("--copy-source", type=str, required=True)
+parser.add_argument(
+    "--metadata-concurrency",
+    type=int,
+    default=64,
+    help="The maximum number of concurrent head requests to check for existing objects.",
+)
+parser.add_argument(
+    "--max-concurrent-requests",
+    type=int,
+    default=DEFAULT_MAX_CONCURRENT_REQUESTS,
+    help="The maximum number of concurrent CopyObject and UploadPartCopy requests.",
+)
+parser.add_argument(
+    "--max-in-flight-bytes",
+    type=int,
+    default=DEFAULT_MAX_IN_FLIGHT_BYTES,
+    help="The maximum number of bytes that the concurrent copy requests cover in total.",
+)
+parser.add_argument(
+    "--multipart-threshold",
+    type=int,
+    default=DEFAULT_MULTIPART_THRESHOLD,
+    help="Objects of at least this many bytes are copied in parts with UploadPartCopy.",
+)
+parser.add_argument(
+    "--fused-upload",
+    type=str,
+    choices=["True", "False"],
+    default="False",
+    help="If True, HashObjects already uploaded the objects, so there's nothing to copy.",
+)
+parser.add_argument(
+    "--checkpoint-seconds",
+    type=float,
+    default=DEFAULT_CHECKPOINT_SECONDS,
+    help="How often to save the completed hashes to the journal that a retried task resumes from.",
+)
+add_standard_args(parser)
 args = parser.parse_args()
+process_standard_args(args)
+
+if args.fused_upload == "True":
+    print("openjd_status: Nothing to copy, HashObjects uploaded the objects in fused mode")
+    print("openjd_progress: 100")
+    sys.exit(0)
 
 workspace_path = Path(sys.argv[1])
 
+metadata_thread_count = args.metadata_concurrency
+limiter = AimdLimiter(
+    initial=min(16, metadata_thread_count), maximum=metadata_thread_count
+)
+
 session = boto3.Session()
-s3_client = session.client("s3")
+s3_client = session.client("s3", config=client_config(metadata_thread_count))
+register_throttle_listener(s3_client, limiter.on_throttle)
+# The copy scheduler retries throttled requests itself, without holding on to a thread
+copy_client = session.client(
+    "s3", config=client_config(args.max_concurrent_requests, max_attempts=1)
+)
+# Record the timing of every API call, to report at the end
+instrumentation = Instrumentation()
+instrumentation.attach(s3_client)
+instrumentation.attach(copy_client)
 
 url = urlparse(args.copy_source, allow_fragments=False)
 s3_bucket_name = url.netloc
@@ -27,43 +107,138 @@ with open(workspace_path / "job_attachment_settings.json") as fh:
 ja_s3_bucket_name = ja_settings["s3BucketName"]
 ja_root_prefix = ja_settings["rootPrefix"]
 
-# Load the list of objects this task will process
-with open(workspace_path / f"s3_objects_{args.index}.json") as fh:
-    s3_objects = json.load(fh)
+# The objects this task will process are streamed from its shard
+object_count = read_partition_summary(workspace_path, args.index)["object_count"]
+
+# The journal of the hashes copied or found in the bucket so far, which a retry of an interrupted
+# task resumes from. The hashes that this task has already handled are in handled_hashes, so each
+# unique blob is copied at most once.
+journal = TaskJournal(
+    journal_path(workspace_path, "CopyObjects", args.index),
+    shard_identity(shard_path(workspace_path, args.index)),
+    checkpoint_seconds=args.checkpoint_seconds,
+)
+handled_hashes = {entry["hash"] for entry in journal.entries()}
+if handled_hashes:
+    print(
+        f"openjd_status: Resuming with {len(handled_hashes)} hashes that an earlier attempt copied or found in the bucket"
+    )
+
+# Determine which of the unique hashes in this partition are already in the job attachments
+# bucket, by listing the bucket or with HeadObject as is cheaper.
+unique_hashes = {
+    s3_object.xxh128_hash
+    for s3_object in read_shard(shard_path(workspace_path, args.index))
+} - handled_hashes
+cas_existence = CasExistenceOracle(
+    s3_client, ja_s3_bucket_name, ja_root_prefix, unique_hashes
+)
+print(
+    f"The partition has {len(unique_hashes)} unique hashes left to check. Listed {cas_existence.listed_shard_count} CAS shards, estimated at {cas_existence.estimated_shard_size} objects each"
+)
+del unique_hashes
 
-# Copy all the objects to the job attachments bucket
-print(f"openjd_status: Processing {len(s3_objects)} objects...")
 copied_object_count = 0
-copied_bytes_count = 0
-for i, s3_object in enumerate(s3_objects):
-    print(f"openjd_progress: {100 * i / len(s3_objects):.1f}")
-    print(f"Processing key {s3_object['key']} with hash {s3_object['xxh128_hash']}")
-    ja_key = f"{ja_root_prefix}/Data/{s3_object['xxh128_hash']}.xxh128"
-    # Check if the object exists, and skip the copy if it does
+counter_lock = threading.Lock()
+
+
+def check_and_copy(done, s3_object):
+    """Checks whether the object's hash is in the CAS, and schedules a copy if it's not."""
     try:
-        s3_client.head_object(Bucket=ja_s3_bucket_name, Key=ja_key)
-        print("Skipping copy, it is already there")
-        continue
-    except ClientError as exc:
-        error_code = int(exc.response["ResponseMetadata"]["HTTPStatusCode"])
-        if error_code != 404:
-            raise
-    copied_object_count += 1
-    copied_bytes_count += s3_object["size"]
-    print(f"Copying {s3_object['size']} bytes...")
-    # Copy using the S3 managed copy operation that does a multi-threaded multi-part
-    # copy when applicable.
-    s3_client.copy(
-        CopySource={"Bucket": s3_bucket_name, "Key": s3_object["key"]},
-        Bucket=ja_s3_bucket_name,
-        Key=ja_key,
-        ExtraArgs={
-            "CopySourceIfMatch": s3_object["etag"],
-            "MetadataDirective": "REPLACE",
-            "TaggingDirective": "REPLACE",
-        },
-    )
+        with limiter:
+            exists = cas_existence.exists(s3_object.xxh128_hash)
+        if exists:
+            progress.debug(
+                f"Skipping copy of key {s3_object.key}, hash {s3_object.xxh128_hash} is already there"
+            )
+            progress.count("already there")
+            done.set_result(None)
+            return
+        progress.debug(
+            f"Copying {s3_object.size} bytes from key {s3_object.key} to hash {s3_object.xxh128_hash}"
+        )
+        copy_future = scheduler.copy(
+            s3_bucket_name,
+            s3_object.key,
+            s3_object.etag,
+            s3_object.size,
+            ja_s3_bucket_name,
+            cas_key(ja_root_prefix, s3_object.xxh128_hash),
+        )
+    except Exception as exc:
+        done.set_exception(exc)
+        return
+
+    def on_copied(copy_future):
+        global copied_object_count
+        if copy_future.exception() is not None:
+            done.set_exception(copy_future.exception())
+            return
+        with counter_lock:
+            copied_object_count += 1
+        progress.count("copied")
+        done.set_result(None)
+
+    copy_future.add_done_callback(on_copied)
+
+
+# Copy all the objects to the job attachments bucket
+print(
+    f"openjd_status: Processing {object_count} objects using {args.max_concurrent_requests} concurrent copy requests..."
+)
+# Limit how many objects are read ahead of the threads, to keep memory bounded
+max_in_flight = 4 * (metadata_thread_count + args.max_concurrent_requests)
+start_time = time.monotonic()
+# Print the progress and a summary of the outcomes periodically, and the details of each object in debug mode
+progress = ProgressReporter(
+    object_count,
+    debug=args.debug,
+    details=lambda: f"copying at {scheduler.copied_bytes / (time.monotonic() - start_time) / 1024**2:.1f} MiB/s",
+)
+scheduler = CopyScheduler(
+    copy_client,
+    max_concurrent_requests=args.max_concurrent_requests,
+    max_in_flight_bytes=args.max_in_flight_bytes,
+    multipart_threshold=args.multipart_threshold,
+)
+try:
+    with ThreadPoolExecutor(max_workers=metadata_thread_count) as metadata_executor, journal:
+        in_flight = {}
+
+        def wait_for_completed():
+            completed, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in completed:
+                # Get the result so it re-raises any exceptions
+                future.result()
+                journal.append({"hash": in_flight.pop(future)})
+                progress.advance()
+
+        for s3_object in read_shard(shard_path(workspace_path, args.index)):
+            if s3_object.xxh128_hash in handled_hashes:
+                progress.advance()
+                continue
+            handled_hashes.add(s3_object.xxh128_hash)
+            if len(in_flight) >= max_in_flight:
+                wait_for_completed()
+            done = Future()
+            metadata_executor.submit(check_and_copy, done, s3_object)
+            in_flight[done] = s3_object.xxh128_hash
+        while in_flight:
+            wait_for_completed()
+finally:
+    scheduler.shutdown()
+# Every object is in the job attachments bucket now, so the journal is no longer needed
+journal.remove()
+duration = time.monotonic() - start_time
+instrumentation.report(workspace_path, "CopyObjects", args.index)
+print(
+    f"openjd_status: Processed {object_count} objects (copied {scheduler.copied_bytes} bytes in {copied_object_count} objects, {scheduler.copied_bytes / max(duration, 1e-9) / 1024**2:.1f} MiB/s)"
+)
+print(f"Saved {journal.checkpoint_count} checkpoints of the completed hashes")
+print(
+    f"Checked for existing objects with {cas_existence.list_request_count} list requests and {cas_existence.head_request_count} head requests"
+)
 print(
-    f"openjd_status: Processed {len(s3_objects)} objects (copied {copied_bytes_count} bytes in {copied_object_count} objects)"
+    f"Retried {scheduler.retry_count} copy requests. The head request concurrency limit ended at {limiter.limit}, after {limiter.throttle_count} throttled requests"
 )
-print("openjd_progress: 100")
+progress.finish()
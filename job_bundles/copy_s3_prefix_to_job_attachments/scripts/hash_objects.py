@@ -2,58 +2,276 @@ import argparse
 import json
 import os
 import sys
+import threading
 from base64 import b64decode, b64encode
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
 from urllib.parse import urlparse
 
 import boto3
 from xxhash import xxh3_128
 
+# This works because the "Shared Library" job environment sets PYTHONPATH.
+from copy_scheduler import DEFAULT_MAX_CONCURRENT_REQUESTS, CopyScheduler
+from fused_upload import DEFAULT_UPLOAD_CONCURRENCY, FusedUploader
+from hash_cache import DEFAULT_MAX_AGE_DAYS, DEFAULT_MAX_ENTRIES, HashCache
+from instrumentation import Instrumentation
+from object_shards import (
+    S3Object,
+    ShardWriter,
+    read_partition_summary,
+    read_shard,
+    shard_path,
+)
+from progress_reporter import ProgressReporter
+from ranged_hashing import (
+    DEFAULT_MAX_BUFFERED_RANGES,
+    DEFAULT_RANGE_CONCURRENCY,
+    DEFAULT_RANGE_SIZE,
+    DEFAULT_RANGED_HASH_THRESHOLD,
+    RangedHasher,
+)
+from s3_concurrency import AimdLimiter, client_config, register_throttle_listener
+from standard_args import add_standard_args, process_standard_args
+from task_journal import (
+    DEFAULT_CHECKPOINT_SECONDS,
+    TaskJournal,
+    journal_path,
+    shard_identity,
+)
+
 parser = argparse.ArgumentParser(prog="collect_object.py")
 parser.add_argument("workspace_path", type=Path)
 parser.add_argument("--index", type=int, required=True)
 parser.add_argument("--copy-source", type=str, required=True)
+parser.add_argument(
+    "--metadata-concurrency",
+    type=int,
+    default=64,
+    help="The maximum number of concurrent tagging and head requests.",
+)
+parser.add_argument(
+    "--hash-cache",
+    type=str,
+    default="",
+    help="The path of an SQLite file on local disk that caches object hashes across runs. Empty disables the cache.",
+)
+parser.add_argument(
+    "--hash-cache-max-age-days",
+    type=int,
+    default=DEFAULT_MAX_AGE_DAYS,
+    help="Hash cache entries that have not been used for this many days are evicted.",
+)
+parser.add_argument(
+    "--hash-cache-max-entries",
+    type=int,
+    default=DEFAULT_MAX_ENTRIES,
+    help="The least recently used hash cache entries beyond this many are evicted.",
+)
+parser.add_argument(
+    "--ranged-hash-threshold",
+    type=int,
+    default=DEFAULT_RANGED_HASH_THRESHOLD,
+    help="Objects of at least this many bytes are hashed with concurrent ranged GETs.",
+)
+parser.add_argument(
+    "--range-size",
+    type=int,
+    default=DEFAULT_RANGE_SIZE,
+    help="The number of bytes in each ranged GET.",
+)
+parser.add_argument(
+    "--range-concurrency",
+    type=int,
+    default=DEFAULT_RANGE_CONCURRENCY,
+    help="The maximum number of concurrent ranged GETs.",
+)
+parser.add_argument(
+    "--max-buffered-ranges",
+    type=int,
+    default=DEFAULT_MAX_BUFFERED_RANGES,
+    help="The maximum number of fetched ranges waiting to be hashed, to cap memory use.",
+)
+parser.add_argument(
+    "--fused-upload",
+    type=str,
+    choices=["True", "False"],
+    default="False",
+    help="If True, upload objects into job attachments while hashing them, instead of leaving it to CopyObjects.",
+)
+parser.add_argument(
+    "--checkpoint-seconds",
+    type=float,
+    default=DEFAULT_CHECKPOINT_SECONDS,
+    help="How often to save the completed objects to the journal that a retried task resumes from.",
+)
+add_standard_args(parser)
 args = parser.parse_args()
+process_standard_args(args)
 
 workspace_path = Path(sys.argv[1])
 
+# Get the available vcpus using the API recommended in Python documentation, then use 2 threads for each
+# to stream object bodies into the hasher. Use multithreaded scheduling, as the xxhash function always
+# releases the GIL.
+available_vcpus = len(os.sched_getaffinity(0))
+body_thread_count = 2 * available_vcpus
+# The metadata calls are bound by request latency, so they get their own threads, with an adaptive
+# limit on how many are in flight that backs off when S3 responds with SlowDown.
+metadata_thread_count = args.metadata_concurrency
+limiter = AimdLimiter(
+    initial=min(16, metadata_thread_count), maximum=metadata_thread_count
+)
+
 session = boto3.Session()
-s3_client = session.client("s3")
+# Size the connection pool so that every thread can have a request in flight
+s3_client = session.client(
+    "s3",
+    config=client_config(
+        metadata_thread_count
+        + body_thread_count
+        + args.range_concurrency
+        + (DEFAULT_UPLOAD_CONCURRENCY if args.fused_upload == "True" else 0)
+    ),
+)
+register_throttle_listener(s3_client, limiter.on_throttle)
+# Record the timing of every API call and of the hashing, to report at the end
+instrumentation = Instrumentation()
+instrumentation.attach(s3_client)
 
 url = urlparse(args.copy_source, allow_fragments=False)
 s3_bucket_name = url.netloc
 
-# Load the list of objects this task will process
-with open(workspace_path / f"s3_objects_{args.index}.json") as fh:
-    s3_objects = json.load(fh)
+# In fused mode, the objects are uploaded into job attachments in the same pass that hashes them
+fused_uploader = None
+if args.fused_upload == "True":
+    with open(workspace_path / "job_attachment_settings.json") as fh:
+        ja_settings = json.load(fh)
+    # The copy scheduler retries throttled requests itself, without holding on to a thread
+    copy_client = session.client(
+        "s3", config=client_config(DEFAULT_MAX_CONCURRENT_REQUESTS, max_attempts=1)
+    )
+    instrumentation.attach(copy_client)
+    copy_scheduler = CopyScheduler(copy_client)
+    fused_uploader = FusedUploader(
+        s3_client,
+        ja_settings["s3BucketName"],
+        ja_settings["rootPrefix"],
+        copy_scheduler,
+        instrumentation=instrumentation,
+    )
+    stale_count = fused_uploader.sweep_stale_temporary_objects()
+    if stale_count:
+        print(f"Deleted {stale_count} temporary objects that interrupted tasks left behind")
+
+hash_cache = None
+if args.hash_cache:
+    os.makedirs(os.path.dirname(os.path.abspath(args.hash_cache)), exist_ok=True)
+    hash_cache = HashCache(
+        args.hash_cache,
+        max_age_days=args.hash_cache_max_age_days,
+        max_entries=args.hash_cache_max_entries,
+    )
+
+# The objects this task will process are streamed from its shard
+object_count = read_partition_summary(workspace_path, args.index)["object_count"]
+# Print the progress and a summary of the outcomes periodically, and the details of each object in debug mode
+progress = ProgressReporter(object_count, debug=args.debug)
+
+# The journal of the objects completed so far, which a retry of an interrupted task resumes from
+journal = TaskJournal(
+    journal_path(workspace_path, "HashObjects", args.index),
+    shard_identity(shard_path(workspace_path, args.index)),
+    checkpoint_seconds=args.checkpoint_seconds,
+)
 
 
 def update_mtime_from_metadata(s3_object, metadata):
-    """Modifies the 'mtime' entry in s3_object from the S3 object metadata."""
+    """Modifies the mtime of s3_object from the S3 object metadata."""
     if posix_mtime_metadata := metadata.get("file-mtime"):
         # DataSync, FSx for Lustre, among others use x-amz-meta-file-mtime,
         # which is nanoseconds if it has an "ns" suffix, otherwise milliseconds.
         if posix_mtime_metadata[-2:] == "ns":
-            s3_object["mtime"] = int(posix_mtime_metadata[:-2])
+            s3_object.mtime = int(posix_mtime_metadata[:-2])
         else:
-            s3_object["mtime"] = int(float(posix_mtime_metadata) * 1e6)
+            s3_object.mtime = int(float(posix_mtime_metadata) * 1e6)
     elif posix_mtime_metadata := metadata.get("mtime"):
         # S3FS, RClone, among others use x-amz-meta-mtime, which is seconds
         # and may be floating point
-        s3_object["mtime"] = int(float(posix_mtime_metadata) * 1e9)
+        s3_object.mtime = int(float(posix_mtime_metadata) * 1e9)
 
 
-# Check all the objects for the hash tag, and hash the data if it's missing or doesn't match the etag
+# Check all the objects for the hash tag, and hash the data if it's missing or doesn't match the etag.
+# The counters are updated from the metadata threads, so they are guarded by a lock.
 hashed_object_count = 0
 hashed_bytes_count = 0
+counter_lock = threading.Lock()
+# The indexes in the shard of the objects being processed that this attempt hashed
+hashed_indexes = set()
+
+
+def run_stage(done, stage, *args):
+    """Runs one stage of processing an object, reporting any exception through the done future."""
+    try:
+        stage(done, *args)
+    except Exception as exc:
+        done.set_exception(exc)
+
+
+def cache_hash(s3_object):
+    """Saves the hash and mtime of the object in the hash cache, if there is one."""
+    if hash_cache is not None:
+        hash_cache.store(
+            s3_bucket_name,
+            s3_object.key,
+            s3_object.etag,
+            s3_object.xxh128_hash,
+            s3_object.mtime,
+        )
+
+
+def copy_to_cas(done, s3_object):
+    """In fused mode, the last stage for an object with a known hash copies it into job attachments if needed."""
+    if fused_uploader is None:
+        done.set_result(None)
+        return
+    with limiter:
+        copy_future = fused_uploader.copy_if_missing(
+            s3_bucket_name,
+            s3_object.key,
+            s3_object.etag,
+            s3_object.size,
+            s3_object.xxh128_hash,
+        )
+    if copy_future is None:
+        done.set_result(None)
+        return
+
+    def on_copied(copy_future):
+        if copy_future.exception() is not None:
+            done.set_exception(copy_future.exception())
+        else:
+            done.set_result(None)
 
+    copy_future.add_done_callback(on_copied)
 
-def process_s3_object(i, s3_object):
-    # NOTE: If we don't combine "\n" inside the main string of print(), it interleaves the "\n" with
-    #       the bodies, and some lines get doubled up while others are empty.
-    print(f"{i}: Processing key {s3_object['key']}\n", end="")
-    response = s3_client.get_object_tagging(Bucket=s3_bucket_name, Key=s3_object["key"])
+
+def get_hash_from_tags(done, i, s3_object):
+    """The first stage, on the metadata threads, checks for the hash in the cache and the object tags."""
+    progress.debug(f"{i}: Processing key {s3_object.key}")
+    if hash_cache is not None:
+        cached = hash_cache.lookup(s3_bucket_name, s3_object.key, s3_object.etag)
+        if cached is not None:
+            # If it's cached for the same etag, there is no need to call S3
+            s3_object.xxh128_hash, s3_object.mtime = cached
+            progress.debug(f"{i}: Using the cached hash {s3_object.xxh128_hash}")
+            progress.count("cached")
+            copy_to_cas(done, s3_object)
+            return
+    with limiter:
+        response = s3_client.get_object_tagging(
+            Bucket=s3_bucket_name, Key=s3_object.key
+        )
     tag_set = response["TagSet"]
     tag_set_dict = {obj["Key"]: obj["Value"] for obj in tag_set}
     etag_and_hash_encoded = tag_set_dict.get("B64DeadlineJobAttachmentsXXH128")
@@ -61,74 +279,191 @@ def process_s3_object(i, s3_object):
         etag, ja_hash = (
             b64decode(etag_and_hash_encoded.encode("ascii")).decode("utf-8").split("|")
         )
-        if etag == s3_object["etag"]:
+        if etag == s3_object.etag:
             # If it's tagged, and the etag matches, use the JA hash from the tag
-            s3_object["xxh128_hash"] = ja_hash
-            print(f"{i}: Using the tagged hash {ja_hash}\n", end="")
+            s3_object.xxh128_hash = ja_hash
+            progress.debug(f"{i}: Using the tagged hash {ja_hash}")
+            progress.count("tagged")
             # Get the POSIX mtime if it's set
-            response = s3_client.head_object(
-                Bucket=s3_bucket_name, Key=s3_object["key"]
-            )
+            with limiter:
+                response = s3_client.head_object(
+                    Bucket=s3_bucket_name, Key=s3_object.key
+                )
             update_mtime_from_metadata(s3_object, response["Metadata"])
+            cache_hash(s3_object)
+            copy_to_cas(done, s3_object)
             return
 
     # We don't know the hash, so we need to compute it
     global hashed_object_count, hashed_bytes_count
-    hashed_object_count += 1
-    hashed_bytes_count += s3_object["size"]
-    hasher = xxh3_128()
-    if s3_object["size"] > 0:
-        response = s3_client.get_object(
-            Bucket=s3_bucket_name, Key=s3_object["key"], IfMatch=s3_object["etag"]
-        )
-        update_mtime_from_metadata(s3_object, response["Metadata"])
-        for chunk in response["Body"].iter_chunks(2**20):
-            hasher.update(chunk)
+    with counter_lock:
+        hashed_object_count += 1
+        hashed_bytes_count += s3_object.size
+        hashed_indexes.add(i)
+    if s3_object.size > 0:
+        body_executor.submit(run_stage, done, hash_object_body, i, s3_object, tag_set)
     else:
         # Get the POSIX mtime if it's set
-        response = s3_client.head_object(Bucket=s3_bucket_name, Key=s3_object["key"])
+        with limiter:
+            response = s3_client.head_object(
+                Bucket=s3_bucket_name, Key=s3_object.key
+            )
+        update_mtime_from_metadata(s3_object, response["Metadata"])
+        s3_object.xxh128_hash = xxh3_128().hexdigest()
+        save_hash_tag(done, i, s3_object, tag_set)
+
+
+def hash_object_body(done, i, s3_object, tag_set):
+    """The second stage, on the body threads, streams the object into the hasher."""
+    if fused_uploader is not None:
+        progress.debug(f"{i}: Hashing and uploading {s3_object.size} bytes")
+        ja_hash, metadata = fused_uploader.hash_and_upload(
+            s3_bucket_name,
+            s3_object.key,
+            s3_object.etag,
+            s3_object.size,
+            ranged_hasher if s3_object.size >= args.ranged_hash_threshold else None,
+        )
+        update_mtime_from_metadata(s3_object, metadata)
+        s3_object.xxh128_hash = ja_hash
+        metadata_executor.submit(
+            run_stage, done, save_hash_tag, i, s3_object, tag_set, True
+        )
+        return
+    if s3_object.size >= args.ranged_hash_threshold:
+        progress.debug(f"{i}: Hashing {s3_object.size} bytes with ranged GETs")
+        ja_hash, metadata = ranged_hasher.hash_object(
+            s3_bucket_name, s3_object.key, s3_object.etag, s3_object.size
+        )
+        update_mtime_from_metadata(s3_object, metadata)
+        s3_object.xxh128_hash = ja_hash
+    else:
+        hasher = xxh3_128()
+        response = s3_client.get_object(
+            Bucket=s3_bucket_name, Key=s3_object.key, IfMatch=s3_object.etag
+        )
         update_mtime_from_metadata(s3_object, response["Metadata"])
-    ja_hash = hasher.hexdigest()
-    s3_object["xxh128_hash"] = ja_hash
-    print(f"{i}: Calculated hash {ja_hash}\n", end="")
+        with instrumentation.timed("stream_body"):
+            for chunk in response["Body"].iter_chunks(2**20):
+                with instrumentation.timed("xxh128"):
+                    hasher.update(chunk)
+        s3_object.xxh128_hash = hasher.hexdigest()
+    metadata_executor.submit(run_stage, done, save_hash_tag, i, s3_object, tag_set)
+
+
+def save_hash_tag(done, i, s3_object, tag_set, uploaded=False):
+    """
+    The last stage, on the metadata threads, saves the calculated hash as an object tag. If the object
+    was not uploaded while hashing, it continues to copy_to_cas.
+    """
+    ja_hash = s3_object.xxh128_hash
+    progress.debug(f"{i}: Calculated hash {ja_hash}")
+    progress.count("hashed")
 
-    # Save the hash as an object tag
-    etag_and_hash = b64encode(f"{s3_object['etag']}|{ja_hash}".encode("utf-8")).decode(
+    etag_and_hash = b64encode(f"{s3_object.etag}|{ja_hash}".encode("utf-8")).decode(
         "ascii"
     )
     tag_set = [
         obj for obj in tag_set if obj["Key"] != "B64DeadlineJobAttachmentsXXH128"
     ]
     tag_set.append({"Key": "B64DeadlineJobAttachmentsXXH128", "Value": etag_and_hash})
-    s3_client.put_object_tagging(
-        Bucket=s3_bucket_name,
-        Key=s3_object["key"],
-        Tagging={"TagSet": tag_set},
-    )
+    with limiter:
+        s3_client.put_object_tagging(
+            Bucket=s3_bucket_name,
+            Key=s3_object.key,
+            Tagging={"TagSet": tag_set},
+        )
+    cache_hash(s3_object)
+    if uploaded:
+        done.set_result(None)
+    else:
+        copy_to_cas(done, s3_object)
 
 
-# Get the available vcpus using the API recommended in Python documentation, then use 2 threads for each
-available_vcpus = len(os.sched_getaffinity(0))
-thread_count = 2 * available_vcpus
-# Use multithreaded scheduling, as the xxhash function always releases the GIL
+# Limit how many objects are read ahead of the threads, to keep memory bounded
+max_in_flight = 4 * (metadata_thread_count + body_thread_count)
 print(
-    f"openjd_status: Processing {len(s3_objects)} objects using {thread_count} threads..."
+    f"openjd_status: Processing {object_count} objects using {metadata_thread_count} metadata threads and {body_thread_count} body threads..."
 )
-with ThreadPoolExecutor(max_workers=thread_count) as executor:
-    # Start the load operations and mark each future with its URL
-    future_list = [
-        executor.submit(process_s3_object, i, s3_object)
-        for i, s3_object in enumerate(s3_objects)
-    ]
-    for i, future in enumerate(as_completed(future_list)):
-        # Get the result so it re-raises any exceptions
-        future.result()
-        print(f"openjd_progress: {100 * i / len(s3_objects):.1f}\n", end="")
+with ThreadPoolExecutor(
+    max_workers=metadata_thread_count
+) as metadata_executor, ThreadPoolExecutor(
+    max_workers=body_thread_count
+) as body_executor, RangedHasher(
+    s3_client,
+    range_size=args.range_size,
+    range_concurrency=args.range_concurrency,
+    max_buffered_ranges=args.max_buffered_ranges,
+    instrumentation=instrumentation,
+) as ranged_hasher, journal, ShardWriter(
+    shard_path(workspace_path, args.index)
+) as writer:
+    # Write the metadata about these objects, including the hashes, to replace the shard when done.
+    # Start with the objects that an earlier attempt of the task completed.
+    resumed_hashed_object_count = 0
+    resumed_hashed_bytes_count = 0
+    completed_indexes = bytearray(object_count)
+    for entry in journal.entries():
+        completed_indexes[entry["index"]] = 1
+        s3_object = S3Object.from_dict(entry["object"])
+        writer.write(s3_object)
+        progress.advance()
+        if entry["hashed"]:
+            resumed_hashed_object_count += 1
+            resumed_hashed_bytes_count += s3_object.size
+    if progress.processed_count:
+        print(
+            f"openjd_status: Resuming with {progress.processed_count} objects that an earlier attempt completed"
+        )
+    in_flight = {}
+
+    def write_completed():
+        completed, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in completed:
+            # Get the result so it re-raises any exceptions
+            future.result()
+            i, s3_object = in_flight.pop(future)
+            writer.write(s3_object)
+            with counter_lock:
+                hashed = i in hashed_indexes
+                hashed_indexes.discard(i)
+            journal.append({"index": i, "object": s3_object.to_dict(), "hashed": hashed})
+            progress.advance()
+
+    for i, s3_object in enumerate(read_shard(shard_path(workspace_path, args.index))):
+        if completed_indexes[i]:
+            continue
+        if len(in_flight) >= max_in_flight:
+            write_completed()
+        done = Future()
+        metadata_executor.submit(run_stage, done, get_hash_from_tags, i, s3_object)
+        in_flight[done] = (i, s3_object)
+    while in_flight:
+        write_completed()
+# The shard now has all the hashes, so the journal is no longer needed
+journal.remove()
+if fused_uploader is not None:
+    fused_uploader.shutdown()
+    copy_scheduler.shutdown()
+instrumentation.report(workspace_path, "HashObjects", args.index)
 print(
-    f"openjd_status: Processed {len(s3_objects)} objects (hashed {hashed_bytes_count} bytes in {hashed_object_count} objects)"
+    f"openjd_status: Processed {object_count} objects (hashed {hashed_bytes_count + resumed_hashed_bytes_count} bytes in {hashed_object_count + resumed_hashed_object_count} objects)"
 )
-print("openjd_progress: 100")
-
-# Update the metadata about these objects in the workspace
-with open(workspace_path / f"s3_objects_{args.index}.json", "w") as fh:
-    json.dump(s3_objects, fh)
+if resumed_hashed_object_count:
+    print(
+        f"Earlier attempts hashed {resumed_hashed_bytes_count} bytes in {resumed_hashed_object_count} of the objects, this attempt hashed {hashed_bytes_count} bytes in {hashed_object_count} objects"
+    )
+print(f"Saved {journal.checkpoint_count} checkpoints of the completed objects")
+if fused_uploader is not None:
+    print(
+        f"Uploaded {fused_uploader.uploaded_bytes_count} bytes in {fused_uploader.uploaded_object_count} objects while hashing, and copied {fused_uploader.copied_object_count} objects with known hashes"
+    )
+print(
+    f"The metadata concurrency limit ended at {limiter.limit}, after {limiter.throttle_count} throttled requests"
+)
+if hash_cache is not None:
+    evicted_count = hash_cache.close()
+    print(
+        f"Hash cache {args.hash_cache}: {hash_cache.hit_count} hits, {hash_cache.miss_count} misses, evicted {evicted_count} entries"
+    )
+progress.finish()
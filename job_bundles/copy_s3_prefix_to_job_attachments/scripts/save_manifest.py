@@ -1,30 +1,75 @@
 import argparse
 import datetime
 import json
-import subprocess
 import sys
-from io import BytesIO
+import tempfile
 from pathlib import Path
 from urllib.parse import urlparse
 
 import boto3
 
-subprocess.check_call([sys.executable, "-m", "pip", "install", "deadline"])
-from deadline.job_attachments.asset_manifests.v2023_03_03 import (
-    AssetManifest,
-    ManifestPath,
+# This works because the "Shared Library" job environment sets PYTHONPATH.
+from instrumentation import Instrumentation
+from manifest_writer import (
+    DEFAULT_PARTITION_CONCURRENCY,
+    DEFAULT_PARTITION_SIZE,
+    PARTITIONINGS,
+    MultipartUploadWriter,
+    manifest_path_sort_key,
+    partition_manifest_paths,
+    write_manifest,
+    write_manifest_index,
+    write_partitioned_manifests,
+)
+from object_shards import DEFAULT_SORT_RUN_SIZE, merge_shards, shard_path, unchanged_shard_path
+from s3_concurrency import client_config
+from snapshots import (
+    MANIFEST_INDEX_SUFFIX,
+    MANIFEST_SUFFIX,
+    OBJECT_INDEX_SUFFIX,
+    PARTITIONED_MANIFESTS_SUFFIX,
+    snapshot_prefix,
+    write_object_index,
 )
 
 parser = argparse.ArgumentParser(prog="collect_object.py")
 parser.add_argument("workspace_path", type=Path)
 parser.add_argument("--parallelism", type=int, required=True)
 parser.add_argument("--copy-source", type=str, required=True)
+parser.add_argument(
+    "--sort-run-size",
+    type=int,
+    default=DEFAULT_SORT_RUN_SIZE,
+    help="The number of objects to sort in memory at a time. Larger runs use more memory but fewer temporary files.",
+)
+parser.add_argument(
+    "--manifest-partitioning",
+    choices=PARTITIONINGS,
+    default="None",
+    help="Split the manifest into one manifest for each top-level directory, or into manifests of about"
+    " --manifest-partition-size bytes, with an index that lists them. None saves a single manifest.",
+)
+parser.add_argument(
+    "--manifest-partition-size",
+    type=int,
+    default=DEFAULT_PARTITION_SIZE,
+    help="The approximate size in bytes of each manifest with the Size partitioning.",
+)
+parser.add_argument(
+    "--manifest-concurrency",
+    type=int,
+    default=DEFAULT_PARTITION_CONCURRENCY,
+    help="The number of partitioned manifests to write at a time.",
+)
 args = parser.parse_args()
 
 workspace_path = Path(sys.argv[1])
 
 session = boto3.Session()
-s3_client = session.client("s3")
+s3_client = session.client("s3", config=client_config(args.manifest_concurrency))
+# Record the timing of every API call, to report at the end
+instrumentation = Instrumentation()
+instrumentation.attach(s3_client)
 
 url = urlparse(args.copy_source, allow_fragments=False)
 s3_bucket_name = url.netloc
@@ -36,41 +81,94 @@ with open(workspace_path / "job_attachment_settings.json") as fh:
 ja_s3_bucket_name = ja_settings["s3BucketName"]
 ja_root_prefix = ja_settings["rootPrefix"]
 
-total_size = 0
-paths = []
-
-for index in range(1, args.parallelism + 1):
-    with open(workspace_path / f"s3_objects_{index}.json") as fh:
-        for s3_object in json.load(fh):
-            total_size += s3_object["size"]
-            paths.append(
-                ManifestPath(
-                    path=s3_object["key"][len(s3_prefix) + 1 :],
-                    hash=s3_object["xxh128_hash"],
-                    mtime=s3_object["mtime"],
-                    size=s3_object["size"],
-                )
-            )
-
-paths.sort(key=lambda x: x.path, reverse=True)
-
-manifest = AssetManifest(
-    hash_alg="xxh128",
-    paths=paths,
-    total_size=total_size,
-)
+# Include the objects that were unchanged since the previous snapshot, if it was an incremental snapshot
+shard_paths = [shard_path(workspace_path, index) for index in range(1, args.parallelism + 1)]
+if unchanged_shard_path(workspace_path).exists():
+    shard_paths.append(unchanged_shard_path(workspace_path))
 
 now_timestamp = (
     datetime.datetime.now(tz=datetime.timezone.utc)
     .isoformat(timespec="minutes")
     .replace("+00:00", "Z")
 )
-manifest_key = f"{ja_root_prefix}/Manifests/bucket-prefix-snapshot-{s3_bucket_name}/{s3_prefix}/{now_timestamp}-manifest.json"
+manifest_key_prefix = snapshot_prefix(ja_root_prefix, s3_bucket_name, s3_prefix) + now_timestamp
+manifest_key = manifest_key_prefix + MANIFEST_SUFFIX
+manifest_index_key = manifest_key_prefix + MANIFEST_INDEX_SUFFIX
+object_index_key = manifest_key_prefix + OBJECT_INDEX_SUFFIX
 
-print(f"Saving manifest with {len(paths)} paths, total {total_size} bytes")
-s3_client.upload_fileobj(
-    Fileobj=BytesIO(manifest.encode().encode("utf-8")),
-    Bucket=ja_s3_bucket_name,
-    Key=manifest_key,
-)
-print(f"openjd_status: Saved manifest url s3://{ja_s3_bucket_name}/{manifest_key}")
+
+def relative_path(s3_object):
+    return s3_object.key[len(s3_prefix) + 1 :]
+
+
+def partitioned_manifest_key(index):
+    return f"{manifest_key_prefix}{PARTITIONED_MANIFESTS_SUFFIX}{index:05d}{MANIFEST_SUFFIX}"
+
+
+def sorted_manifest_paths(run_directory):
+    """Yields the manifest paths of all the shards, sorted as the canonical encoding requires."""
+    for s3_object in merge_shards(
+        shard_paths,
+        lambda s3_object: manifest_path_sort_key(relative_path(s3_object)),
+        Path(run_directory),
+        args.sort_run_size,
+    ):
+        yield relative_path(s3_object), s3_object.xxh128_hash, s3_object.mtime, s3_object.size
+
+
+# Stream the manifest, sorted by path as the canonical encoding requires, into a multipart upload.
+# The shards are merged with an external sort, whose temporary files go in the workspace.
+if args.manifest_partitioning == "None":
+    print("Saving manifest...")
+    with instrumentation.timed("save_manifest"), tempfile.TemporaryDirectory(
+        dir=workspace_path
+    ) as run_directory, MultipartUploadWriter(s3_client, ja_s3_bucket_name, manifest_key) as writer:
+        path_count, total_size = write_manifest(writer, sorted_manifest_paths(run_directory))
+    print(f"Saved manifest with {path_count} paths, total {total_size} bytes, in {writer.size} bytes")
+else:
+    # Each partition is a contiguous range of the sorted paths, written concurrently to its own manifest
+    print(f"Saving manifests partitioned by {args.manifest_partitioning}...")
+    with instrumentation.timed("save_manifest"), tempfile.TemporaryDirectory(
+        dir=workspace_path
+    ) as run_directory:
+        manifests = write_partitioned_manifests(
+            lambda index: MultipartUploadWriter(
+                s3_client, ja_s3_bucket_name, partitioned_manifest_key(index)
+            ),
+            partition_manifest_paths(
+                sorted_manifest_paths(run_directory),
+                args.manifest_partitioning,
+                args.manifest_partition_size,
+            ),
+            args.manifest_concurrency,
+        )
+    for manifest in manifests:
+        manifest["key"] = partitioned_manifest_key(manifest["index"])
+    with MultipartUploadWriter(s3_client, ja_s3_bucket_name, manifest_index_key) as writer:
+        write_manifest_index(writer, args.manifest_partitioning, manifests)
+    print(
+        f"Saved {len(manifests)} manifests with {sum(m['pathCount'] for m in manifests)} paths,"
+        f" total {sum(m['totalSize'] for m in manifests)} bytes, and an index of them in {writer.size} bytes"
+    )
+
+# Save the object index that an incremental snapshot compares with, in S3 listing order
+print("Saving object index...")
+with instrumentation.timed("save_object_index"), tempfile.TemporaryDirectory(
+    dir=workspace_path
+) as run_directory, MultipartUploadWriter(s3_client, ja_s3_bucket_name, object_index_key) as writer:
+    object_count = write_object_index(
+        writer,
+        merge_shards(
+            shard_paths,
+            lambda s3_object: s3_object.key,
+            Path(run_directory),
+            args.sort_run_size,
+        ),
+    )
+print(f"Saved object index with {object_count} objects")
+
+instrumentation.report(workspace_path, "SaveManifest")
+if args.manifest_partitioning == "None":
+    print(f"openjd_status: Saved manifest url s3://{ja_s3_bucket_name}/{manifest_key}")
+else:
+    print(f"openjd_status: Saved manifest index url s3://{ja_s3_bucket_name}/{manifest_index_key}")
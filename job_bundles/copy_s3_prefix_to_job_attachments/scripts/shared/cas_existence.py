@@ -0,0 +1,146 @@
+"""
+Determines which hashes already exist in the job attachments content-addressable storage (CAS).
+
+Checking each hash with an s3:HeadObject costs one request per object. When a partition has
+many hashes compared to the size of the CAS, listing the CAS keys is cheaper, because each
+s3:ListObjectsV2 page covers up to 1000 keys. The CAS keys are "<rootPrefix>/Data/<hash>.xxh128",
+and hashes are uniformly distributed, so the CasExistenceOracle splits the CAS into shards by
+the first hex digits of the hash. For each shard, it estimates the number of listing pages
+from a sample, and lists the shard if that's cheaper than a HeadObject for each of the
+partition's hashes in the shard.
+"""
+
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+# The number of hex digits of the hash that identify a CAS shard, so there are 16**2 = 256 shards.
+SHARD_PREFIX_LENGTH = 2
+# How many HeadObject requests one ListObjectsV2 page is worth, as it takes longer to return.
+LIST_PAGE_COST_IN_HEADS = 5
+LIST_PAGE_SIZE = 1000
+
+
+def cas_key(ja_root_prefix, xxh128_hash):
+    return f"{ja_root_prefix}/Data/{xxh128_hash}.xxh128"
+
+
+class CasExistenceOracle:
+    """
+    Answers whether a hash exists in the CAS. Construct it with the set of unique hashes that
+    will be queried, so it can choose between listing and HeadObject for each shard. The exists()
+    method is safe to call from multiple threads.
+    """
+
+    def __init__(self, s3_client, ja_s3_bucket_name, ja_root_prefix, hashes, list_concurrency=8):
+        self.s3_client = s3_client
+        self.ja_s3_bucket_name = ja_s3_bucket_name
+        self.ja_root_prefix = ja_root_prefix
+        self.list_request_count = 0
+        self.head_request_count = 0
+        self._lock = threading.Lock()
+
+        hashes_by_shard = {}
+        for xxh128_hash in hashes:
+            hashes_by_shard.setdefault(xxh128_hash[:SHARD_PREFIX_LENGTH], set()).add(xxh128_hash)
+
+        # The hashes known to exist, for the shards that were listed
+        self._listed_shards = set()
+        self._existing_hashes = set()
+        if not hashes_by_shard:
+            self.estimated_shard_size = 0
+            return
+
+        # Sample the most populated shard to estimate the number of keys in each shard
+        sample_shard = max(hashes_by_shard, key=lambda shard: len(hashes_by_shard[shard]))
+        self.estimated_shard_size = self._estimate_shard_size(
+            sample_shard, hashes_by_shard[sample_shard]
+        )
+        list_pages_per_shard = max(1, math.ceil(self.estimated_shard_size / LIST_PAGE_SIZE))
+        shards_to_list = [
+            shard
+            for shard, shard_hashes in hashes_by_shard.items()
+            if list_pages_per_shard * LIST_PAGE_COST_IN_HEADS < len(shard_hashes)
+            and shard not in self._listed_shards
+        ]
+        with ThreadPoolExecutor(max_workers=list_concurrency) as executor:
+            for shard, (existing_hashes, page_count) in zip(
+                shards_to_list,
+                executor.map(
+                    lambda shard: self._list_shard(shard, hashes_by_shard[shard]),
+                    shards_to_list,
+                ),
+            ):
+                self.list_request_count += page_count
+                self._existing_hashes.update(existing_hashes)
+                self._listed_shards.add(shard)
+
+    @property
+    def listed_shard_count(self):
+        return len(self._listed_shards)
+
+    def _estimate_shard_size(self, shard, shard_hashes):
+        data_prefix = f"{self.ja_root_prefix}/Data/"
+        response = self.s3_client.list_objects_v2(
+            Bucket=self.ja_s3_bucket_name,
+            Prefix=data_prefix + shard,
+            MaxKeys=LIST_PAGE_SIZE,
+        )
+        self.list_request_count += 1
+        contents = response.get("Contents", [])
+        if not response.get("IsTruncated"):
+            # The sample is the whole shard, so it doesn't need to be listed again
+            self._existing_hashes.update(
+                shard_hashes.intersection(
+                    obj["Key"][len(data_prefix) : -len(".xxh128")] for obj in contents
+                )
+            )
+            self._listed_shards.add(shard)
+            return len(contents)
+        # The hashes are uniformly distributed, so the fraction of the shard's hash space
+        # that the first page covered gives the size of the whole shard.
+        digits = 8
+        last_hash = contents[-1]["Key"].rsplit("/", 1)[-1]
+        first_value = int(shard.ljust(digits, "0"), 16)
+        try:
+            covered = int(last_hash[:digits], 16) - first_value + 1
+        except ValueError:
+            # Not a hash key, so assume the shard is too big to list
+            return LIST_PAGE_SIZE * 16**digits
+        shard_width = 16 ** (digits - len(shard))
+        return math.ceil(len(contents) * shard_width / covered)
+
+    def _list_shard(self, shard, shard_hashes):
+        """Returns the hashes from shard_hashes that exist, and the number of pages listed."""
+        existing_hashes = set()
+        page_count = 0
+        data_prefix = f"{self.ja_root_prefix}/Data/"
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            Bucket=self.ja_s3_bucket_name, Prefix=data_prefix + shard
+        ):
+            page_count += 1
+            for obj in page.get("Contents", []):
+                name = obj["Key"][len(data_prefix) :]
+                # Only keep the hashes that will be queried, to bound the memory use
+                if name.endswith(".xxh128") and name[: -len(".xxh128")] in shard_hashes:
+                    existing_hashes.add(name[: -len(".xxh128")])
+        return existing_hashes, page_count
+
+    def exists(self, xxh128_hash):
+        if xxh128_hash[:SHARD_PREFIX_LENGTH] in self._listed_shards:
+            return xxh128_hash in self._existing_hashes
+        with self._lock:
+            self.head_request_count += 1
+        try:
+            self.s3_client.head_object(
+                Bucket=self.ja_s3_bucket_name, Key=cas_key(self.ja_root_prefix, xxh128_hash)
+            )
+            return True
+        except ClientError as exc:
+            error_code = int(exc.response["ResponseMetadata"]["HTTPStatusCode"])
+            if error_code != 404:
+                raise
+            return False
@@ -0,0 +1,212 @@
+"""
+Schedules many S3 server-side copies concurrently.
+
+Small objects are copied with a single s3:CopyObject, and large objects with a multipart
+upload whose parts are copied with s3:UploadPartCopy. Every request, whether a whole small
+object or one part of a large one, runs on the same pool of threads, so small objects keep
+flowing while large ones are in progress. A budget of bytes in flight bounds how much data
+the copies have outstanding at once, in addition to the number of threads.
+
+Throttled requests are retried after a jittered backoff. The retry waits on a timer instead
+of in a thread of the pool, so the other transfers keep going at full concurrency.
+"""
+
+import math
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from s3_concurrency import backoff_seconds, is_retryable_error
+
+MIB = 1024 * 1024
+DEFAULT_MULTIPART_THRESHOLD = 256 * MIB
+DEFAULT_MAX_IN_FLIGHT_BYTES = 64 * 1024 * MIB
+DEFAULT_MAX_CONCURRENT_REQUESTS = 64
+DEFAULT_MAX_ATTEMPTS = 8
+MIN_PART_SIZE = 64 * MIB
+MAX_PART_SIZE = 5 * 1024 * MIB
+# Larger objects get larger parts, so that each object needs at most this many parts
+TARGET_MAX_PART_COUNT = 256
+
+
+def part_size_for(size):
+    """Returns the size of the parts for a multipart copy of an object with the given size."""
+    part_size = max(MIN_PART_SIZE, math.ceil(size / TARGET_MAX_PART_COUNT / MIB) * MIB)
+    return min(MAX_PART_SIZE, part_size)
+
+
+class ByteBudget:
+    """Blocks until the requested number of bytes fits within the budget."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, nbytes):
+        # A request larger than the whole budget can run when nothing else is in flight
+        nbytes = min(nbytes, self.max_bytes)
+        with self._condition:
+            while self._in_flight + nbytes > self.max_bytes:
+                self._condition.wait()
+            self._in_flight += nbytes
+        return nbytes
+
+    def release(self, nbytes):
+        with self._condition:
+            self._in_flight -= nbytes
+            self._condition.notify_all()
+
+
+class CopyScheduler:
+    """
+    Runs server-side copies concurrently. Call copy() for each object, which returns a Future
+    that is done when the copy is complete, and shutdown() at the end.
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        *,
+        max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS,
+        max_in_flight_bytes=DEFAULT_MAX_IN_FLIGHT_BYTES,
+        multipart_threshold=DEFAULT_MULTIPART_THRESHOLD,
+        max_attempts=DEFAULT_MAX_ATTEMPTS,
+    ):
+        # The client should be configured without botocore retries, as the scheduler retries requests
+        self.s3_client = s3_client
+        self.multipart_threshold = multipart_threshold
+        self.max_attempts = max_attempts
+        self.copied_bytes = 0
+        self.retry_count = 0
+        self._lock = threading.Lock()
+        self._budget = ByteBudget(max_in_flight_bytes)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_requests)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _submit(self, request, nbytes, on_success, on_failure, attempt=1):
+        """Runs request() on the pool, retrying it if it fails with a retryable error."""
+
+        def run():
+            reserved = self._budget.acquire(nbytes)
+            try:
+                result = request()
+            except Exception as exc:
+                if is_retryable_error(exc) and attempt < self.max_attempts:
+                    with self._lock:
+                        self.retry_count += 1
+                    timer = threading.Timer(
+                        backoff_seconds(attempt),
+                        self._resubmit,
+                        (request, nbytes, on_success, on_failure, attempt + 1),
+                    )
+                    timer.daemon = True
+                    timer.start()
+                else:
+                    on_failure(exc)
+                return
+            finally:
+                self._budget.release(reserved)
+            with self._lock:
+                self.copied_bytes += nbytes
+            try:
+                on_success(result)
+            except Exception as exc:
+                # The executor would swallow the exception, leaving the caller's Future unresolved
+                on_failure(exc)
+
+        self._executor.submit(run)
+
+    def _resubmit(self, request, nbytes, on_success, on_failure, attempt):
+        try:
+            self._submit(request, nbytes, on_success, on_failure, attempt)
+        except RuntimeError as exc:
+            # The scheduler was shut down while waiting to retry
+            on_failure(exc)
+
+    def copy(self, source_bucket, source_key, source_etag, size, bucket, key):
+        """Copies the source object, which must match source_etag, to the key. Returns a Future."""
+        future = Future()
+        copy_source = {"Bucket": source_bucket, "Key": source_key}
+        if size < self.multipart_threshold:
+            self._submit(
+                lambda: self.s3_client.copy_object(
+                    CopySource=copy_source,
+                    CopySourceIfMatch=source_etag,
+                    Bucket=bucket,
+                    Key=key,
+                    MetadataDirective="REPLACE",
+                    TaggingDirective="REPLACE",
+                ),
+                size,
+                lambda result: future.set_result(None),
+                future.set_exception,
+            )
+        else:
+            self._submit(
+                lambda: self.s3_client.create_multipart_upload(Bucket=bucket, Key=key),
+                0,
+                lambda result: self._copy_parts(
+                    future, copy_source, source_etag, size, bucket, key, result["UploadId"]
+                ),
+                future.set_exception,
+            )
+        return future
+
+    def _copy_parts(self, future, copy_source, source_etag, size, bucket, key, upload_id):
+        part_size = part_size_for(size)
+        part_count = math.ceil(size / part_size)
+        part_etags = [None] * part_count
+        state = {"remaining": part_count, "failed": False}
+
+        def abort(exc):
+            with self._lock:
+                if state["failed"]:
+                    return
+                state["failed"] = True
+            try:
+                self.s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            finally:
+                future.set_exception(exc)
+
+        def on_part_copied(part_number, result):
+            part_etags[part_number - 1] = result["CopyPartResult"]["ETag"]
+            with self._lock:
+                state["remaining"] -= 1
+                all_copied = state["remaining"] == 0 and not state["failed"]
+            if all_copied:
+                self._submit(
+                    lambda: self.s3_client.complete_multipart_upload(
+                        Bucket=bucket,
+                        Key=key,
+                        UploadId=upload_id,
+                        MultipartUpload={
+                            "Parts": [
+                                {"PartNumber": i + 1, "ETag": etag}
+                                for i, etag in enumerate(part_etags)
+                            ]
+                        },
+                    ),
+                    0,
+                    lambda result: future.set_result(None),
+                    abort,
+                )
+
+        for part_number in range(1, part_count + 1):
+            start = (part_number - 1) * part_size
+            end = min(start + part_size, size)
+            self._submit(
+                lambda part_number=part_number, start=start, end=end: self.s3_client.upload_part_copy(
+                    CopySource=copy_source,
+                    CopySourceIfMatch=source_etag,
+                    CopySourceRange=f"bytes={start}-{end - 1}",
+                    Bucket=bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=part_number,
+                ),
+                end - start,
+                lambda result, part_number=part_number: on_part_copied(part_number, result),
+                abort,
+            )
@@ -0,0 +1,360 @@
+"""
+Uploads S3 objects into the job attachments content-addressable storage (CAS) in the same
+pass that hashes them.
+
+Without it, an object that has no hash yet is read twice: once by HashObjects to compute
+the hash, and again by the server-side copy of CopyObjects. The FusedUploader streams the
+object once, feeding each chunk both to the hasher and to a multipart upload to a temporary
+key in the job attachments bucket. The CAS key depends on the hash, so it's only known at
+the end. The upload is then completed and moved to the CAS key with a server-side copy, or
+aborted if the CAS already has the hash. Objects smaller than one part are read into memory
+and put directly at their CAS key.
+
+The chunks of an object are gathered into parts, and the parts are uploaded concurrently on a
+pool of threads, so hashing and reading continue while the parts upload. A budget of bytes in
+flight bounds the memory that the parts waiting to upload hold.
+
+Objects whose hash is already known, from the hash cache or an object tag, are copied
+server-side when the CAS does not have them yet. Each hash is handled once per task: the first
+object with the hash claims it, and the other objects with the same content wait until it's
+in the CAS. If putting it there fails, the next object with the hash claims it instead.
+
+A task that is killed after completing an upload and before deleting its temporary object
+leaves that object behind, so sweep_stale_temporary_objects() deletes the temporary objects
+that are older than any upload still in progress could be.
+"""
+
+import datetime
+import math
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from xxhash import xxh3_128
+
+from cas_existence import CasExistenceOracle, cas_key
+from copy_scheduler import ByteBudget
+from instrumentation import timed
+
+MIB = 1024 * 1024
+DEFAULT_PART_SIZE = 16 * MIB
+# S3 limits on the parts of a multipart upload
+MIN_PART_SIZE = 5 * MIB
+MAX_PART_COUNT = 10_000
+DEFAULT_UPLOAD_CONCURRENCY = 16
+DEFAULT_MAX_UPLOAD_IN_FLIGHT_BYTES = 16 * DEFAULT_PART_SIZE
+TEMPORARY_KEY_PREFIX = "tmp/copy-s3-prefix-"
+# Temporary objects older than this are left over from killed tasks
+STALE_TEMPORARY_OBJECT_SECONDS = 24 * 60 * 60
+
+
+class FusedUploader:
+    """
+    Hashes objects while uploading them into the CAS, and copies objects with known hashes
+    into the CAS. The methods are safe to call from multiple threads. Call shutdown() at the end.
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        ja_s3_bucket_name,
+        ja_root_prefix,
+        copy_scheduler,
+        *,
+        part_size=DEFAULT_PART_SIZE,
+        upload_concurrency=DEFAULT_UPLOAD_CONCURRENCY,
+        max_upload_in_flight_bytes=DEFAULT_MAX_UPLOAD_IN_FLIGHT_BYTES,
+        instrumentation=None,
+    ):
+        self.s3_client = s3_client
+        self.instrumentation = instrumentation
+        self.ja_s3_bucket_name = ja_s3_bucket_name
+        self.ja_root_prefix = ja_root_prefix
+        self.copy_scheduler = copy_scheduler
+        self.part_size = max(MIN_PART_SIZE, part_size)
+        # The hashes are not known in advance, so every existence check is a HeadObject
+        self.cas_existence = CasExistenceOracle(
+            s3_client, ja_s3_bucket_name, ja_root_prefix, ()
+        )
+        self.uploaded_object_count = 0
+        self.uploaded_bytes_count = 0
+        self.copied_object_count = 0
+        self._lock = threading.Lock()
+        # For each hash claimed by an object, a Future that is done when it's in the CAS
+        self._claims = {}
+        self._upload_budget = ByteBudget(max_upload_in_flight_bytes)
+        self._upload_executor = ThreadPoolExecutor(max_workers=upload_concurrency)
+
+    def shutdown(self):
+        self._upload_executor.shutdown(wait=True)
+
+    def _claim(self, xxh128_hash):
+        """
+        Returns (claimed, claim). If claimed is True, the caller puts the hash into the CAS and then
+        calls _settle(). Otherwise, the claim is a Future that is done when the hash is in the CAS,
+        or fails when the caller that claimed it failed to put it there.
+        """
+        with self._lock:
+            claim = self._claims.get(xxh128_hash)
+            if claim is None:
+                claim = self._claims[xxh128_hash] = Future()
+                return True, claim
+            return False, claim
+
+    def _claim_or_wait(self, xxh128_hash):
+        """Returns True once the caller claims the hash, or False once another caller put it into the CAS."""
+        while True:
+            claimed, claim = self._claim(xxh128_hash)
+            if claimed:
+                return True
+            if claim.exception() is None:
+                return False
+
+    def _settle(self, xxh128_hash, exc=None):
+        """Records that the claimed hash is in the CAS, or if exc is provided, that putting it there failed."""
+        with self._lock:
+            claim = self._claims[xxh128_hash]
+            if exc is not None:
+                # Let the next object with the hash claim it
+                del self._claims[xxh128_hash]
+        if exc is None:
+            claim.set_result(None)
+        else:
+            claim.set_exception(exc)
+
+    def _abort_upload(self, temporary_key, upload_id):
+        self.s3_client.abort_multipart_upload(
+            Bucket=self.ja_s3_bucket_name, Key=temporary_key, UploadId=upload_id
+        )
+
+    def _temporary_key(self):
+        return f"{self.ja_root_prefix}/{TEMPORARY_KEY_PREFIX}{uuid.uuid4().hex}"
+
+    def sweep_stale_temporary_objects(self, max_age_seconds=STALE_TEMPORARY_OBJECT_SECONDS):
+        """Deletes the temporary objects that killed tasks left behind. Returns how many it deleted."""
+        cutoff = datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(
+            seconds=max_age_seconds
+        )
+        deleted_count = 0
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            Bucket=self.ja_s3_bucket_name, Prefix=f"{self.ja_root_prefix}/{TEMPORARY_KEY_PREFIX}"
+        ):
+            for obj in page.get("Contents", []):
+                if obj["LastModified"] < cutoff:
+                    self.s3_client.delete_object(Bucket=self.ja_s3_bucket_name, Key=obj["Key"])
+                    deleted_count += 1
+        return deleted_count
+
+    def hash_and_upload(self, bucket, key, etag, size, ranged_hasher=None):
+        """
+        Reads the object once to hash it and upload it into the CAS. Returns (hexdigest, metadata),
+        where metadata is the user-defined metadata of the object. If ranged_hasher is provided,
+        the object is read with its concurrent ranged GETs.
+        """
+        if size < self.part_size:
+            return self._hash_and_put(bucket, key, etag)
+
+        # Use larger parts when needed to stay within the limit on the number of parts
+        part_size = max(self.part_size, math.ceil(size / MAX_PART_COUNT / MIB) * MIB)
+        temporary_key = self._temporary_key()
+        upload_id = self.s3_client.create_multipart_upload(
+            Bucket=self.ja_s3_bucket_name, Key=temporary_key
+        )["UploadId"]
+        part_futures = []
+        part_errors = []
+        buffer = bytearray()
+
+        def submit_part(data):
+            # Stop reading the object as soon as a part fails
+            if part_errors:
+                raise part_errors[0]
+            # Number the part when it's submitted, because the parts finish uploading in any order
+            part_number = len(part_futures) + 1
+            nbytes = self._upload_budget.acquire(len(data))
+
+            def on_part_done(future):
+                self._upload_budget.release(nbytes)
+                if not future.cancelled() and future.exception() is not None:
+                    part_errors.append(future.exception())
+
+            try:
+                future = self._upload_executor.submit(
+                    self._upload_part, temporary_key, upload_id, part_number, data
+                )
+            except BaseException:
+                self._upload_budget.release(nbytes)
+                raise
+            future.add_done_callback(on_part_done)
+            part_futures.append(future)
+
+        def on_data(data):
+            if not buffer and len(data) == part_size:
+                # A range of the ranged hasher is usually a whole part
+                submit_part(data)
+                return
+            buffer.extend(data)
+            while len(buffer) >= part_size:
+                submit_part(bytes(buffer[:part_size]))
+                del buffer[:part_size]
+
+        try:
+            if ranged_hasher is not None:
+                xxh128_hash, metadata = ranged_hasher.hash_object(
+                    bucket, key, etag, size, on_range=on_data
+                )
+            else:
+                hasher = xxh3_128()
+                response = self.s3_client.get_object(Bucket=bucket, Key=key, IfMatch=etag)
+                metadata = response["Metadata"]
+                for chunk in response["Body"].iter_chunks(MIB):
+                    with timed(self.instrumentation, "xxh128"):
+                        hasher.update(chunk)
+                    on_data(chunk)
+                xxh128_hash = hasher.hexdigest()
+            if buffer:
+                submit_part(bytes(buffer))
+                buffer.clear()
+            parts = sorted((future.result() for future in part_futures), key=lambda part: part["PartNumber"])
+        except BaseException:
+            # Let the parts that are uploading finish, so that none of them outlives the abort
+            for future in part_futures:
+                future.cancel()
+            wait(part_futures)
+            self._abort_upload(temporary_key, upload_id)
+            raise
+
+        if not self._claim_or_wait(xxh128_hash):
+            self._abort_upload(temporary_key, upload_id)
+            return xxh128_hash, metadata
+        try:
+            try:
+                if self.cas_existence.exists(xxh128_hash):
+                    self._abort_upload(temporary_key, upload_id)
+                    response = None
+                else:
+                    response = self.s3_client.complete_multipart_upload(
+                        Bucket=self.ja_s3_bucket_name,
+                        Key=temporary_key,
+                        UploadId=upload_id,
+                        MultipartUpload={"Parts": parts},
+                    )
+            except BaseException:
+                self._abort_upload(temporary_key, upload_id)
+                raise
+            if response is not None:
+                self._move_to_cas(temporary_key, response["ETag"], size, xxh128_hash)
+        except BaseException as exc:
+            self._settle(xxh128_hash, exc)
+            raise
+        self._settle(xxh128_hash)
+        return xxh128_hash, metadata
+
+    def _move_to_cas(self, temporary_key, etag, size, xxh128_hash):
+        # S3 has no rename, so move the temporary object to its CAS key with a server-side copy
+        try:
+            self.copy_scheduler.copy(
+                self.ja_s3_bucket_name,
+                temporary_key,
+                etag,
+                size,
+                self.ja_s3_bucket_name,
+                cas_key(self.ja_root_prefix, xxh128_hash),
+            ).result()
+        finally:
+            self.s3_client.delete_object(Bucket=self.ja_s3_bucket_name, Key=temporary_key)
+        with self._lock:
+            self.uploaded_object_count += 1
+            self.uploaded_bytes_count += size
+
+    def _upload_part(self, temporary_key, upload_id, part_number, data):
+        response = self.s3_client.upload_part(
+            Bucket=self.ja_s3_bucket_name,
+            Key=temporary_key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=data,
+        )
+        return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+    def _hash_and_put(self, bucket, key, etag):
+        response = self.s3_client.get_object(Bucket=bucket, Key=key, IfMatch=etag)
+        data = response["Body"].read()
+        with timed(self.instrumentation, "xxh128"):
+            xxh128_hash = xxh3_128(data).hexdigest()
+        if self._claim_or_wait(xxh128_hash):
+            try:
+                if not self.cas_existence.exists(xxh128_hash):
+                    self.s3_client.put_object(
+                        Bucket=self.ja_s3_bucket_name,
+                        Key=cas_key(self.ja_root_prefix, xxh128_hash),
+                        Body=data,
+                    )
+                    with self._lock:
+                        self.uploaded_object_count += 1
+                        self.uploaded_bytes_count += len(data)
+            except BaseException as exc:
+                self._settle(xxh128_hash, exc)
+                raise
+            self._settle(xxh128_hash)
+        return xxh128_hash, response["Metadata"]
+
+    def copy_if_missing(self, bucket, key, etag, size, xxh128_hash):
+        """
+        Copies an object with a known hash into the CAS, if it's not there already. Returns a Future
+        that is done when the copy is complete, or None if no copy was needed.
+        """
+        claimed, claim = self._claim(xxh128_hash)
+        if not claimed:
+            if claim.done() and claim.exception() is None:
+                return None
+            return self._copy_after_claim(claim, bucket, key, etag, size, xxh128_hash)
+        try:
+            if self.cas_existence.exists(xxh128_hash):
+                self._settle(xxh128_hash)
+                return None
+            future = self.copy_scheduler.copy(
+                bucket, key, etag, size, self.ja_s3_bucket_name, cas_key(self.ja_root_prefix, xxh128_hash)
+            )
+        except BaseException as exc:
+            self._settle(xxh128_hash, exc)
+            raise
+
+        def on_copied(future):
+            self._settle(xxh128_hash, future.exception())
+            if future.exception() is None:
+                with self._lock:
+                    self.copied_object_count += 1
+
+        future.add_done_callback(on_copied)
+        return future
+
+    def _copy_after_claim(self, claim, bucket, key, etag, size, xxh128_hash):
+        """
+        Returns a Future that is done when another object with the same hash is in the CAS. If
+        putting that one there fails, this object is copied instead.
+        """
+        future = Future()
+
+        def on_copied(copy_future):
+            if copy_future.exception() is not None:
+                future.set_exception(copy_future.exception())
+            else:
+                future.set_result(None)
+
+        def on_claim_done(claim):
+            if claim.exception() is None:
+                future.set_result(None)
+                return
+            try:
+                copy_future = self.copy_if_missing(bucket, key, etag, size, xxh128_hash)
+            except BaseException as exc:
+                future.set_exception(exc)
+                return
+            if copy_future is None:
+                future.set_result(None)
+            else:
+                copy_future.add_done_callback(on_copied)
+
+        claim.add_done_callback(on_claim_done)
+        return future
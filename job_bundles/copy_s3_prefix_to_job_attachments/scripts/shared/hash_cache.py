@@ -0,0 +1,116 @@
+"""
+A persistent local cache of the job attachments hashes of S3 objects.
+
+Getting the hash of an object that is already tagged still costs an s3:GetObjectTagging
+and an s3:HeadObject call. When the same prefixes are snapshotted repeatedly, the
+HashCache saves these calls by remembering the hash and POSIX mtime of each object in
+an SQLite database on local disk. An entry is only used when the object's etag matches,
+so a changed object is always hashed again.
+
+Multiple tasks on the same host can share the database file. Entries that have not been
+used for max_age_days are evicted, and then the least recently used entries beyond
+max_entries.
+"""
+
+import sqlite3
+import threading
+import time
+
+DEFAULT_MAX_AGE_DAYS = 30
+DEFAULT_MAX_ENTRIES = 50_000_000
+# How many pending changes to accumulate before writing them to the database
+FLUSH_BATCH_SIZE = 10_000
+
+
+class HashCache:
+    """
+    Maps (bucket, key, etag) to (xxh128_hash, mtime). The methods are safe to call from
+    multiple threads.
+    """
+
+    def __init__(self, path, *, max_age_days=DEFAULT_MAX_AGE_DAYS, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_age_days = max_age_days
+        self.max_entries = max_entries
+        self.hit_count = 0
+        self.miss_count = 0
+        self._lock = threading.Lock()
+        self._pending_stores = []
+        self._pending_hits = []
+        self._now = int(time.time())
+        self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        # Write-ahead logging lets tasks on the same host read while another one writes
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """CREATE TABLE IF NOT EXISTS object_hashes (
+                bucket TEXT NOT NULL,
+                key TEXT NOT NULL,
+                etag TEXT NOT NULL,
+                xxh128_hash TEXT NOT NULL,
+                mtime INTEGER NOT NULL,
+                last_used INTEGER NOT NULL,
+                PRIMARY KEY (bucket, key)
+            ) WITHOUT ROWID"""
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS object_hashes_last_used ON object_hashes (last_used)"
+        )
+        self._connection.commit()
+
+    def lookup(self, bucket, key, etag):
+        """Returns (xxh128_hash, mtime) for the object, or None if it's not in the cache."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT xxh128_hash, mtime FROM object_hashes WHERE bucket = ? AND key = ? AND etag = ?",
+                (bucket, key, etag),
+            ).fetchone()
+            if row is None:
+                self.miss_count += 1
+                return None
+            self.hit_count += 1
+            self._pending_hits.append((self._now, bucket, key))
+            if len(self._pending_hits) >= FLUSH_BATCH_SIZE:
+                self._flush()
+            return row
+
+    def store(self, bucket, key, etag, xxh128_hash, mtime):
+        """Saves the hash and mtime of the object, replacing any entry for a previous etag."""
+        with self._lock:
+            self._pending_stores.append((bucket, key, etag, xxh128_hash, mtime, self._now))
+            if len(self._pending_stores) >= FLUSH_BATCH_SIZE:
+                self._flush()
+
+    def _flush(self):
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO object_hashes VALUES (?, ?, ?, ?, ?, ?)",
+                self._pending_stores,
+            )
+            self._connection.executemany(
+                "UPDATE object_hashes SET last_used = ? WHERE bucket = ? AND key = ?",
+                self._pending_hits,
+            )
+        self._pending_stores = []
+        self._pending_hits = []
+
+    def close(self):
+        """Writes the pending changes, evicts old entries, and returns the number evicted."""
+        with self._lock:
+            self._flush()
+            with self._connection:
+                evicted_count = self._connection.execute(
+                    "DELETE FROM object_hashes WHERE last_used < ?",
+                    (self._now - self.max_age_days * 24 * 60 * 60,),
+                ).rowcount
+                (entry_count,) = self._connection.execute(
+                    "SELECT COUNT(*) FROM object_hashes"
+                ).fetchone()
+                if entry_count > self.max_entries:
+                    evicted_count += self._connection.execute(
+                        """DELETE FROM object_hashes WHERE (bucket, key) IN (
+                            SELECT bucket, key FROM object_hashes ORDER BY last_used LIMIT ?
+                        )""",
+                        (entry_count - self.max_entries,),
+                    ).rowcount
+            self._connection.close()
+            return evicted_count
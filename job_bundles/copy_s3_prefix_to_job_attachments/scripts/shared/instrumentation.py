@@ -0,0 +1,240 @@
+"""
+Per-request instrumentation for the scripts of the copy job.
+
+The Instrumentation hooks the botocore events of the clients it's attached to, and records
+the latency of every API call in a histogram per operation, along with errors, retries,
+throttling responses and the bytes sent and received. Sections of local work, like
+hashing, are timed with timed(), which records both the wall clock time and the CPU time
+of the thread.
+
+At the end of a task, report() prints a one-line summary as openjd_status with a table of
+the details, and writes a JSON profile into the workspace, so the tasks of a job, or of
+different jobs, can be compared.
+"""
+
+import bisect
+import contextlib
+import json
+import os
+import resource
+import socket
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+from s3_concurrency import is_throttle_response
+
+# The upper bounds, in milliseconds, of the latency histogram buckets. The last bucket has no upper bound.
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
+PROFILES_DIRNAME = "profiles"
+
+
+class _OperationStats:
+    def __init__(self):
+        self.count = 0
+        self.error_count = 0
+        self.retry_count = 0
+        self.throttle_count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def percentile_ms(self, fraction):
+        """Returns the upper bound of the histogram bucket that contains the percentile, at most the maximum."""
+        max_ms = round(self.max_seconds * 1000, 1)
+        target = fraction * self.count
+        cumulative = 0
+        for bound, bucket_count in zip(LATENCY_BUCKETS_MS, self.histogram):
+            cumulative += bucket_count
+            if cumulative >= target:
+                return min(bound, max_ms)
+        return max_ms
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "errors": self.error_count,
+            "retries": self.retry_count,
+            "throttles": self.throttle_count,
+            "total_seconds": round(self.total_seconds, 6),
+            "mean_ms": round(1000 * self.total_seconds / self.count, 3) if self.count else 0,
+            "max_ms": round(1000 * self.max_seconds, 3),
+            "p50_ms": self.percentile_ms(0.5),
+            "p90_ms": self.percentile_ms(0.9),
+            "p99_ms": self.percentile_ms(0.99),
+            "histogram_ms": {
+                f"<={bound}" if i < len(LATENCY_BUCKETS_MS) else f">{LATENCY_BUCKETS_MS[-1]}": count
+                for i, (bound, count) in enumerate(zip(LATENCY_BUCKETS_MS + [None], self.histogram))
+                if count
+            },
+        }
+
+
+class Instrumentation:
+    """
+    Collects timing for API calls and sections of local work. The methods are safe to call
+    from multiple threads.
+    """
+
+    def __init__(self):
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self._operations = defaultdict(_OperationStats)
+        self._timers = defaultdict(lambda: {"count": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0})
+        self._start_time = time.monotonic()
+
+    def attach(self, client):
+        """Records the API calls that the botocore client makes."""
+        events = client.meta.events
+        events.register("before-call", self._before_call)
+        events.register("before-send", self._before_send)
+        events.register("after-call", self._after_call)
+        events.register("after-call-error", self._after_call_error)
+        events.register("needs-retry", self._needs_retry)
+
+    @staticmethod
+    def _operation_name(model):
+        return f"{model.service_model.service_name}:{model.name}"
+
+    def _before_call(self, model, params, context, **kwargs):
+        # The after-call-error event has no model, so keep the operation name in the request context
+        context["instrumentation_operation"] = self._operation_name(model)
+        context["instrumentation_start_time"] = time.perf_counter()
+
+    def _before_send(self, request, **kwargs):
+        # Count the body of the prepared request, because at before-call time a streamed body,
+        # like the file object of an upload, is not read yet. With aws-chunked encoding, the
+        # decoded length is the size of the body without the chunk framing. A body of unknown
+        # length, sent with chunked transfer encoding, is not counted.
+        length = request.headers.get("X-Amz-Decoded-Content-Length") or request.headers.get("Content-Length")
+        if length:
+            with self._lock:
+                self.bytes_sent += int(length)
+
+    def _record_call(self, context, error, retry_count=0, response_bytes=0):
+        start_time = context.get("instrumentation_start_time")
+        if start_time is None:
+            return
+        seconds = time.perf_counter() - start_time
+        bucket = bisect.bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)
+        with self._lock:
+            stats = self._operations[context["instrumentation_operation"]]
+            stats.count += 1
+            stats.error_count += error
+            stats.retry_count += retry_count
+            stats.total_seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.histogram[bucket] += 1
+            self.bytes_received += response_bytes
+
+    def _after_call(self, http_response, parsed, context, **kwargs):
+        # For streaming operations like GetObject, the content length is the size of the body
+        # that the caller reads after the call returns.
+        self._record_call(
+            context,
+            error=http_response.status_code >= 300,
+            retry_count=parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0),
+            response_bytes=int(http_response.headers.get("content-length", 0)),
+        )
+
+    def _after_call_error(self, context, **kwargs):
+        self._record_call(context, error=True)
+
+    def _needs_retry(self, response, operation, **kwargs):
+        if response is not None and is_throttle_response(response[1]):
+            with self._lock:
+                self._operations[self._operation_name(operation)].throttle_count += 1
+
+    def add_time(self, name, wall_seconds, cpu_seconds):
+        with self._lock:
+            timer = self._timers[name]
+            timer["count"] += 1
+            timer["wall_seconds"] += wall_seconds
+            timer["cpu_seconds"] += cpu_seconds
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        """Records the wall clock and thread CPU time of the code in the with block under the name."""
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+
+    def profile(self):
+        """Returns the collected data as a JSON-serializable dict."""
+        with self._lock:
+            operations = {
+                name: stats.as_dict() for name, stats in sorted(self._operations.items())
+            }
+            timers = {
+                name: {
+                    "count": timer["count"],
+                    "wall_seconds": round(timer["wall_seconds"], 6),
+                    "cpu_seconds": round(timer["cpu_seconds"], 6),
+                }
+                for name, timer in sorted(self._timers.items())
+            }
+            bytes_sent = self.bytes_sent
+            bytes_received = self.bytes_received
+        return {
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "wall_seconds": round(time.monotonic() - self._start_time, 6),
+            "process_cpu_seconds": round(time.process_time(), 6),
+            # On Linux, ru_maxrss is in KiB
+            "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "bytes_sent": bytes_sent,
+            "bytes_received": bytes_received,
+            "operations": operations,
+            "timers": timers,
+        }
+
+    def report(self, workspace_path: Path, step_name, task_index=None):
+        """Prints a summary of the collected data, and saves the JSON profile into the workspace."""
+        profile = self.profile()
+        profile["step"] = step_name
+        profile["task_index"] = task_index
+
+        operations = profile["operations"]
+        request_count = sum(op["count"] for op in operations.values())
+        slowest = sorted(operations.items(), key=lambda item: -item[1]["total_seconds"])[:3]
+        print(
+            f"openjd_status: {request_count} API calls in {profile['wall_seconds']:.1f}s, most time in "
+            + ", ".join(
+                f"{name.split(':')[1]} ({op['count']} calls, p50 {op['p50_ms']}ms, p99 {op['p99_ms']}ms)"
+                for name, op in slowest
+            )
+        )
+        print("API call timing:")
+        for name, op in operations.items():
+            print(
+                f"  {name:40s} {op['count']:9d} calls {op['total_seconds']:10.2f}s total {op['mean_ms']:9.1f}ms mean "
+                f"{op['p50_ms']:6}ms p50 {op['p99_ms']:6}ms p99 {op['max_ms']:9.1f}ms max "
+                f"{op['errors']} errors {op['retries']} retries {op['throttles']} throttles"
+            )
+        for name, timer in profile["timers"].items():
+            print(
+                f"  {name:40s} {timer['count']:9d} times {timer['wall_seconds']:10.2f}s wall {timer['cpu_seconds']:10.2f}s CPU"
+            )
+        print(
+            f"Sent {profile['bytes_sent']} bytes and received {profile['bytes_received']} bytes, "
+            f"{profile['process_cpu_seconds']:.1f}s process CPU, {profile['peak_rss_bytes'] / 1024**2:.1f}MiB peak RSS"
+        )
+
+        profiles_dir = Path(workspace_path) / PROFILES_DIRNAME
+        profiles_dir.mkdir(parents=True, exist_ok=True)
+        filename = step_name if task_index is None else f"{step_name}_{task_index}"
+        with open(profiles_dir / f"{filename}.json", "w") as fh:
+            json.dump(profile, fh, indent=1)
+        print(f"Saved the profile to {profiles_dir / filename}.json")
+
+
+def timed(instrumentation, name):
+    """Returns instrumentation.timed(name), or a context manager that does nothing if instrumentation is None."""
+    if instrumentation is None:
+        return contextlib.nullcontext()
+    return instrumentation.timed(name)
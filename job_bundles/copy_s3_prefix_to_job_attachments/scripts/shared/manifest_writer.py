@@ -0,0 +1,286 @@
+"""
+Writes job attachments manifests to S3 as a stream, with bounded memory.
+
+The manifest format is the canonical JSON encoding of the v2023-03-03 asset manifest from
+the deadline package, AssetManifest.encode(). That encoding sorts the object keys and the
+paths, and writes no whitespace, so it can be produced one path at a time from paths that
+are already sorted with manifest_path_sort_key. The output goes to S3 through a
+multipart upload, so neither the paths nor the encoded manifest are ever all in memory.
+
+For very large prefixes, the paths can instead be split into several manifests, each with a
+contiguous range of the sorted paths, either by top-level directory or by size, and a small
+index that lists them. A consumer that only needs some of the paths then only downloads the
+manifests that have them. The manifests are written concurrently in threads, while the main
+thread passes each one its paths in batches through a bounded queue.
+"""
+
+import itertools
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+MIB = 1024 * 1024
+DEFAULT_UPLOAD_PART_SIZE = 16 * MIB
+# S3 requires all the parts of a multipart upload, except the last, to be at least this big
+MIN_UPLOAD_PART_SIZE = 5 * MIB
+
+MANIFEST_VERSION = "2023-03-03"
+HASH_ALG = "xxh128"
+
+PARTITIONINGS = ["None", "TopLevelDirectory", "Size"]
+# With the Size partitioning, start a new manifest when the current one is about this big
+DEFAULT_PARTITION_SIZE = 64 * MIB
+DEFAULT_PARTITION_CONCURRENCY = 8
+# The number of paths to pass from the main thread to the thread writing a manifest at a time
+PARTITION_BATCH_SIZE = 2048
+# How many batches can wait for each thread writing a manifest
+PARTITION_QUEUE_SIZE = 4
+# The encoded size of a path entry in a manifest, apart from the path and the digits of the numbers
+_PATH_ENTRY_OVERHEAD = 80
+
+
+def manifest_path_sort_key(path):
+    """
+    Returns the sort key for a manifest path. The canonical encoding sorts the paths by their
+    UTF-16 code units, which differs from Python's code point order for some characters.
+    """
+    # Use the "surrogatepass" error handler because filenames encountered in the wild
+    # include surrogates.
+    return path.encode("utf-16_be", errors="surrogatepass")
+
+
+class MultipartUploadWriter:
+    """
+    A writable binary file object that uploads what's written to an S3 object, one part at a
+    time. Use it as a context manager, so the upload is completed on success and aborted on
+    an exception. Data smaller than one part is uploaded with a single s3:PutObject.
+    """
+
+    def __init__(self, s3_client, bucket, key, part_size=DEFAULT_UPLOAD_PART_SIZE):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(MIN_UPLOAD_PART_SIZE, part_size)
+        self.size = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def write(self, data):
+        self._buffer += data
+        self.size += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[: self.part_size]))
+            del self._buffer[: self.part_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _upload_part(self, data):
+        if self._upload_id is None:
+            self._upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key
+            )["UploadId"]
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=len(self._parts) + 1,
+            Body=data,
+        )
+        self._parts.append({"PartNumber": len(self._parts) + 1, "ETag": response["ETag"]})
+
+    def close(self):
+        if self._upload_id is None:
+            self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer))
+            return
+        if self._buffer:
+            self._upload_part(bytes(self._buffer))
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            MultipartUpload={"Parts": self._parts},
+        )
+
+    def abort(self):
+        if self._upload_id is not None:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_manifest(fileobj, paths):
+    """
+    Writes the canonical encoding of a manifest to a writable binary file object. The paths are
+    (path, xxh128_hash, mtime, size) tuples, already sorted with manifest_path_sort_key.
+    Returns the number of paths and their total size.
+    """
+    path_count = 0
+    total_size = 0
+    # The keys are in sorted order, and the paths come before the total size
+    fileobj.write(
+        f'{{"hashAlg":"{HASH_ALG}","manifestVersion":"{MANIFEST_VERSION}","paths":['.encode("ascii")
+    )
+    chunk = []
+    for path, xxh128_hash, mtime, size in paths:
+        if path_count:
+            chunk.append(",")
+        chunk.append(
+            f'{{"hash":{json.dumps(xxh128_hash)},"mtime":{mtime},"path":{json.dumps(path)},"size":{size}}}'
+        )
+        path_count += 1
+        total_size += size
+        # Write in batches, as many small writes are slow
+        if len(chunk) >= 2048:
+            fileobj.write("".join(chunk).encode("ascii"))
+            chunk = []
+    chunk.append(f'],"totalSize":{total_size}}}')
+    fileobj.write("".join(chunk).encode("ascii"))
+    return path_count, total_size
+
+
+def top_level_directory(path):
+    """Returns the top-level directory of a manifest path, or None for a file at the top level."""
+    directory, separator, _ = path.partition("/")
+    return directory if separator else None
+
+
+def partition_manifest_paths(paths, partitioning, partition_size=DEFAULT_PARTITION_SIZE):
+    """
+    Splits sorted (path, xxh128_hash, mtime, size) tuples into partitions of contiguous paths. Yields
+    (directory, paths) for each partition, where paths is an iterator that must be consumed before
+    the next partition. With the TopLevelDirectory partitioning, each partition is one top-level
+    directory, and the files at the top level between two directories are a partition with a
+    directory of None. With the Size partitioning, the directory is always None.
+    """
+    if partitioning == "TopLevelDirectory":
+        for directory, partition_paths in itertools.groupby(paths, key=lambda entry: top_level_directory(entry[0])):
+            yield directory, partition_paths
+    elif partitioning == "Size":
+        # Estimate the encoded size of each path entry, without encoding it twice
+        partition_index = 0
+        encoded_size = 0
+
+        def partition_key(entry):
+            nonlocal partition_index, encoded_size
+            path, _, mtime, size = entry
+            entry_size = len(path) + len(str(mtime)) + len(str(size)) + _PATH_ENTRY_OVERHEAD
+            if encoded_size and encoded_size + entry_size > partition_size:
+                partition_index += 1
+                encoded_size = 0
+            encoded_size += entry_size
+            return partition_index
+
+        for _, partition_paths in itertools.groupby(paths, key=partition_key):
+            yield None, partition_paths
+    else:
+        raise ValueError(f"Unknown manifest partitioning {partitioning!r}")
+
+
+def _write_partition(open_fileobj, index, batches, aborted):
+    """Writes the paths that arrive in batches as the manifest of the 1-based partition index."""
+    summary = {"index": index, "firstPath": None, "lastPath": None}
+
+    def paths():
+        while True:
+            try:
+                batch = batches.get(timeout=1)
+            except queue.Empty:
+                if aborted.is_set():
+                    raise RuntimeError("Writing the manifests was aborted")
+                continue
+            if batch is None:
+                return
+            if summary["firstPath"] is None:
+                summary["firstPath"] = batch[0][0]
+            summary["lastPath"] = batch[-1][0]
+            yield from batch
+
+    with open_fileobj(index) as fileobj:
+        summary["pathCount"], summary["totalSize"] = write_manifest(fileobj, paths())
+    return summary
+
+
+def _put_batch(batches, batch, future):
+    """Puts a batch in the queue of the thread writing a manifest, raising its exception if it failed."""
+    # If the thread fails, it stops taking batches, so check on it while waiting
+    while True:
+        try:
+            batches.put(batch, timeout=1)
+            return
+        except queue.Full:
+            if future.done():
+                future.result()
+
+
+def write_partitioned_manifests(open_fileobj, partitions, concurrency=DEFAULT_PARTITION_CONCURRENCY):
+    """
+    Writes each partition from partition_manifest_paths() as a separate manifest, up to concurrency
+    of them at a time. open_fileobj(index) returns a context manager for the writable binary file
+    object of the 1-based partition index, like a MultipartUploadWriter. Returns a list with the index,
+    directory, first and last paths, path count and total size of each manifest.
+    """
+    slots = threading.BoundedSemaphore(concurrency)
+    aborted = threading.Event()
+    futures = []
+    directories = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        try:
+            for index, (directory, paths) in enumerate(partitions, start=1):
+                # Only start a manifest once a thread is free to write it
+                slots.acquire()
+                batches = queue.Queue(maxsize=PARTITION_QUEUE_SIZE)
+                future = executor.submit(_write_partition, open_fileobj, index, batches, aborted)
+                future.add_done_callback(lambda _: slots.release())
+                futures.append(future)
+                directories.append(directory)
+                while batch := list(itertools.islice(paths, PARTITION_BATCH_SIZE)):
+                    _put_batch(batches, batch, future)
+                # None marks the end of the paths
+                _put_batch(batches, None, future)
+        except BaseException:
+            aborted.set()
+            raise
+    summaries = [future.result() for future in futures]
+    for summary, directory in zip(summaries, directories):
+        summary["directory"] = directory
+    return summaries
+
+
+def write_manifest_index(fileobj, partitioning, manifests):
+    """
+    Writes the index of the manifests from write_partitioned_manifests(), with the S3 key of each,
+    as JSON to a writable binary file object. The manifests are in sorted path order, so a consumer
+    finds the manifest that has a path by the first and last paths, or by the top-level directory.
+    """
+    index = {
+        "hashAlg": HASH_ALG,
+        "manifestVersion": MANIFEST_VERSION,
+        "partitioning": partitioning,
+        "manifests": [
+            {
+                "key": manifest["key"],
+                "directory": manifest["directory"],
+                "firstPath": manifest["firstPath"],
+                "lastPath": manifest["lastPath"],
+                "pathCount": manifest["pathCount"],
+                "totalSize": manifest["totalSize"],
+            }
+            for manifest in manifests
+        ],
+        "pathCount": sum(manifest["pathCount"] for manifest in manifests),
+        "totalSize": sum(manifest["totalSize"] for manifest in manifests),
+    }
+    fileobj.write(json.dumps(index, separators=(",", ":")).encode("utf8"))
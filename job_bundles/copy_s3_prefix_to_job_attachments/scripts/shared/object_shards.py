@@ -0,0 +1,253 @@
+"""
+Streaming storage for the lists of S3 objects that the steps of the copy job
+pass to each other through the workspace.
+
+Each object is an S3Object, a record with __slots__ that takes a fraction of the memory
+of a dict. Each partition of objects is a shard file of compact binary records, that steps
+write as the objects are produced and read back one at a time through a memory map, so
+memory use stays bounded no matter how many objects are under the prefix. A record stores
+its key as the length of the prefix it shares with the previous key plus the rest of the
+key, and the etag and xxh128 hash as raw bytes when they have the usual hex form.
+"""
+
+import heapq
+import json
+import mmap
+import os
+import re
+import struct
+from pathlib import Path
+
+PARTITIONS_SUMMARY_FILENAME = "s3_objects_partitions.json"
+# How many objects to sort in memory at a time when merging shards
+DEFAULT_SORT_RUN_SIZE = 500_000
+
+# While reading a shard, release the pages of the memory map already read every this many bytes,
+# so the records read earlier don't stay resident
+READ_RELEASE_BYTES = 16 * 1024 * 1024
+
+# Each record starts with the length of the key prefix shared with the previous record, the
+# length of the rest of the key, the size, the mtime, and flags for the etag and hash that follow.
+_RECORD_HEADER = struct.Struct("<HHQqB")
+_PART_COUNT = struct.Struct("<I")
+_TEXT_LENGTH = struct.Struct("<H")
+# The etag is 16 bytes for the MD5 form '"<32 hex digits>"'
+_FLAG_MD5_ETAG = 1
+# The etag is 16 bytes and a part count for the multipart form '"<32 hex digits>-<part count>"'
+_FLAG_MULTIPART_ETAG = 2
+# The hash is 16 bytes
+_FLAG_BINARY_HASH = 4
+# The hash is text, in the unusual case that it's not 32 lowercase hex digits
+_FLAG_TEXT_HASH = 8
+_ETAG_RE = re.compile(r'"([0-9a-f]{32})(?:-([1-9][0-9]{0,8}))?"')
+_HASH_RE = re.compile(r"[0-9a-f]{32}")
+
+
+class S3Object:
+    """An object under the prefix. The xxh128_hash is None until HashObjects gets it."""
+
+    __slots__ = ("key", "size", "etag", "mtime", "xxh128_hash")
+
+    def __init__(self, key, size, etag, mtime, xxh128_hash=None):
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.mtime = mtime
+        self.xxh128_hash = xxh128_hash
+
+    @classmethod
+    def from_dict(cls, value):
+        return cls(value["key"], value["size"], value["etag"], value["mtime"], value.get("xxh128_hash"))
+
+    def to_dict(self):
+        """Returns the object as a dict for JSON, with the fields in the order that the object index uses."""
+        value = {"key": self.key, "size": self.size, "etag": self.etag, "mtime": self.mtime}
+        if self.xxh128_hash is not None:
+            value["xxh128_hash"] = self.xxh128_hash
+        return value
+
+    def __eq__(self, other):
+        if not isinstance(other, S3Object):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return f"S3Object({self.to_dict()!r})"
+
+
+def shard_path(workspace_path: Path, index: int) -> Path:
+    """Returns the path of the shard file for the 1-based partition index."""
+    return workspace_path / f"s3_objects_{index}.bin"
+
+
+def unchanged_shard_path(workspace_path: Path) -> Path:
+    """
+    Returns the path of the shard file for objects that are unchanged since the previous snapshot,
+    which skip the HashObjects and CopyObjects steps.
+    """
+    return workspace_path / "s3_objects_unchanged.bin"
+
+
+def read_shard(path: Path):
+    """Yields the objects of a shard file one at a time."""
+    with open(path, "rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return
+        # Reading through a memory map avoids copying the file into buffers
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset = 0
+            released = 0
+            end = len(data)
+            key = b""
+            while offset < end:
+                if offset - released >= READ_RELEASE_BYTES and hasattr(mmap, "MADV_DONTNEED"):
+                    release_end = offset - offset % mmap.PAGESIZE
+                    data.madvise(mmap.MADV_DONTNEED, released, release_end - released)
+                    released = release_end
+                shared_length, suffix_length, size, mtime, flags = _RECORD_HEADER.unpack_from(data, offset)
+                offset += _RECORD_HEADER.size
+                key = key[:shared_length] + data[offset : offset + suffix_length]
+                offset += suffix_length
+                if flags & (_FLAG_MD5_ETAG | _FLAG_MULTIPART_ETAG):
+                    etag = data[offset : offset + 16].hex()
+                    offset += 16
+                    if flags & _FLAG_MULTIPART_ETAG:
+                        etag = f'"{etag}-{_PART_COUNT.unpack_from(data, offset)[0]}"'
+                        offset += _PART_COUNT.size
+                    else:
+                        etag = f'"{etag}"'
+                else:
+                    (length,) = _TEXT_LENGTH.unpack_from(data, offset)
+                    offset += _TEXT_LENGTH.size
+                    etag = data[offset : offset + length].decode("utf8")
+                    offset += length
+                xxh128_hash = None
+                if flags & _FLAG_BINARY_HASH:
+                    xxh128_hash = data[offset : offset + 16].hex()
+                    offset += 16
+                elif flags & _FLAG_TEXT_HASH:
+                    (length,) = _TEXT_LENGTH.unpack_from(data, offset)
+                    offset += _TEXT_LENGTH.size
+                    xxh128_hash = data[offset : offset + length].decode("utf8")
+                    offset += length
+                yield S3Object(key.decode("utf8"), size, etag, mtime, xxh128_hash)
+
+
+class ShardWriter:
+    """
+    Writes objects to a shard file, one record per object. The data goes to a temporary
+    file that replaces the shard when the writer is closed, so readers only ever see
+    a complete shard, and a shard can be rewritten while it is being read.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.object_count = 0
+        self.total_size = 0
+        self._tmp_path = path.with_name(path.name + ".tmp")
+        self._fh = open(self._tmp_path, "wb")
+        self._previous_key = b""
+
+    def write(self, s3_object):
+        key = s3_object.key.encode("utf8")
+        # Keys are at most 1024 bytes, so the shared length fits in the header
+        shared_length = 0
+        max_shared_length = min(len(key), len(self._previous_key))
+        while shared_length < max_shared_length and key[shared_length] == self._previous_key[shared_length]:
+            shared_length += 1
+        self._previous_key = key
+
+        flags = 0
+        parts = [None, key[shared_length:]]
+        etag_match = _ETAG_RE.fullmatch(s3_object.etag)
+        if etag_match:
+            parts.append(bytes.fromhex(etag_match.group(1)))
+            if etag_match.group(2):
+                flags |= _FLAG_MULTIPART_ETAG
+                parts.append(_PART_COUNT.pack(int(etag_match.group(2))))
+            else:
+                flags |= _FLAG_MD5_ETAG
+        else:
+            etag = s3_object.etag.encode("utf8")
+            parts.append(_TEXT_LENGTH.pack(len(etag)))
+            parts.append(etag)
+        if s3_object.xxh128_hash is not None:
+            if _HASH_RE.fullmatch(s3_object.xxh128_hash):
+                flags |= _FLAG_BINARY_HASH
+                parts.append(bytes.fromhex(s3_object.xxh128_hash))
+            else:
+                flags |= _FLAG_TEXT_HASH
+                xxh128_hash = s3_object.xxh128_hash.encode("utf8")
+                parts.append(_TEXT_LENGTH.pack(len(xxh128_hash)))
+                parts.append(xxh128_hash)
+        parts[0] = _RECORD_HEADER.pack(
+            shared_length, len(key) - shared_length, s3_object.size, s3_object.mtime, flags
+        )
+        self._fh.write(b"".join(parts))
+        self.object_count += 1
+        self.total_size += s3_object.size
+
+    def close(self):
+        self._fh.close()
+        os.replace(self._tmp_path, self.path)
+
+    def discard(self):
+        self._fh.close()
+        os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def merge_shards(paths, key, run_directory: Path, run_size=DEFAULT_SORT_RUN_SIZE):
+    """
+    Yields the objects of all the shard files, sorted by key(s3_object). This is an external merge
+    sort, so only about run_size objects are in memory at once. Runs of up to run_size objects
+    are sorted and written to files in run_directory, and then merged.
+    """
+    run_paths = []
+    run = []
+    for path in paths:
+        for s3_object in read_shard(path):
+            run.append(s3_object)
+            if len(run) >= run_size:
+                run.sort(key=key)
+                run_path = run_directory / f"sort_run_{len(run_paths)}.bin"
+                with ShardWriter(run_path) as writer:
+                    for run_object in run:
+                        writer.write(run_object)
+                run_paths.append(run_path)
+                run = []
+    run.sort(key=key)
+    if not run_paths:
+        # Everything fit in one run, so there's nothing to merge
+        yield from run
+        return
+    yield from heapq.merge(run, *(read_shard(path) for path in run_paths), key=key)
+
+
+def write_partitions_summary(workspace_path: Path, writers, predicted_seconds):
+    """Saves the object count, total size and predicted time of each shard written by CollectObjects."""
+    partitions = [
+        {
+            "index": i + 1,
+            "object_count": w.object_count,
+            "total_size": w.total_size,
+            "predicted_seconds": seconds,
+        }
+        for i, (w, seconds) in enumerate(zip(writers, predicted_seconds))
+    ]
+    with open(workspace_path / PARTITIONS_SUMMARY_FILENAME, "w") as fh:
+        json.dump(partitions, fh)
+
+
+def read_partition_summary(workspace_path: Path, index: int):
+    """Loads the object count, total size and predicted time of the shard for the 1-based partition index."""
+    with open(workspace_path / PARTITIONS_SUMMARY_FILENAME) as fh:
+        return json.load(fh)[index - 1]
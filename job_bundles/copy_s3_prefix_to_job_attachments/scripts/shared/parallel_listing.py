@@ -0,0 +1,327 @@
+"""
+Lists the objects under a prefix with many concurrent s3:ListObjectsV2 calls, with exactly
+the same result as a single paginated listing.
+
+A single listing makes one request for every 1000 keys, one after another, so on a prefix
+with tens of millions of objects the request latency adds up to hours. The ParallelLister
+first lists the top directory levels of the prefix with Delimiter="/", which returns the
+objects directly in each directory along with its subdirectories. Then it lists the
+subdirectories concurrently as separate ranges. While a thread is idle, the unfinished range
+that has listed the most pages is split at a key halfway between its last listed key and its
+upper boundary, and the upper half is listed with StartAfter, so large flat directories are
+listed in parallel too.
+
+Each range is written to a temporary shard file as it is listed, and the lister yields the
+objects of the ranges in key order, so the caller sees the same sequence of objects as from
+a single listing, and memory use stays bounded.
+"""
+
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from object_shards import S3Object, ShardWriter, read_shard
+
+DEFAULT_LISTING_CONCURRENCY = 16
+# List this many directory levels below the prefix with a delimiter to find ranges
+DEFAULT_DISCOVERY_DEPTH = 1
+# Stop descending into directory levels once there are this many ranges per thread
+DISCOVERY_RANGES_PER_THREAD = 4
+# A directory with more than this many pages in a Delimiter="/" listing is listed as one
+# range instead, and split by the idle threads
+MAX_DISCOVERY_PAGES = 5
+# Only split ranges that have listed this many full pages, as a split costs an extra request
+MIN_PAGES_TO_SPLIT = 2
+# When splitting a range with no upper boundary, split the key space below this character.
+# Keys with a character above it still belong to the upper half.
+SPLIT_UPPER_CHAR = 0x7F
+# Split points don't use control characters
+SPLIT_LOWER_CHAR = 0x20
+
+
+def s3_object_from_listing(obj):
+    """Returns the object of a s3:ListObjectsV2 response in the form that the steps pass to each other."""
+    return S3Object(obj["Key"], obj["Size"], obj["ETag"], int(obj["LastModified"].timestamp() * 1e9))
+
+
+def key_between(low, high):
+    """
+    Returns a key that sorts after low and before high, roughly halfway between them, or None if
+    there is no suitable one. Keys are compared by code point, which is the same as the UTF-8 byte
+    order of S3 listings.
+    """
+    if low >= high:
+        return None
+    # The first character that differs, where low may have ended
+    position = 0
+    while position < len(low) and low[position] == high[position]:
+        position += 1
+    low_char = ord(low[position]) if position < len(low) else SPLIT_LOWER_CHAR - 1
+    high_char = ord(high[position])
+    result = high[:position]
+    # Past the first differing character, only low constrains the key
+    while True:
+        middle_char = (low_char + high_char) // 2
+        if low_char < middle_char and not 0xD800 <= middle_char <= 0xDFFF:
+            return result + chr(middle_char)
+        if position >= len(low) or low_char < SPLIT_LOWER_CHAR:
+            return None
+        result += low[position]
+        position += 1
+        low_char = ord(low[position]) if position < len(low) else SPLIT_LOWER_CHAR - 1
+        high_char = SPLIT_UPPER_CHAR + 1
+
+
+class _KeyRange:
+    """
+    The keys with the prefix after start_after, up to and including last. A start_after of None
+    is the start of the prefix, and a last of None is the end of the prefix.
+    """
+
+    def __init__(self, prefix, start_after, last, path):
+        self.prefix = prefix
+        self.start_after = start_after
+        self.last = last
+        self.path = path
+        # The last key listed so far, and whether there are more after it
+        self.listed_after = None
+        self.page_count = 0
+        self.truncated = True
+        self.next = None
+        self.done = threading.Event()
+
+
+class ParallelLister:
+    """
+    Lists the objects under prefix in the bucket, skipping the directory markers that end
+    in "/". Iterate over objects() to get them in S3 listing order. Use it as a context
+    manager, so the threads stop and the temporary files are removed at the end.
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        bucket,
+        prefix,
+        run_directory: Path,
+        concurrency=DEFAULT_LISTING_CONCURRENCY,
+        discovery_depth=DEFAULT_DISCOVERY_DEPTH,
+    ):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.run_directory = run_directory
+        self.concurrency = concurrency
+        self.discovery_depth = discovery_depth
+        self.range_count = 0
+        self.split_count = 0
+        self._lock = threading.Lock()
+        self._pending = []
+        self._active = []
+        self._stopping = False
+        self._exception = None
+        self._executor = None
+        self._first_range = None
+
+    def __enter__(self):
+        self.run_directory.mkdir(parents=True, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop()
+        self._executor.shutdown()
+        shutil.rmtree(self.run_directory, ignore_errors=True)
+
+    def _new_range(self, prefix, start_after=None, last=None):
+        self.range_count += 1
+        return _KeyRange(
+            prefix, start_after, last, self.run_directory / f"list_range_{self.range_count}.bin"
+        )
+
+    def _list_directory(self, prefix):
+        """
+        Returns the objects and the subdirectories directly in the directory prefix, or None if
+        there are more than MAX_DISCOVERY_PAGES pages of them.
+        """
+        objects = []
+        subdirectories = []
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        pages = paginator.paginate(Bucket=self.bucket, Prefix=prefix, Delimiter="/")
+        for page_number, page in enumerate(pages, start=1):
+            if page_number > MAX_DISCOVERY_PAGES:
+                return None
+            objects.extend(page.get("Contents", []))
+            subdirectories.extend(p["Prefix"] for p in page.get("CommonPrefixes", []))
+        return objects, subdirectories
+
+    def _directory_ranges(self, prefix, objects, subdirectories):
+        """
+        Returns the ranges that cover a directory, in key order: one for each subdirectory, and
+        ones that are already listed for the objects between them.
+        """
+        ranges = []
+        writer = None
+        subdirectory_index = 0
+        for obj in objects:
+            # The keys of a subdirectory sort together, after the subdirectory itself
+            while (
+                subdirectory_index < len(subdirectories)
+                and subdirectories[subdirectory_index] < obj["Key"]
+            ):
+                if writer is not None:
+                    writer.close()
+                    writer = None
+                ranges.append(self._new_range(subdirectories[subdirectory_index]))
+                subdirectory_index += 1
+            if obj["Key"].endswith("/"):
+                continue
+            if writer is None:
+                objects_range = self._new_range(prefix)
+                objects_range.done.set()
+                ranges.append(objects_range)
+                writer = ShardWriter(objects_range.path)
+            writer.write(s3_object_from_listing(obj))
+        if writer is not None:
+            writer.close()
+        ranges.extend(self._new_range(p) for p in subdirectories[subdirectory_index:])
+        return ranges
+
+    def discover_ranges(self):
+        """
+        Returns the ranges that cover the prefix, in key order, by listing the directory levels under
+        the prefix with a delimiter. It stops at discovery_depth levels or when there are enough
+        ranges to keep the threads busy.
+        """
+        ranges = [self._new_range(self.prefix)]
+        if self.concurrency == 1:
+            # A single range, listed like a single paginated listing
+            return ranges
+        for _ in range(self.discovery_depth):
+            unlisted = [r for r in ranges if not r.done.is_set()]
+            if not unlisted or len(unlisted) >= DISCOVERY_RANGES_PER_THREAD * self.concurrency:
+                break
+            directories = dict(
+                zip(
+                    (r.prefix for r in unlisted),
+                    self._executor.map(self._list_directory, [r.prefix for r in unlisted]),
+                )
+            )
+            expanded_ranges = []
+            for key_range in ranges:
+                if key_range.done.is_set() or directories[key_range.prefix] is None:
+                    expanded_ranges.append(key_range)
+                else:
+                    expanded_ranges.extend(
+                        self._directory_ranges(key_range.prefix, *directories[key_range.prefix])
+                    )
+            ranges = expanded_ranges
+        return ranges
+
+    def _start(self):
+        """Discovers the ranges, and starts listing them."""
+        ranges = self.discover_ranges()
+        for key_range, next_range in zip(ranges, ranges[1:]):
+            key_range.next = next_range
+        self._first_range = ranges[0] if ranges else None
+        with self._lock:
+            self._pending = [r for r in ranges if not r.done.is_set()]
+            self._schedule()
+
+    def _stop(self):
+        """Stops listing. The active ranges stop after their current request."""
+        with self._lock:
+            self._stopping = True
+            for key_range in self._pending:
+                key_range.done.set()
+            self._pending = []
+
+    def _split(self):
+        """Splits the unfinished range that has listed the most pages, and returns the new range, or None."""
+        candidates = sorted(
+            (r for r in self._active if r.truncated and r.page_count >= MIN_PAGES_TO_SPLIT),
+            key=lambda r: r.page_count,
+            reverse=True,
+        )
+        for key_range in candidates:
+            upper = key_range.last
+            if upper is None:
+                upper = key_range.prefix + chr(SPLIT_UPPER_CHAR)
+            split_key = key_between(key_range.listed_after, upper)
+            if split_key is None:
+                continue
+            new_range = self._new_range(key_range.prefix, split_key, key_range.last)
+            new_range.next = key_range.next
+            key_range.next = new_range
+            key_range.last = split_key
+            self.split_count += 1
+            return new_range
+        return None
+
+    def _schedule(self):
+        """Keeps every thread busy with a range, splitting ranges when none are waiting. Call it holding the lock."""
+        while not self._stopping and len(self._active) < self.concurrency:
+            if self._pending:
+                key_range = self._pending.pop(0)
+            else:
+                key_range = self._split()
+                if key_range is None:
+                    return
+            self._active.append(key_range)
+            self._executor.submit(self._list_range, key_range)
+
+    def _list_range(self, key_range):
+        try:
+            with ShardWriter(key_range.path) as writer:
+                start_after = key_range.start_after
+                while True:
+                    request = {"Bucket": self.bucket, "Prefix": key_range.prefix}
+                    if start_after is not None:
+                        request["StartAfter"] = start_after
+                    response = self.s3_client.list_objects_v2(**request)
+                    contents = response.get("Contents", [])
+                    with self._lock:
+                        if self._stopping:
+                            return
+                        # Read the upper boundary after the response, as a split may have lowered it
+                        last = key_range.last
+                        if last is not None and contents and contents[-1]["Key"] > last:
+                            contents = [obj for obj in contents if obj["Key"] <= last]
+                            key_range.truncated = False
+                        else:
+                            key_range.truncated = response.get("IsTruncated", False)
+                        if contents:
+                            key_range.listed_after = contents[-1]["Key"]
+                        key_range.page_count += 1
+                        truncated = key_range.truncated
+                    for obj in contents:
+                        if not obj["Key"].endswith("/"):
+                            writer.write(s3_object_from_listing(obj))
+                    if not truncated:
+                        break
+                    start_after = contents[-1]["Key"]
+                    # This range can now be split, if a thread is idle
+                    with self._lock:
+                        self._schedule()
+        except Exception as exc:
+            self._exception = exc
+            self._stop()
+        finally:
+            with self._lock:
+                self._active.remove(key_range)
+                self._schedule()
+            key_range.done.set()
+
+    def objects(self):
+        """Yields the objects in S3 listing order, as the ranges finish."""
+        self._start()
+        key_range = self._first_range
+        while key_range is not None:
+            key_range.done.wait()
+            if self._exception is not None:
+                raise self._exception
+            yield from read_shard(key_range.path)
+            key_range.path.unlink()
+            # A range is only split while it's being listed, so its next range is final now
+            key_range = key_range.next
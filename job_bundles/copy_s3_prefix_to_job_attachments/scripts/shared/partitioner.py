@@ -0,0 +1,89 @@
+"""
+Divides the S3 objects under the prefix into partitions, one for each task of the
+HashObjects and CopyObjects steps, so that the tasks take about the same time.
+
+The time of a task is estimated from a cost per object, made of the overhead of the
+API calls the steps make for every object plus the time to transfer its bytes. Objects
+are assigned to the partition with the lowest estimated cost so far, a greedy bin-packing
+that works while the listing is streamed. Objects that are large compared to the rest
+are held back and placed at the end, largest first (LPT scheduling), onto the partitions
+that are then the least loaded.
+"""
+
+import heapq
+
+# HashObjects calls GetObjectTagging, then HeadObject or GetObject and PutObjectTagging, and
+# CopyObjects calls HeadObject and CopyObject.
+DEFAULT_API_CALLS_PER_OBJECT = 5
+# The effective time per API call, with the tasks running many calls concurrently.
+DEFAULT_REQUEST_SECONDS = 0.005
+# The rate at which a task reads, hashes and copies the bytes of one object.
+DEFAULT_BYTES_PER_SECOND = 100 * 1024 * 1024
+# Objects that take at least this long are held back and placed largest first.
+DEFAULT_LARGE_OBJECT_SECONDS = 10.0
+
+
+class CostModel:
+    """Estimates the seconds the HashObjects and CopyObjects tasks spend on an object."""
+
+    def __init__(
+        self,
+        *,
+        api_calls_per_object=DEFAULT_API_CALLS_PER_OBJECT,
+        request_seconds=DEFAULT_REQUEST_SECONDS,
+        bytes_per_second=DEFAULT_BYTES_PER_SECOND,
+    ):
+        self.per_object_seconds = api_calls_per_object * request_seconds
+        self.bytes_per_second = bytes_per_second
+
+    def cost(self, size):
+        return self.per_object_seconds + size / self.bytes_per_second
+
+
+class GreedyPartitioner:
+    """
+    Assigns objects to partitions, balancing the estimated cost of each partition.
+
+    Call add() for every object as it is listed. It returns the 0-based partition index
+    for the object, or None if the object is large and was held back. After all the objects
+    are added, finish() returns (index, object) pairs for the held back objects.
+    """
+
+    def __init__(self, partition_count, cost_model, large_object_seconds):
+        self.cost_model = cost_model
+        self.large_object_seconds = large_object_seconds
+        self.costs = [0.0] * partition_count
+        self.max_object_cost = 0.0
+        self._heap = [(0.0, i) for i in range(partition_count)]
+        self._large_objects = []
+
+    def _assign(self, cost):
+        total, index = heapq.heappop(self._heap)
+        total += cost
+        self.costs[index] = total
+        heapq.heappush(self._heap, (total, index))
+        return index
+
+    def add(self, s3_object):
+        cost = self.cost_model.cost(s3_object.size)
+        self.max_object_cost = max(self.max_object_cost, cost)
+        if cost >= self.large_object_seconds:
+            self._large_objects.append((cost, s3_object))
+            return None
+        return self._assign(cost)
+
+    def finish(self):
+        self._large_objects.sort(key=lambda v: v[0], reverse=True)
+        result = [(self._assign(cost), s3_object) for cost, s3_object in self._large_objects]
+        self._large_objects = []
+        return result
+
+    @property
+    def makespan(self):
+        """The predicted time for the step, set by the partition with the highest cost."""
+        return max(self.costs)
+
+    @property
+    def lower_bound(self):
+        """No partitioning can be faster than an even split, or than its largest object."""
+        return max(sum(self.costs) / len(self.costs), self.max_object_cost)
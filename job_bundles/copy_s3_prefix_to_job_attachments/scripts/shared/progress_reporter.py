@@ -0,0 +1,90 @@
+"""
+Progress and log output at a bounded rate, for tasks that process millions of objects.
+
+Printing a few lines for every object makes gigabytes of task logs on a large prefix, and the
+worker agent spends CPU forwarding them. The ProgressReporter prints openjd_progress at most
+once per interval, and counts what happened to each object by outcome, like "tagged" or
+"copied", printing the counts in a periodic openjd_status summary instead. The lines about
+each object are only printed in debug mode.
+"""
+
+import threading
+import time
+from collections import Counter
+
+# How often to print openjd_progress
+DEFAULT_PROGRESS_INTERVAL_SECONDS = 1.0
+# How often to print an openjd_status summary
+DEFAULT_SUMMARY_INTERVAL_SECONDS = 10.0
+
+
+class ProgressReporter:
+    """
+    Reports the progress of a task through object_count objects. Call advance() as objects
+    complete, count() for the outcome of each object, and debug() for the details of each object.
+    Any thread can call count() and debug(). details, if given, returns more text for the summary.
+    """
+
+    def __init__(
+        self,
+        object_count,
+        debug=False,
+        details=None,
+        progress_interval_seconds=DEFAULT_PROGRESS_INTERVAL_SECONDS,
+        summary_interval_seconds=DEFAULT_SUMMARY_INTERVAL_SECONDS,
+    ):
+        self.object_count = object_count
+        self.processed_count = 0
+        self.outcome_counts = Counter()
+        self.debug_enabled = debug
+        self.details = details
+        self.progress_interval_seconds = progress_interval_seconds
+        self.summary_interval_seconds = summary_interval_seconds
+        self._lock = threading.Lock()
+        self._last_progress_time = time.monotonic()
+        self._last_progress = None
+        self._last_summary_time = self._last_progress_time
+
+    def debug(self, message):
+        """Prints a line about one object, in debug mode only."""
+        if self.debug_enabled:
+            # Combine the "\n" with the message, as otherwise lines from different threads interleave
+            print(f"{message}\n", end="")
+
+    def count(self, outcome, amount=1):
+        """Counts objects with the outcome, for the summary."""
+        with self._lock:
+            self.outcome_counts[outcome] += amount
+
+    def advance(self, amount=1):
+        """Adds to the count of processed objects, and prints the progress and summary if they're due."""
+        self.processed_count += amount
+        now = time.monotonic()
+        if now - self._last_progress_time >= self.progress_interval_seconds:
+            self._last_progress_time = now
+            self._print_progress()
+            if now - self._last_summary_time >= self.summary_interval_seconds:
+                self._last_summary_time = now
+                self.print_summary()
+
+    def _print_progress(self):
+        progress = f"{100 * self.processed_count / max(self.object_count, 1):.1f}"
+        # Skip the line if the rounded value is the same
+        if progress != self._last_progress:
+            self._last_progress = progress
+            print(f"openjd_progress: {progress}\n", end="")
+
+    def print_summary(self):
+        """Prints how many objects were processed so far, with the count of each outcome."""
+        with self._lock:
+            outcomes = ", ".join(f"{count} {outcome}" for outcome, count in self.outcome_counts.items())
+        summary = f"openjd_status: Processed {self.processed_count} of {self.object_count} objects"
+        if outcomes:
+            summary += f" ({outcomes})"
+        if self.details is not None:
+            summary += f", {self.details()}"
+        print(f"{summary}\n", end="")
+
+    def finish(self):
+        """Prints the final progress."""
+        print("openjd_progress: 100\n", end="")
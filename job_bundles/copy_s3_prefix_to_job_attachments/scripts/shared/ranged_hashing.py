@@ -0,0 +1,103 @@
+"""
+Hashes large S3 objects by fetching byte ranges concurrently.
+
+A single GetObject stream is limited to the bandwidth of one connection, so a very
+large object can take much longer than the rest of a partition combined. The
+RangedHasher fetches the byte ranges of the object with concurrent ranged GETs, and
+feeds them in order into a single xxh3_128 state, so the digest is identical to the
+one from hashing the object sequentially.
+
+Ranges that arrive out of order wait in a reorder buffer until it's their turn. The
+buffer is shared by all the objects being hashed, and has a fixed number of slots, so
+memory use stays capped at about max_buffered_ranges * range_size bytes.
+"""
+
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from xxhash import xxh3_128
+
+from instrumentation import timed
+
+DEFAULT_RANGED_HASH_THRESHOLD = 128 * 1024 * 1024
+DEFAULT_RANGE_SIZE = 16 * 1024 * 1024
+DEFAULT_RANGE_CONCURRENCY = 16
+DEFAULT_MAX_BUFFERED_RANGES = 32
+
+
+class RangedHasher:
+    """
+    Hashes S3 objects with concurrent ranged GETs. Use it as a context manager, so the threads
+    fetching ranges are shut down at the end.
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        *,
+        range_size=DEFAULT_RANGE_SIZE,
+        range_concurrency=DEFAULT_RANGE_CONCURRENCY,
+        max_buffered_ranges=DEFAULT_MAX_BUFFERED_RANGES,
+        instrumentation=None,
+    ):
+        self.s3_client = s3_client
+        self.instrumentation = instrumentation
+        self.range_size = range_size
+        self._buffer_slots = threading.Semaphore(max_buffered_ranges)
+        self._executor = ThreadPoolExecutor(max_workers=range_concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._executor.shutdown(wait=True)
+
+    def _get_range(self, bucket, key, etag, start, end):
+        response = self.s3_client.get_object(
+            Bucket=bucket, Key=key, IfMatch=etag, Range=f"bytes={start}-{end - 1}"
+        )
+        return response["Metadata"], response["Body"].read()
+
+    def hash_object(self, bucket, key, etag, size, *, on_range=None):
+        """
+        Returns (hexdigest, metadata) for the object, where metadata is the user-defined
+        metadata of the object. The etag must match, so every range is from the same object.
+
+        If on_range is provided, it's called with the data of each range in order, after it is
+        hashed. It runs while the range holds its slot in the reorder buffer, so it should not
+        wait long.
+        """
+        range_size = self.range_size
+        hasher = xxh3_128()
+        metadata = None
+        next_start = 0
+        in_flight = deque()
+        try:
+            while next_start < size or in_flight:
+                # Fill the reorder buffer. An object waits for a slot only when it has no ranges
+                # in flight, because otherwise objects could wait on each other while holding slots.
+                while next_start < size and self._buffer_slots.acquire(blocking=not in_flight):
+                    end = min(next_start + range_size, size)
+                    in_flight.append(
+                        self._executor.submit(self._get_range, bucket, key, etag, next_start, end)
+                    )
+                    next_start = end
+                # Feed the next range in order into the hasher
+                future = in_flight.popleft()
+                try:
+                    range_metadata, data = future.result()
+                    if metadata is None:
+                        metadata = range_metadata
+                    with timed(self.instrumentation, "xxh128"):
+                        hasher.update(data)
+                    if on_range is not None:
+                        on_range(data)
+                finally:
+                    # The range holds its slot until it's consumed, to keep the memory use capped
+                    self._buffer_slots.release()
+        finally:
+            for future in in_flight:
+                future.cancel()
+                self._buffer_slots.release()
+        return hasher.hexdigest(), metadata
@@ -0,0 +1,122 @@
+"""
+Concurrency control for the many small S3 API calls the copy job makes per object.
+
+When a prefix has many small objects, the steps are bound by request latency rather
+than by CPU or bandwidth, so they need many requests in flight. The AimdLimiter caps
+how many run at once with an additive-increase/multiplicative-decrease (AIMD) limit,
+the same scheme TCP uses for congestion control: the limit grows slowly while requests
+succeed, and is cut in half when S3 responds with SlowDown or another throttling error.
+"""
+
+import random
+import threading
+import time
+
+import botocore.config
+import botocore.exceptions
+
+# Error codes that S3 and other AWS services return when a caller should slow down.
+THROTTLE_ERROR_CODES = {
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "TooManyRequestsException",
+    "ServiceUnavailable",
+    "503",
+}
+
+
+class AimdLimiter:
+    """
+    Limits the number of concurrent requests, adapting the limit to throttling.
+
+    Use it as a context manager around each request, and connect on_throttle() to the
+    client with register_throttle_listener() so that it sees throttling responses even
+    when botocore retries them.
+    """
+
+    def __init__(self, initial, maximum, minimum=1, decrease_cooldown_seconds=1.0):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.decrease_cooldown_seconds = decrease_cooldown_seconds
+        self.throttle_count = 0
+        self._limit = float(initial)
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def __enter__(self):
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                self._condition.wait()
+            self._in_flight += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self._condition:
+            self._in_flight -= 1
+            if exc_type is None:
+                # Additive increase, by about one for each limit's worth of successful requests
+                self._limit = min(self.maximum, self._limit + 1 / self._limit)
+            self._condition.notify_all()
+
+    def on_throttle(self):
+        with self._condition:
+            self.throttle_count += 1
+            now = time.monotonic()
+            # The requests in flight when the limit is cut may also get throttled, so
+            # only cut once per cooldown period.
+            if now - self._last_decrease >= self.decrease_cooldown_seconds:
+                self._last_decrease = now
+                self._limit = max(self.minimum, self._limit / 2)
+
+
+def is_throttle_response(parsed_response):
+    """Returns True if the parsed botocore response is a throttling error."""
+    if not parsed_response:
+        return False
+    error_code = parsed_response.get("Error", {}).get("Code")
+    status_code = parsed_response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return error_code in THROTTLE_ERROR_CODES or status_code == 503
+
+
+def is_retryable_error(exc):
+    """Returns True if a request that raised the exception should be retried."""
+    if isinstance(exc, botocore.exceptions.ClientError):
+        return is_throttle_response(exc.response) or (
+            exc.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500
+        )
+    return isinstance(
+        exc, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)
+    )
+
+
+def backoff_seconds(attempt, base_seconds=0.1, max_seconds=20.0):
+    """Returns a delay before retry number attempt (starting at 1), using exponential backoff with full jitter."""
+    return random.uniform(0, min(max_seconds, base_seconds * 2**attempt))
+
+
+def register_throttle_listener(client, on_throttle):
+    """Calls on_throttle() every time the client receives a throttling response."""
+
+    def needs_retry_handler(response, **kwargs):
+        if response is not None and is_throttle_response(response[1]):
+            on_throttle()
+
+    client.meta.events.register("needs-retry.s3", needs_retry_handler)
+
+
+def client_config(max_pool_connections, max_attempts=10):
+    """
+    Returns a botocore config with a connection pool for the given number of concurrent requests.
+    Use max_attempts=1 when the caller handles retries itself.
+    """
+    return botocore.config.Config(
+        max_pool_connections=max_pool_connections,
+        retries={"mode": "standard", "max_attempts": max_attempts},
+    )
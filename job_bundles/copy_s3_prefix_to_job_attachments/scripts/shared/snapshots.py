@@ -0,0 +1,64 @@
+"""
+Locations and contents of the bucket prefix snapshots that SaveManifest writes.
+
+Next to each manifest, SaveManifest writes an object index with the key, size, etag,
+xxh128 hash and POSIX mtime of every object, one JSON object per line in S3 listing
+order, compressed with gzip. The manifest itself has no etags, so the object index is
+what the incremental mode of CollectObjects compares with the fresh listing. Both are in
+the same order, so the comparison is a merge join that streams through both of them.
+"""
+
+import gzip
+import io
+import json
+
+from object_shards import S3Object
+
+MANIFEST_SUFFIX = "-manifest.json"
+MANIFEST_INDEX_SUFFIX = "-manifest-index.json"
+# The partitioned manifests are in a directory next to their index
+PARTITIONED_MANIFESTS_SUFFIX = "-manifests/"
+OBJECT_INDEX_SUFFIX = "-objects.jsonl.gz"
+
+
+def snapshot_prefix(ja_root_prefix, s3_bucket_name, s3_prefix):
+    """Returns the key prefix, ending in "/", of the snapshots for the bucket prefix."""
+    return f"{ja_root_prefix}/Manifests/bucket-prefix-snapshot-{s3_bucket_name}/{s3_prefix}/"
+
+
+def find_latest_object_index(s3_client, ja_s3_bucket_name, prefix):
+    """
+    Returns the key of the object index for the most recent snapshot in the prefix, or None if
+    there isn't one. Snapshots saved before object indexes were added are skipped.
+    """
+    latest_key = None
+    paginator = s3_client.get_paginator("list_objects_v2")
+    # The delimiter excludes the snapshots of longer prefixes, that are nested within this prefix
+    for page in paginator.paginate(Bucket=ja_s3_bucket_name, Prefix=prefix, Delimiter="/"):
+        for obj in page.get("Contents", []):
+            # The keys start with an ISO 8601 timestamp, so the latest one sorts last
+            if obj["Key"].endswith(OBJECT_INDEX_SUFFIX):
+                latest_key = max(latest_key or obj["Key"], obj["Key"])
+    return latest_key
+
+
+def read_object_index(s3_client, ja_s3_bucket_name, key):
+    """Yields the objects of a snapshot object index one at a time, in S3 listing order."""
+    response = s3_client.get_object(Bucket=ja_s3_bucket_name, Key=key)
+    with gzip.GzipFile(fileobj=response["Body"]) as fh:
+        for line in io.TextIOWrapper(fh, encoding="utf8"):
+            yield S3Object.from_dict(json.loads(line))
+
+
+def write_object_index(fileobj, s3_objects):
+    """
+    Writes the gzip-compressed object index for objects that are already in S3 listing order
+    to a writable binary file object. Returns the number of objects written.
+    """
+    object_count = 0
+    with gzip.GzipFile(fileobj=fileobj, mode="wb", mtime=0) as fh:
+        for s3_object in s3_objects:
+            fh.write(json.dumps(s3_object.to_dict(), separators=(",", ":")).encode("utf8"))
+            fh.write(b"\n")
+            object_count += 1
+    return object_count
@@ -0,0 +1,18 @@
+"""
+Standard options of the copy job's scripts, following the shared library pattern of the
+developer progression job bundles.
+"""
+
+
+def add_standard_args(parser):
+    """Add standard options to the argparse parser."""
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        help="Log every object as it's processed, instead of periodic summaries.",
+    )
+
+
+def process_standard_args(args):
+    if args.debug:
+        print("Debug mode is enabled")
@@ -0,0 +1,108 @@
+"""
+Append-only journals that let a retried HashObjects or CopyObjects task skip the objects
+that an interrupted attempt already finished.
+
+A task appends a line to its journal in the workspace for every object it completes, and
+checkpoints the journal every few seconds by flushing it and calling fsync, so an interruption
+loses at most the objects completed since the last checkpoint. The first line identifies the
+shard the task processes by its size and modification time, so a journal for a different
+shard, like one that an earlier run of CollectObjects partitioned, is discarded. A last line
+that an interruption cut short is dropped when the journal is opened again.
+"""
+
+import json
+import os
+import time
+from pathlib import Path
+
+JOURNALS_DIRNAME = "journals"
+# How often to flush and fsync the journal
+DEFAULT_CHECKPOINT_SECONDS = 10.0
+
+
+def journal_path(workspace_path: Path, step_name, index) -> Path:
+    """Returns the path of the journal for the task of the step with the 1-based partition index."""
+    return workspace_path / JOURNALS_DIRNAME / f"{step_name}_{index}.jsonl"
+
+
+def shard_identity(path: Path):
+    """Returns what identifies the contents of a shard file, to match a journal with the shard it was written for."""
+    stat = os.stat(path)
+    return {"shard_size": stat.st_size, "shard_mtime_ns": stat.st_mtime_ns}
+
+
+class TaskJournal:
+    """
+    A journal of the objects a task has completed. Opening it keeps the entries from an earlier
+    attempt on the same shard, which entries() returns, and append() adds entries. Call append()
+    from one thread only.
+    """
+
+    def __init__(self, path: Path, identity, checkpoint_seconds=DEFAULT_CHECKPOINT_SECONDS):
+        self.path = path
+        self.checkpoint_seconds = checkpoint_seconds
+        self.replayed_count = 0
+        self.checkpoint_count = 0
+        path.parent.mkdir(parents=True, exist_ok=True)
+        header = json.dumps(identity, separators=(",", ":"), sort_keys=True)
+
+        # Find the end of the last complete entry of an earlier attempt on the same shard
+        valid_size = 0
+        if path.exists():
+            with open(path, "rb") as fh:
+                if fh.readline().decode("utf8", errors="replace").rstrip("\n") == header:
+                    valid_size = fh.tell()
+                    for line in fh:
+                        if not line.endswith(b"\n"):
+                            break
+                        try:
+                            json.loads(line)
+                        except ValueError:
+                            break
+                        valid_size += len(line)
+                        self.replayed_count += 1
+        self._fh = open(path, "a+", encoding="utf8")
+        self._fh.truncate(valid_size)
+        if valid_size == 0:
+            self._fh.write(header + "\n")
+            self.checkpoint()
+        self._last_checkpoint_time = time.monotonic()
+
+    def entries(self):
+        """Yields the entries in the journal as of the last checkpoint."""
+        with open(self.path, encoding="utf8") as fh:
+            # Skip the shard identity
+            fh.readline()
+            for line in fh:
+                if not line.endswith("\n"):
+                    break
+                yield json.loads(line)
+
+    def append(self, entry):
+        self._fh.write(json.dumps(entry, separators=(",", ":")))
+        self._fh.write("\n")
+        if time.monotonic() - self._last_checkpoint_time >= self.checkpoint_seconds:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Makes the entries appended so far durable."""
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self.checkpoint_count += 1
+        self._last_checkpoint_time = time.monotonic()
+
+    def close(self):
+        self.checkpoint()
+        self._fh.close()
+
+    def remove(self):
+        """Deletes the journal, once the task's results are saved elsewhere."""
+        self._fh.close()
+        self.path.unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self._fh.closed:
+            self.close()